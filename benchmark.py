@@ -0,0 +1,162 @@
+import os, sys, json, time, math, argparse, tempfile, tracemalloc
+sys.path.insert(1, './src')
+from alang_parser import parse_file
+from alang_compiler import compile_alang
+from assembler import assemble
+from program_generator import generate_program, DEFAULT_SIZES
+
+# Benchmark of the parser, compiler and assembler on synthetic programs.
+#
+# Each size parameter of the program generator is scaled on its own by the given factors while the
+# others keep their default. parse_file, compile_alang and assemble are timed separately, taking
+# the best of a few runs, then run once more with tracemalloc for their peak memory.
+# The exponent of each scaling curve is fitted on a log-log scale: 1 is linear, 2 quadratic.
+#
+# With a baseline file the run fails if a stage became slower, used more memory or scales worse
+# than in the baseline. Times depend on the machine, so save the baseline on the machine that checks it.
+
+STAGES = ["parse", "compile", "assemble"]
+DEFAULT_FACTORS = [1, 2, 4, 8]
+DEFAULT_BASELINE = "benchmark_baseline.json"
+
+def run_stages(path, trace=False):
+    """Parse, compile and assemble a program file. Return {stage: seconds} or {stage: peak bytes} if trace."""
+    results = {}
+
+    def measure(stage, fn, *args):
+        if trace:
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        value = fn(*args)
+        results[stage] = time.perf_counter() - start
+        if trace:
+            results[stage] = tracemalloc.get_traced_memory()[1] - current
+        return value
+
+    code_blocks = measure("parse", parse_file, path)
+    listing = measure("compile", compile_alang, code_blocks)
+    measure("assemble", assemble, listing)
+    return results
+
+def scaling_exponent(sizes, seconds):
+    """Least squares slope of log(seconds) over log(size)."""
+    points = [(math.log(s), math.log(t)) for s, t in zip(sizes, seconds) if s > 0 and t > 0]
+    if len(points) < 2:
+        return 0
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    if var == 0:
+        return 0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+def benchmark_axis(axis, factors, repeat, directory):
+    """Scale one size parameter. Return its sizes, program lengths and per stage curves."""
+    curve = {"sizes": [], "lines": [], "stages": {stage: {"seconds": [], "peak_bytes": []} for stage in STAGES}}
+    for factor in factors:
+        size = DEFAULT_SIZES[axis] * factor
+        source = generate_program({axis: size})
+        path = os.path.join(directory, f"{axis}_{size}.alang")
+        with open(path, "w") as f:
+            f.write(source)
+        best = {stage: math.inf for stage in STAGES}
+        for _ in range(repeat):
+            for stage, seconds in run_stages(path).items():
+                best[stage] = min(best[stage], seconds)
+        tracemalloc.start()
+        peaks = run_stages(path, trace=True)
+        tracemalloc.stop()
+        curve["sizes"].append(size)
+        curve["lines"].append(source.count("\n"))
+        for stage in STAGES:
+            curve["stages"][stage]["seconds"].append(best[stage])
+            curve["stages"][stage]["peak_bytes"].append(peaks[stage])
+    for stage in STAGES:
+        data = curve["stages"][stage]
+        data["exponent"] = scaling_exponent(curve["sizes"], data["seconds"])
+    return curve
+
+def compare(report, baseline, time_tolerance, memory_tolerance, exponent_tolerance):
+    """Return the regressions of a report against a baseline report as messages."""
+    failures = []
+    for axis, old_curve in baseline["axes"].items():
+        curve = report["axes"].get(axis)
+        if curve is None or curve["sizes"] != old_curve["sizes"]:
+            continue
+        for stage, old in old_curve["stages"].items():
+            new = curve["stages"][stage]
+            name = f"{axis} {stage}"
+            if new["exponent"] > old["exponent"] + exponent_tolerance:
+                failures.append(f"{name}: scales with exponent {new['exponent']:.2f}, baseline {old['exponent']:.2f}")
+            if new["seconds"][-1] > old["seconds"][-1] * (1 + time_tolerance):
+                failures.append(f"{name}: {new['seconds'][-1]:.4f} s at size {curve['sizes'][-1]}, "
+                    f"baseline {old['seconds'][-1]:.4f} s")
+            if new["peak_bytes"][-1] > old["peak_bytes"][-1] * (1 + memory_tolerance):
+                failures.append(f"{name}: peak {new['peak_bytes'][-1]} bytes at size {curve['sizes'][-1]}, "
+                    f"baseline {old['peak_bytes'][-1]}")
+    return failures
+
+def format_report(report):
+    lines = [f"{'Axis':11} {'size':>6} {'lines':>7}" + "".join(f" {stage + ' s':>12} {'KiB':>9}" for stage in STAGES)]
+    for axis, curve in report["axes"].items():
+        for idx, size in enumerate(curve["sizes"]):
+            row = f"{axis:11} {size:6} {curve['lines'][idx]:7}"
+            for stage in STAGES:
+                data = curve["stages"][stage]
+                row += f" {data['seconds'][idx]:12.4f} {data['peak_bytes'][idx] / 1024:9.1f}"
+            lines.append(row)
+        exponents = ", ".join(f"{stage} {curve['stages'][stage]['exponent']:.2f}" for stage in STAGES)
+        lines.append(f"{axis:11} exponents: {exponents}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the compiler on generated programs of growing size.")
+    parser.add_argument("--axes", default=",".join(DEFAULT_SIZES),
+        help="Comma separated size parameters to scale. Default: %(default)s")
+    parser.add_argument("--factors", default=",".join(map(str, DEFAULT_FACTORS)),
+        help="Comma separated factors to scale each parameter by. Default: %(default)s")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size, the fastest is kept. Default: %(default)s")
+    parser.add_argument("--output", default="output/benchmark.json", help="Report file. Default: %(default)s")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE,
+        help="Fail on regressions against this report if it exists. Default: %(default)s")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the baseline.")
+    parser.add_argument("--time-tolerance", type=float, default=0.5,
+        help="Allowed slowdown at the largest size, as a fraction. Default: %(default)s")
+    parser.add_argument("--memory-tolerance", type=float, default=0.25,
+        help="Allowed growth of peak memory at the largest size, as a fraction. Default: %(default)s")
+    parser.add_argument("--exponent-tolerance", type=float, default=0.3,
+        help="Allowed growth of the scaling exponent. Default: %(default)s")
+    args = parser.parse_args()
+
+    axes = args.axes.split(",")
+    for axis in axes:
+        if axis not in DEFAULT_SIZES:
+            print(f"Unknown size parameter {axis}. Choose from {', '.join(DEFAULT_SIZES)}.")
+            exit()
+    factors = [int(f) for f in args.factors.split(",")]
+
+    report = {"defaults": DEFAULT_SIZES, "factors": factors, "repeat": args.repeat, "axes": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        for axis in axes:
+            print(f"Scaling {axis}...")
+            report["axes"][axis] = benchmark_axis(axis, factors, args.repeat, directory)
+    print(format_report(report))
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        failures = compare(report, baseline, args.time_tolerance, args.memory_tolerance, args.exponent_tolerance)
+        for failure in failures:
+            print(f"Regression: {failure}")
+        if failures:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
@@ -1,28 +1,159 @@
-import os, json, sys
+import os, json, sys, argparse
 sys.path.insert(1, './src')
-from alang_parser import parse_file
-from alang_compiler import compile_alang
-from assembler import assemble
+from alang_parser import parse_file, to_serializable
+from alang_compiler import compile_program, format_compile_stats, DEFAULT_OPTIONS
+from simulator import Simulator, format_stats
+from artifacts import output_files, write_outputs
+from build_cache import BuildCache, DEFAULT_MAX_BYTES, DEFAULT_MAX_AGE
+from profiler import Profiler, phase, format_profile
+from instrument import decode_profile, format_hotspots
+from compile_server import CompileServer, DEFAULT_ADDRESS
+from cost_model import format_costs, cost_hints
+from simulator import CYCLE_TABLE
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2: 
-        raise Exception("No input file specified.")
-    input_file = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Compile an alang file to machine code.")
+    parser.add_argument("input_file", nargs="?")
+    parser.add_argument("--peephole", default=",".join(DEFAULT_OPTIONS["peephole"]),
+        help="Comma separated peephole patterns to run. Default: %(default)s")
+    parser.add_argument("--no-peephole", action="store_true", help="Disable the peephole optimizer.")
+    parser.add_argument("--no-regalloc", action="store_true", help="Keep all variables in memory.")
+    parser.add_argument("--no-fold", action="store_true", help="Disable constant folding.")
+    parser.add_argument("--no-dead-code", action="store_true", help="Keep uncalled functions and never entered blocks.")
+    parser.add_argument("--no-overlay", action="store_true", help="Give every variable its own memory rows.")
+    parser.add_argument("--unroll", type=int, default=DEFAULT_OPTIONS["unroll"], metavar="FACTOR",
+        help="Unroll constant trip count loops and memcpy loops by up to FACTOR. 1 disables unrolling. Default: %(default)s")
+    parser.add_argument("--no-layout", action="store_true",
+        help="Place if and while bodies after their function instead of inline.")
+    parser.add_argument("--no-call-liveness", action="store_true", help="Always stash GR0 around calls.")
+    parser.add_argument("--inline-threshold", type=int, default=DEFAULT_OPTIONS["inline_threshold"],
+        help="Inline leaf functions of at most this many instructions. 0 disables inlining. Default: %(default)s")
+    parser.add_argument("--cache", nargs="?", const=".alang_cache", metavar="DIR",
+        help="Reuse compiled functions from a cache directory. Default directory: %(const)s")
+    parser.add_argument("--cache-max-mb", type=float, default=DEFAULT_MAX_BYTES / (1 << 20),
+        help="Evict the least recently used cached functions above this size. Default: %(default)s")
+    parser.add_argument("--cache-max-days", type=float, default=DEFAULT_MAX_AGE / 86400,
+        help="Evict cached functions unused for this many days. Default: %(default)s")
+    parser.add_argument("--jobs", type=int, default=DEFAULT_OPTIONS["jobs"], metavar="N",
+        help="Compile functions in N worker processes. 0 uses every CPU. Default: %(default)s")
+    parser.add_argument("--instrument", nargs="?", const="all", metavar="FUNCTIONS",
+        help="Count calls and cycles of functions and their loops on the target. Comma separated function names, "
+            "all functions if none are given. The symbol map is written to output/symbols.json.")
+    parser.add_argument("--cost", action="store_true",
+        help="Estimate the cycles of each function and loop. The ranked report is printed, "
+            "added to the listing comments and written to output/costs.json.")
+    parser.add_argument("--cycle-table", metavar="FILE",
+        help="JSON file overriding the cycles of opcodes and address modes used by --cost and --simulate.")
+    parser.add_argument("--loop-bound", type=int, default=DEFAULT_OPTIONS["loop_bound"], metavar="N",
+        help="Iterations --cost assumes for loops without a known trip count. Default: %(default)s")
+    parser.add_argument("--cost-hints", nargs="?", const="output/costs.json", metavar="FILE",
+        help="Inline and unroll the functions and loops hinted by a previous cost report more aggressively. "
+            "Default file: %(const)s")
+    parser.add_argument("--no-asm", action="store_true", help="Don't write the assembly listing output/compiled.asm.")
+    parser.add_argument("--dump-parsed", action="store_true", help="Write the parsed code blocks to output/parsed.json.")
+    parser.add_argument("--profile", nargs="?", const="output/profile.json", metavar="FILE",
+        help="Record the time and peak memory of each compiler phase and function and write them as JSON. "
+            "Default file: %(const)s")
+    parser.add_argument("--binary", action="store_true",
+        help="Write packed binary machine code to output/machine_code.bin instead of text.")
+    parser.add_argument("--serve", nargs="?", const=DEFAULT_ADDRESS, metavar="ADDRESS",
+        help="Run a compile server on a Unix socket path or local port, building with these flags. "
+            "Default: %(const)s. See src/compile_server.py.")
+    parser.add_argument("--watch", action="store_true", help="Rebuild files built by the server when they change.")
+    parser.add_argument("--simulate", nargs="?", type=int, const=-1, metavar="MAX_STEPS",
+        help="Run the machine code in the simulator and print the statistics.")
+    args = parser.parse_args()
+    input_file = args.input_file
+
+    options = {}
+    options["peephole"] = [] if args.no_peephole else args.peephole.split(",")
+    if args.no_regalloc:
+        options["registers"] = []
+    if args.no_fold:
+        options["fold"] = False
+    options["inline_threshold"] = args.inline_threshold
+    options["unroll"] = args.unroll
+    if args.no_dead_code:
+        options["dead_code"] = False
+    if args.no_overlay:
+        options["overlay"] = False
+    if args.no_layout:
+        options["layout"] = False
+    if args.no_call_liveness:
+        options["call_liveness"] = False
+    options["jobs"] = args.jobs or os.cpu_count()
+    if args.cache:
+        options["cache"] = BuildCache(args.cache, int(args.cache_max_mb * (1 << 20)), args.cache_max_days * 86400)
+    if args.instrument:
+        options["instrument"] = "all" if args.instrument == "all" else args.instrument.split(",")
+    cycle_table = CYCLE_TABLE
+    if args.cycle_table:
+        with open(args.cycle_table, "r") as f:
+            overrides = json.load(f)
+        cycle_table = {**CYCLE_TABLE, **overrides, "ops": {**CYCLE_TABLE["ops"], **overrides.get("ops", {})},
+            "modes": {**CYCLE_TABLE["modes"], **overrides.get("modes", {})}}
+    if args.cost:
+        options["cost"] = True
+        options["cycle_table"] = cycle_table
+        options["loop_bound"] = args.loop_bound
+    if args.cost_hints:
+        if not os.path.exists(args.cost_hints):
+            print(f"No cost report {args.cost_hints}. Build with --cost first.")
+            exit()
+        with open(args.cost_hints, "r") as f:
+            options["cost_hints"] = cost_hints(json.load(f))
+    if args.serve:
+        server = CompileServer(options, args.binary, not args.no_asm, watch=args.watch)
+        if input_file:
+            response = server.build(input_file)
+            print(response["output"])
+            if response.get("error"):
+                print(f"Compiler error: {response['error']}")
+        server.serve(args.serve)
+        exit()
+    if not input_file:
+        parser.error("the input file is required unless serving")
+
+    profiler = Profiler() if args.profile else None
+    options["profiler"] = profiler
+    stats = {}
 
     os.makedirs("output", exist_ok=True)
 
     print("Parsing code...")
-    code_blocks = parse_file(input_file)
-    with open(f"output/parsed.json", "w") as f:
-        f.write(json.dumps(code_blocks, indent=2, default=lambda x: x.__dict__))
+    with phase(profiler, "parse"):
+        code_blocks = parse_file(input_file, profiler)
+    if args.dump_parsed:
+        with phase(profiler, "dump_parsed"), open(f"output/parsed.json", "w") as f:
+            f.write(json.dumps(code_blocks, indent=2, default=to_serializable))
 
     print("Compiling...")
-    assembly_code = compile_alang(code_blocks)
-    with open(f"output/compiled.asm", "w") as f:
-        f.write(assembly_code)
+    with phase(profiler, "compile"):
+        program = compile_program(code_blocks, options, stats)
+    if stats_text := format_compile_stats(stats):
+        print(stats_text)
+    if program.costs:
+        print(format_costs(program.costs))
+    if not args.no_asm:
+        with phase(profiler, "listing"):
+            program.listing()
 
     print("Assembling...")
-    machine_code = assemble(assembly_code)
-    with open(f"output/machine_code", "w") as f:
-        f.write(machine_code)
+    with phase(profiler, "assemble"):
+        machine_code = program.words()
+    with phase(profiler, "write"):
+        write_outputs(output_files(program, args.binary, not args.no_asm))
+
+    if args.simulate is not None:
+        print("Simulating...")
+        with phase(profiler, "simulate"):
+            simulator = Simulator(machine_code, cycle_table=cycle_table, entry=program.entry)
+            simulation = simulator.run(args.simulate if args.simulate >= 0 else None)
+        print(format_stats(simulation))
+        if program.symbols:
+            print(format_hotspots(decode_profile(program.symbols, simulator.mem)))
 
+    if profiler is not None:
+        profiler.write(args.profile)
+        print(f"Profile written to {args.profile}")
+        print(format_profile(profiler.report()))
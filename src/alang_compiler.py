@@ -1,129 +1,285 @@
-from alang_parser import parse_file, Statement, IfStatement
+from alang_parser import parse_file, Statement, IfStatement, BlockTable, copy_blocks
 from compiler_utils import (
-    parse_function, 
-    parse_variable, 
     deref_variable,
+    deref_operand,
     get_block,
     instructions_to_string,
     Instruction, 
     JmpBackPlaceholder, 
     JmpToPlaceholder, 
-    CompilationError
+    JmpRelPlaceholder,
+    JmpOverPlaceholder,
+    CompilationError,
+    INDEX_REGISTER
 )
+from peephole import peephole, thread_jumps, PEEPHOLE_PATTERNS, BLOCK_PATTERNS, LINKED_PATTERNS
+from value_numbering import number_values
+from regalloc import allocate_registers, all_operands, function_map, ALLOCATABLE_REGISTERS
+from ir_optimizer import (
+    fold_constants,
+    is_inline_candidate,
+    eliminate_dead_code,
+    entry_functions,
+    reachable_functions,
+    unroll_loops,
+    declare_intrinsic_variables,
+    intrinsic_call,
+    MEMCPY_POINTER
+)
+from assembler import assemble_instructions
+from overlay import overlay_variables
+from build_cache import make_object, relocate, merge_stats
+from machine_image import WORD_BYTES
+from profiler import phase
+from instrument import declare_profile_counters, counter_address, profile_entry, profile_exit, active_blocks, symbol_map
+from cost_model import estimate_costs, annotate_costs, DEFAULT_LOOP_BOUND, HINT_FACTOR
+from simulator import CYCLE_TABLE
 import json
-import re
+import multiprocessing
+
+DEFAULT_OPTIONS = {
+    # Peephole patterns to run. See peephole.py.
+    "peephole": list(PEEPHOLE_PATTERNS) + BLOCK_PATTERNS + LINKED_PATTERNS,
+    # Keep hot local variables in these general registers. Empty to keep all variables in memory.
+    "registers": ALLOCATABLE_REGISTERS,
+    # Fold constant expressions and turn multiplications by powers of two into shifts.
+    "fold": True,
+    # Inline leaf functions compiling to at most this many instructions. 0 disables inlining.
+    "inline_threshold": 8,
+    # Only stash GR0 around calls when it holds a value needed after the call.
+    "call_liveness": True,
+    # BuildCache to reuse compiled functions from. None compiles everything.
+    "cache": None,
+    # Number of worker processes compiling functions in parallel.
+    "jobs": 1,
+    # Drop functions that are never called and if/while blocks that are never entered.
+    "dead_code": True,
+    # Share memory rows between locals of functions that are never active at the same time.
+    "overlay": True,
+    # Unroll loops with a constant trip count and memcpy loops by up to this factor. 1 disables unrolling.
+    "unroll": 4,
+    # Lay out if bodies after an inverted condition and loops with the test at the bottom.
+    "layout": True,
+    # Count entries and cycles of functions and loops on the target. "all" or a list of function names.
+    "instrument": None,
+    # Profiler recording the time and memory of each phase and function. None disables profiling.
+    "profiler": None,
+    # Estimate the cycles of each function and loop and add them to the listing. See cost_model.py.
+    "cost": False,
+    # Cycles of each opcode and address mode used by the estimates.
+    "cycle_table": CYCLE_TABLE,
+    # Iterations assumed for loops without a known trip count.
+    "loop_bound": DEFAULT_LOOP_BOUND,
+    # Functions and loops to inline and unroll more aggressively: {"inline": names, "unroll": names}.
+    "cost_hints": None,
+}
+
+# Largest value of the data field, the range of immediate operands.
+MAX_IMMEDIATE = 0xFFFFF
 
-# https://regex-vis.com/
-return_rgx = r"return( (([*&])?(\w+)))?$"
-if_rgx = r"(if|while)\(([\w*&]+)(!=|<|>)([\w*&]+)\)$"
-halt_rgx = r"(halt)$"
-time_rgx = r"time(?=[+\-*]|$)"
+# memcpy calls copying at most this many rows between constant addresses are fully unrolled.
+MEMCPY_UNROLL_LIMIT = 8
 
 OP_MAP = {
+    None: "LOAD",
     "+": "ADD",
     "-": "SUB",
     "*": "MUL",
-    "=": "STORE"
+    "<<": "LSL",
 }
 
-def compile_func_call(fn_name, fn_params, block, all_blocks):
-    """Compile a function call to assembly instructions."""
-    func_map = block["functions"]
+def inline_body(target_block, all_blocks):
+    """Return the instructions to inline for a call to the function, or None if it should be called."""
+    cache = all_blocks.inline_bodies
+    if target_block.block_id not in cache:
+        body = None
+        threshold = all_blocks.options.get("inline_threshold", 0)
+        hints = all_blocks.options.get("cost_hints") or {}
+        if target_block.name in hints.get("inline", ()):
+            threshold *= HINT_FACTOR
+        # Instrumented functions are always called so their calls are counted.
+        if threshold > 0 and is_inline_candidate(target_block) and target_block.block_id not in all_blocks.profile_counters:
+            body = []
+            for statement in target_block.code:
+                if statement.kind == "return":
+                    # Leave the return value in GR1 like a called function would.
+                    for _, operand in statement.terms:
+                        m, val = deref_operand(operand, target_block.variables, all_blocks.registers)
+                        body.append(Instruction("LOAD", 1, m, val))
+                else:
+                    body += compile_statement(statement, target_block, all_blocks)
+            if len(body) > threshold:
+                body = None
+        cache[target_block.block_id] = body
+    return cache[target_block.block_id]
+
+def compile_func_call(fn_name, fn_params, block, all_blocks, live=(0,)):
+    """Compile a function call to assembly instructions.
+    The registers in live hold values needed after the call and are stashed on the stack."""
+    func_map = block.functions
     if fn_name not in func_map:
         raise CompilationError(f"Undeclared function used: {fn_name}")
     func_code = func_map[fn_name]
 
+    if not all_blocks.options.get("call_liveness", True):
+        live = (0,)
+    # Calls used to always stash GR0.
+    eliminated = 0 if 0 in live else 2
+    if eliminated:
+        stash_stats = all_blocks.stats.setdefault("call_stash", {})
+        stash_stats["eliminated"] = stash_stats.get("eliminated", 0) + eliminated
+
     instructions = []
-    instructions.append(Instruction("PUSH", 0)) # Stash GR0
+    for r in live:
+        instructions.append(Instruction("PUSH", r)) # Stash live registers
 
     # Set function parameter variables
     target_block = get_block(func_code, all_blocks)
     for idx, param in enumerate(fn_params):
-        if idx >= len(target_block["parameters"]):
+        if idx >= len(target_block.parameters):
             raise CompilationError("Too many parameter values given.")
         
         # Load the local variable
-        adr_op, var_name, _ = parse_variable(param, True)
-        m, val = deref_variable(adr_op, var_name, block["variables"])
+        m, val = deref_operand(param, block.variables, all_blocks.registers)
         instructions.append(Instruction("LOAD", 0, m, val)) 
 
         # Store in the target variable
-        _, val = deref_variable(None, target_block["parameters"][idx], target_block["variables"])
-        instructions.append(Instruction("STORE", 0, 0, val)) # Store in function variable
+        m, val = deref_variable(None, target_block.parameters[idx], target_block.variables, all_blocks.registers)
+        instructions.append(Instruction("STORE", 0, m, val)) # Store in function variable
         
-    instructions.append(JmpToPlaceholder("CALL", func_code, 0))
-    instructions.append(Instruction("POP", 0)) # Retrieve stashed GR1
+    body = inline_body(target_block, all_blocks)
+    if body is not None:
+        instructions += [Instruction(i.op, i.grx, i.m, i.data) for i in body]
+        inline_stats = all_blocks.stats.setdefault("inline", {})
+        inline_stats["calls"] = inline_stats.get("calls", 0) + 1
+    else:
+        instructions.append(JmpToPlaceholder("CALL", func_code, 0))
+    for r in reversed(live):
+        instructions.append(Instruction("POP", r)) # Retrieve stashed registers
     return instructions
 
-def compile_expression(expression, block, all_blocks):
+def copy_loop(body, step, end, check_first):
+    """Repeat body, adding step to GR31 after each pass, while GR31 < end.
+    end is an (address mode, data) operand. check_first tests the condition before the first pass."""
+    instructions = []
+    if check_first:
+        instructions.append(JmpRelPlaceholder("JMP", len(body) + 2))
+    instructions += body
+    instructions.append(Instruction("ADD", INDEX_REGISTER, 1, step))
+    instructions.append(Instruction("CMP", INDEX_REGISTER, *end))
+    instructions.append(JmpRelPlaceholder("JGR", -(len(body) + 2)))
+    return instructions
+
+def compile_memcpy(params, block, all_blocks):
+    """Compile memcpy(destination, source, count). Copies count memory rows.
+    Constant addresses are copied with IDX addressing, with GR31 as the index. Otherwise GR31
+    holds the source address and the destination pointer is kept in memory for IND addressing."""
+    if len(params) != 3:
+        raise CompilationError("memcpy takes a destination, a source and a count.")
+    (dst_m, dst), (src_m, src), count = [deref_operand(p, block.variables, all_blocks.registers) for p in params]
+    factor = max(all_blocks.options.get("unroll", 1), 1)
+    instructions = []
+    if dst_m == 1 and src_m == 1:
+        if count[0] == 1 and count[1] <= max(MEMCPY_UNROLL_LIMIT, factor):
+            for i in range(count[1]):
+                instructions.append(Instruction("LOAD", 0, 0, src + i))
+                instructions.append(Instruction("STORE", 0, 0, dst + i))
+            return instructions
+        if count[0] == 1:
+            # Copy the rows that don't fill a whole unrolled pass first.
+            passes, rest = divmod(count[1], factor)
+            for i in range(passes * factor, count[1]):
+                instructions.append(Instruction("LOAD", 0, 0, src + i))
+                instructions.append(Instruction("STORE", 0, 0, dst + i))
+            body = []
+            for i in range(factor):
+                body.append(Instruction("LOAD", 0, 3, src + i))
+                body.append(Instruction("STORE", 0, 3, dst + i))
+            instructions.append(Instruction("LOAD", INDEX_REGISTER, 1, 0))
+            return instructions + copy_loop(body, factor, (1, passes * factor), False)
+        body = [Instruction("LOAD", 0, 3, src), Instruction("STORE", 0, 3, dst)]
+        instructions.append(Instruction("LOAD", INDEX_REGISTER, 1, 0))
+        return instructions + copy_loop(body, 1, count, True)
+
+    # GR31 runs from the source address to source + count, kept in GR1.
+    pointer = deref_variable(None, MEMCPY_POINTER, block.variables)[1]
+    instructions.append(Instruction("LOAD", 0, dst_m, dst))
+    instructions.append(Instruction("STORE", 0, 0, pointer))
+    instructions.append(Instruction("LOAD", INDEX_REGISTER, src_m, src))
+    instructions.append(Instruction("LOAD", 1, src_m, src))
+    instructions.append(Instruction("ADD", 1, *count))
+    step = 1
+    if count[0] == 1:
+        if count[1] == 0:
+            return []
+        step = next(k for k in range(factor, 0, -1) if count[1] % k == 0)
+    body = []
+    for i in range(step):
+        body.append(Instruction("LOAD", 0, 3, i))
+        body.append(Instruction("STORE", 0, 2, pointer))
+        body.append(Instruction("LOAD", 0, 0, pointer))
+        body.append(Instruction("ADD", 0, 1, 1))
+        body.append(Instruction("STORE", 0, 0, pointer))
+    return instructions + copy_loop(body, step, (4, 1), count[0] != 1)
+
+def compile_expression(terms, block, all_blocks):
     """Compile an expression (x+y-z...) to assembly instructions."""
     instructions = []
-    # Load first operand
-    if f := parse_function(expression):
-        fn_name, fn_params, width = f
-        instructions += compile_func_call(fn_name, fn_params, block, all_blocks)
-        # Functions store their return value in GR1. Copy it to GR0.
-        instructions.append(Instruction("LOAD", 0, 4, 1)) 
-        i = width
-    elif r := re.match(time_rgx, expression):
-        # Load time registry to GR1
-        instructions.append(Instruction("LOAD", 0, 4, 30))
-        _, i = r.span()
-    elif v := parse_variable(expression):
-        adr_op, var_name, width = v
-        m, val = deref_variable(adr_op, var_name, block["variables"])
-        instructions.append(Instruction("LOAD", 0, m, val))
-        i = width
-    else:
-        raise CompilationError("Invalid syntax.")
-
-    while i < len(expression):
-        operand = expression[i]
-        op = OP_MAP[operand]
-        sub_expression = expression[i+1:]
-        if f := parse_function(sub_expression):
-            fn_name, fn_params, width = f
-            instructions += compile_func_call(fn_name, fn_params, block, all_blocks)
-            instructions.append(Instruction(op, 0, 5, 1)) # Functions store their return value in GR1
-            i += width + 1
-        elif r := re.match(time_rgx, sub_expression):
-            # Load time registry to GR1
-            instructions.append(Instruction(op, 0, 4, 30))
-            i += r.span()[1] + 1
-        elif v := parse_variable(sub_expression):
-            adr_op, var_name, width = v
-            m, val = deref_variable(adr_op, var_name, block["variables"])
-            instructions.append(Instruction(op, 0, m, val))
-            i += width + 1
+    for op, operand in terms:
+        if operand.kind == "call":
+            # GR0 holds the value of the expression so far unless the call is the first operand.
+            # GR1 is free since return values are used right after each call.
+            live = (0,) if op else ()
+            instructions += compile_func_call(operand.value, operand.params, block, all_blocks, live)
+            # Functions store their return value in GR1.
+            instructions.append(Instruction(OP_MAP[op], 0, 4, 1))
         else:
-            raise CompilationError("Invalid syntax.")
+            m, val = deref_operand(operand, block.variables, all_blocks.registers)
+            instructions.append(Instruction(OP_MAP[op], 0, m, val))
     return instructions
 
-def compile_assignment(assign_target, block):
+def compile_assignment(assign_target, block, all_blocks):
     """Compile a value assignment (x=) to assembly instructions."""
-    adr_op, var_name, _ = parse_variable(assign_target, True)
-    m, val = deref_variable(adr_op, var_name, block["variables"])
-    if m != 0 and m != 2 and m != 3:
+    m, val = deref_operand(assign_target, block.variables, all_blocks.registers)
+    if m != 0 and m != 2 and m != 3 and not (m == 4 and assign_target.kind == "variable"):
         raise CompilationError(f"Invalid address mode for assignment {assign_target}")
     
     return [
         Instruction("STORE", 0, m, val) # Store GR0 to the specified variable.
     ]
 
+def skip_condition(compare, lhs, rhs):
+    """Return LOAD and CMP instructions after which JGR jumps if the condition is false,
+    or None if that needs more than one jump. lhs and rhs are (address mode, data)."""
+    if compare == "!=":
+        # There is no jump on equal.
+        return None
+    # x < y is false when y < x + 1 and when y - 1 < x. One of them is an immediate if x or y is a constant.
+    x, y = (lhs, rhs) if compare == "<" else (rhs, lhs)
+    if x[0] == 1 and x[1] < MAX_IMMEDIATE:
+        return [Instruction("LOAD", 0, *y), Instruction("CMP", 0, 1, x[1] + 1)]
+    if y[0] == 1 and y[1] > 0:
+        return [Instruction("LOAD", 0, 1, y[1] - 1), Instruction("CMP", 0, *x)]
+    return None
+
 def compile_statement(statement, block, all_blocks):
     """Compile a single statment to assembly instructions."""
     instructions = []
     if isinstance(statement, IfStatement):
-        s = statement.text.replace(" ", "")
-        r = re.match(if_rgx, s)
-        if not r:
-            raise CompilationError("Invalid if statement")
-        operand = r.group(3)
+        operand = statement.compare
+        m_1, val_1 = deref_operand(statement.lhs, block.variables, all_blocks.registers)
+        m_2, val_2 = deref_operand(statement.rhs, block.variables, all_blocks.registers)
 
-        adr_op_1, var_name_1, _ = parse_variable(r.group(2), True)
-        adr_op_2, var_name_2, _ = parse_variable(r.group(4), True)
-        m_1, val_1 = deref_variable(adr_op_1, var_name_1, block["variables"])
-        m_2, val_2 = deref_variable(adr_op_2, var_name_2, block["variables"])
+        if all_blocks.options["layout"]:
+            target_type = get_block(statement.target_block, all_blocks).block_type
+            if target_type == "while":
+                # Test at the bottom. Jump over the body to the condition, which jumps back into the body.
+                instructions.append(JmpOverPlaceholder("JMP", statement.target_block))
+            elif target_type == "if":
+                skip = skip_condition(operand, (m_1, val_1), (m_2, val_2))
+                if skip is not None:
+                    # The body follows the condition and is jumped over when the condition is false.
+                    return skip + [JmpOverPlaceholder("JGR", statement.target_block)]
 
         if operand == "!=":
             instructions.append(Instruction("LOAD", 0, m_1, val_1))
@@ -142,91 +298,451 @@ def compile_statement(statement, block, all_blocks):
         #     instructions.append(Instruction("CMP", 0, m_2, val_2))
         #     instructions.append(JmpToPlaceholder("JEQ", statement.target_block, 0))
         
-    elif r := re.match(return_rgx, statement.text):
+    elif statement.kind == "return":
         # Compile function return statement.
-        if r.group(2):
-            adr_op, var_name, _ = parse_variable(r.group(2), True)
-            m, val = deref_variable(adr_op, var_name, block["variables"])
+        for _, operand in statement.terms:
+            m, val = deref_operand(operand, block.variables, all_blocks.registers)
             instructions.append(Instruction("LOAD", 1, m, val)) # Store return value in GR1
+        instructions += profile_exits(block, all_blocks)
         instructions.append(Instruction("RET"))
-    elif r := re.match(halt_rgx, statement.text):
+    elif statement.kind == "halt":
+        instructions += profile_exits(block, all_blocks)
         instructions.append(Instruction("HALT"))
+    elif intrinsic_call(statement, block) == "memcpy":
+        instructions += compile_memcpy(statement.terms[0][1].params, block, all_blocks)
     else: 
         # Compile assignment and expression statement.
-        # TODO: add regex match.
-        s = statement.text.replace(" ", "") # Trim spaces.
-        lhs, eq, rhs = s.partition("=")
-        if not eq:
-            rhs = lhs
-            lhs = None
-        instructions += compile_expression(rhs, block, all_blocks)
-        if lhs:
-            instructions += compile_assignment(lhs, block)
+        instructions += compile_expression(statement.terms, block, all_blocks)
+        if statement.target:
+            instructions += compile_assignment(statement.target, block, all_blocks)
     
     return instructions
 
+def profile_exits(block, all_blocks):
+    """Instructions adding the cycles of the instrumented loops and function a block returns from."""
+    instructions = []
+    for b in active_blocks(block, all_blocks, all_blocks.profile_counters):
+        instructions += profile_exit(counter_address(b, all_blocks.profile_counters))
+    return instructions
+
 def compile_block(block, all_blocks):
     """Compile a code block to a list of assembly instructions."""
     instructions = []
     comments = {}
+    counters = all_blocks.profile_counters
+
+    if block.block_type == "function" and block.block_id in counters:
+        comments[0] = "profile entry"
+        instructions += profile_entry(counter_address(block, counters))
 
-    for statement in block["code"]:
+    for statement in block.code:
         comments[len(instructions)] = statement.text
+        # Instrumented loops are timed from before their condition until they exit.
+        loop = isinstance(statement, IfStatement) and statement.target_block in counters
         try:
+            if loop:
+                adr = counter_address(all_blocks.get(statement.target_block), counters)
+                instructions += profile_entry(adr)
             instructions += compile_statement(statement, block, all_blocks)
+            if loop:
+                instructions += profile_exit(adr)
         except Exception as e:
             print(f"Compilation failed at line {statement.row} \"{statement.text}\"\n{e}")
             exit()
 
     # Add extra instructions for specific code block types
-    if block["block_type"] == "function":
+    if block.block_type == "function":
         # Always return at the end of functions.
         comments[len(instructions)] = "implicit return"
+        instructions += profile_exits(block, all_blocks)
         instructions.append(Instruction("RET"))
-    elif block["block_type"] == "if" or block["block_type"] == "while":
+    elif block.block_type == "if" or block.block_type == "while":
         # Jump back to previous function.
         comments[len(instructions)] = "jump back"
         instructions.append(JmpBackPlaceholder())
 
     return instructions, comments
 
+def layout_blocks(code_blocks, compiled, stats=None):
+    """Place the compiled blocks in memory. Return the program instructions and comments.
+    Blocks jumped over by a JmpOverPlaceholder are placed right after it without their jump back,
+    so they fall through to the code after them. The other blocks follow each other in program order.
+    The number of inline if and while blocks is added to stats."""
+    inline = {inst.block_id for block in code_blocks for inst in compiled[block.block_id][0]
+        if isinstance(inst, JmpOverPlaceholder)}
+    if stats is not None:
+        for block_id in inline:
+            key = "ifs" if code_blocks.get(block_id).block_type == "if" else "loops"
+            stats[key] = stats.get(key, 0) + 1
+    program_instructions = []
+    p_comments = {}
+
+    def place(block):
+        block_instructions, comments = compiled[block.block_id]
+        if block.block_id in inline:
+            block_instructions = block_instructions[:-1]
+        block.start_address = len(program_instructions)
+        for idx, inst in enumerate(block_instructions):
+            # Merge in comments
+            if idx in comments:
+                comment = comments[idx]
+                if idx == 0:
+                    comment += f" | {block.block_type} {block.name}"
+                p_comments[len(program_instructions)] = comment
+            program_instructions.append(inst)
+            if isinstance(inst, JmpOverPlaceholder):
+                place(code_blocks.get(inst.block_id))
+        block.end_address = len(program_instructions) - 1
+
+    for block in code_blocks:
+        if block.block_id not in inline:
+            place(block)
+    return program_instructions, p_comments
+
 def insert_jumps(instructions, blocks):
     for idx, inst in enumerate(instructions):
         if isinstance(inst, JmpToPlaceholder):
             target_block = get_block(inst.block_id, blocks)
-            target_addr = target_block["start_address"] + inst.offset
+            target_addr = target_block.start_address + inst.offset
 
-            # Find matching jump back instruction for if and while.
-            if target_block["block_type"] == "if":
-                instructions[target_block["end_address"]] = Instruction("JMP", 0, 1, idx + 1)
-            elif target_block["block_type"] == "while":
-                instructions[target_block["end_address"]] = Instruction("JMP", 0, 1, idx - 2)
+            # Find matching jump back instruction for if and while. Blocks laid out inline have none.
+            if isinstance(instructions[target_block.end_address], JmpBackPlaceholder):
+                if target_block.block_type == "if":
+                    instructions[target_block.end_address] = Instruction("JMP", 0, 1, idx + 1)
+                elif target_block.block_type == "while":
+                    instructions[target_block.end_address] = Instruction("JMP", 0, 1, idx - 2)
             instructions[idx] = Instruction(inst.op, 0, 1, target_addr)
+        elif isinstance(inst, JmpRelPlaceholder):
+            instructions[idx] = Instruction(inst.op, 0, 1, idx + inst.offset)
+        elif isinstance(inst, JmpOverPlaceholder):
+            target_block = get_block(inst.block_id, blocks)
+            instructions[idx] = Instruction(inst.op, 0, 1, target_block.end_address + 1)
 
-def compile_alang(code_blocks):
-    program_instructions = []
-    p_comments = {}
+def compile_unit(unit, all_blocks):
+    """Compile the blocks of a function and run value numbering and the peephole optimizer on them.
+    Return {block id: (instructions, comments)}."""
+    compiled = {}
+    peephole_stats = all_blocks.stats.setdefault("peephole", {})
+    for block in unit:
+        instructions, comments = compile_block(block, all_blocks)
+        if "value_numbering" in all_blocks.options["peephole"]:
+            instructions, comments = number_values(instructions, comments, all_blocks, peephole_stats)
+        compiled[block.block_id] = peephole(
+            instructions, comments, all_blocks, all_blocks.options["peephole"], peephole_stats)
+    return compiled
+
+def callee_signature(fn_name, block, all_blocks):
+    """What the code of a call depends on in the called function: its parameters and inlined body."""
+    fn_id = block.functions.resolve(fn_name)
+    if fn_id is None:
+        # Intrinsics depend on the hidden variables they use.
+        return block.variables.resolve(MEMCPY_POINTER)
+    target_block = all_blocks.get(fn_id)
+    params = []
+    for p in target_block.parameters:
+        adr = target_block.variables.resolve(p)
+        params.append([adr, all_blocks.registers.get(adr)])
+    try:
+        body = inline_body(target_block, all_blocks)
+    except CompilationError:
+        # Reported when the function itself is compiled.
+        body = None
+    return [params, None if body is None else [repr(i) for i in body]]
+
+def unit_fingerprint(unit, all_blocks):
+    """Return everything the compiled code of a function and its if/while blocks depends on."""
+    options = all_blocks.options
+    local = {b.block_id: idx for idx, b in enumerate(unit)}
+    fingerprint = [[list(options["peephole"]), options["fold"], options["inline_threshold"], options["call_liveness"],
+        options["unroll"], options["layout"]]]
+    for b in unit:
+        symbols = {}
+        calls = {}
+        statements = []
+        for statement in b.code:
+            target = local.get(statement.target_block) if isinstance(statement, IfStatement) else None
+            statements.append([statement.kind, statement.text, target])
+            operands, fn_names = all_operands(statement)
+            for operand, _ in operands:
+                if operand.kind == "variable" and operand.value not in symbols:
+                    adr = b.variables.resolve(operand.value)
+                    symbols[operand.value] = [adr, all_blocks.registers.get(adr)]
+            for name in fn_names:
+                if name not in calls:
+                    calls[name] = callee_signature(name, b, all_blocks)
+        counter = counter_address(b, all_blocks.profile_counters) if b.block_id in all_blocks.profile_counters else None
+        fingerprint.append([b.block_type, local.get(b.parent_block), statements, symbols, calls, counter])
+    return fingerprint
+
+def compile_isolated(unit, all_blocks):
+    """Compile a function with counters of its own, so they can be cached and merged in a fixed order.
+    Return the compiled blocks and the counters."""
+    stats = all_blocks.stats
+    all_blocks.stats = {}
+    profiler = all_blocks.options["profiler"]
+    try:
+        if profiler is None:
+            compiled = compile_unit(unit, all_blocks)
+        else:
+            with profiler.function(unit) as record:
+                compiled = compile_unit(unit, all_blocks)
+            record["instructions"] = sum(len(instructions) for instructions, _ in compiled.values())
+        return compiled, all_blocks.stats
+    finally:
+        all_blocks.stats = stats
+
+# Blocks of the program being compiled, set in each worker process.
+worker_blocks = None
+
+def init_worker(all_blocks):
+    global worker_blocks
+    worker_blocks = all_blocks
+
+def compile_worker(block_ids):
+    """Compile a function in a worker process. Return it as a relocatable object, or None on errors."""
+    unit = [worker_blocks.get(block_id) for block_id in block_ids]
+    try:
+        compiled, stats = compile_isolated(unit, worker_blocks)
+    except SystemExit:
+        # The error has been printed by the worker.
+        return None
+    obj = make_object(unit, compiled, stats, worker_blocks)
+    if worker_blocks.options["profiler"] is not None:
+        # The profile of the function is recorded in the worker's copy of the profiler.
+        obj["profile"] = worker_blocks.options["profiler"].functions.pop()
+    return obj
+
+def compile_units(units, all_blocks, jobs=1):
+    """Compile functions, in parallel worker processes if jobs > 1.
+    Return (compiled blocks, counters) for each function in order."""
+    if jobs <= 1 or len(units) < 2:
+        return [compile_isolated(unit, all_blocks) for unit in units]
+    # Forked workers inherit the blocks. Only the block ids and the compiled objects are sent between processes.
+    with multiprocessing.Pool(jobs, initializer=init_worker, initargs=(all_blocks,)) as pool:
+        chunksize = max(1, len(units) // (jobs * 8))
+        objects = pool.map(compile_worker, [[b.block_id for b in unit] for unit in units], chunksize)
+    if any(obj is None for obj in objects):
+        exit()
+    if all_blocks.options["profiler"] is not None:
+        all_blocks.options["profiler"].functions += [obj["profile"] for obj in objects]
+    return [(relocate(obj, unit), obj["stats"]) for unit, obj in zip(units, objects)]
+
+def removed_size(removed_blocks, removed_statements, all_blocks, code_blocks):
+    """Return the number of instructions removed blocks and conditions would have compiled to.
+    all_blocks holds every parsed block, code_blocks the ones being compiled."""
+    full = BlockTable(all_blocks)
+    full.registers = code_blocks.registers
+    full.options = code_blocks.options
+    full.inline_bodies = code_blocks.inline_bodies
+    size = 0
+    for block in removed_blocks:
+        size += len(compile_unit([block], full)[block.block_id][0])
+    for block, statement in removed_statements:
+        size += len(compile_statement(statement, block, full))
+    return size
+
+class CompiledProgram():
+    """Linked instructions of a program. The assembly listing and machine words are produced on request.
+    symbols is the symbol map of the profile counters of an instrumented program, otherwise None.
+    costs is the cost report if the cost option is set, otherwise None.
+    entry is the address the program starts at, that of main if it has one."""
+    __slots__ = ("instructions", "comments", "symbols", "costs", "entry", "text", "machine_words")
+
+    def __init__(self, instructions, comments, symbols=None, costs=None, entry=0):
+        self.instructions = instructions
+        self.comments = comments
+        self.symbols = symbols
+        self.costs = costs
+        self.entry = entry
+        self.text = None
+        self.machine_words = None
+
+    def listing(self):
+        """Assembly listing with comments."""
+        if self.text is None:
+            self.text = instructions_to_string(self.instructions, self.comments)
+        return self.text
+
+    def words(self):
+        """Machine words, encoded directly from the instructions."""
+        if self.machine_words is None:
+            self.machine_words = assemble_instructions(self.instructions)
+        return self.machine_words
+
+def compile_alang(code_blocks, options=None, stats=None):
+    """Compile the parsed code blocks to an assembly listing.
+    options overrides DEFAULT_OPTIONS. Optimization counters are added to the stats dict if given."""
+    return compile_program(code_blocks, options, stats).listing()
+
+def compile_program(code_blocks, options=None, stats=None):
+    """Compile the parsed code blocks to a CompiledProgram.
+    options overrides DEFAULT_OPTIONS. Optimization counters are added to the stats dict if given."""
+    options = {**DEFAULT_OPTIONS, **(options or {})}
+    if stats is None:
+        stats = {}
+    # The passes declare and move variables and set the addresses of the blocks. Work on copies.
+    code_blocks = copy_blocks(code_blocks)
+    # Before dead code elimination, removed_size compiles the removed blocks too.
+    declare_intrinsic_variables(code_blocks)
+    code_blocks.options = options
+    code_blocks.stats = stats
+    code_blocks.inline_bodies = {}
+    profiler = options["profiler"]
+    removed_blocks, removed_statements = [], []
+    if options["dead_code"]:
+        all_blocks = code_blocks
+        with phase(profiler, "dead_code"):
+            code_blocks, removed_blocks, removed_statements = eliminate_dead_code(
+                code_blocks, stats.setdefault("dead_code", {}))
+        code_blocks.options = options
+        code_blocks.stats = stats
+    if options["fold"]:
+        with phase(profiler, "fold"):
+            code_blocks = fold_constants(code_blocks, stats.setdefault("folding", {}))
+    trips = {}
+    hints = options["cost_hints"] or {}
+    hot_loops = {name: options["unroll"] * HINT_FACTOR for name in hints.get("unroll", ())}
+    with phase(profiler, "unroll"):
+        code_blocks = unroll_loops(code_blocks, options["unroll"], stats.setdefault("unroll", {}),
+            trips if options["cost"] else None, hot_loops)
+    code_blocks.options = options
+    code_blocks.stats = stats
+    counters = {}
+    if options["instrument"]:
+        counters = declare_profile_counters(code_blocks, options["instrument"])
+        code_blocks.profile_counters = counters
+    code_blocks.registers = {}
+    if options["registers"]:
+        with phase(profiler, "regalloc"):
+            code_blocks.registers = allocate_registers(
+                code_blocks, options["registers"], stats.setdefault("registers", {}))
+    if options["overlay"]:
+        with phase(profiler, "overlay"):
+            code_blocks.registers = overlay_variables(
+                code_blocks, code_blocks.registers, stats.setdefault("overlay", {}))
+
+    # Compile each function together with its if/while blocks.
+    units = {}
+    functions = function_map(code_blocks)
     for block in code_blocks:
-        block_instructions, comments = compile_block(block, code_blocks)
+        fn = functions[block.block_id]
+        units.setdefault(fn.block_id if fn else block.block_id, []).append(block)
+    units = list(units.values())
+    peephole_stats = stats.setdefault("peephole", {})
 
-        # Add instructions to the program.
-        start_adr = len(program_instructions)
-        block["start_address"] = start_adr
-        block["end_address"] = start_adr + len(block_instructions) - 1
-        program_instructions += block_instructions
+    # Reuse cached functions if nothing they depend on has changed.
+    cache = options["cache"]
+    results = [None] * len(units)
+    keys = {}
+    if cache is not None:
+        cache_stats = stats.setdefault("cache", {"hits": 0, "misses": 0})
+        with phase(profiler, "cache_load"):
+            for idx, unit in enumerate(units):
+                if unit[0].block_type != "function":
+                    continue
+                keys[idx] = cache.key(unit_fingerprint(unit, code_blocks))
+                obj = cache.load(keys[idx])
+                if obj is not None:
+                    results[idx] = (relocate(obj, unit), obj["stats"])
+                    cache_stats["hits"] += 1
+    missing = [idx for idx, r in enumerate(results) if r is None]
+    with phase(profiler, "functions"):
+        compiled_units = compile_units([units[idx] for idx in missing], code_blocks, options["jobs"])
+    for idx, result in zip(missing, compiled_units):
+        results[idx] = result
+    if cache is not None:
+        with phase(profiler, "cache_store"):
+            for idx in missing:
+                if idx in keys:
+                    cache_stats["misses"] += 1
+                    cache.store(keys[idx], make_object(units[idx], results[idx][0], results[idx][1], code_blocks))
+            cache_stats["evicted"] = cache.evict()
 
-        # Merge in comments
-        if 0 in comments:
-            comments[0] += f" | {block['block_type']} {block['name']}"
-        for idx, comment in comments.items():
-            p_comments[start_adr+idx] = comment
+    # Counters are merged in program order so the statistics don't depend on the cache or the jobs.
+    compiled = {}
+    for unit_compiled, unit_stats in results:
+        compiled.update(unit_compiled)
+        merge_stats(stats, unit_stats)
+
+    if options["dead_code"]:
+        with phase(profiler, "dead_functions"):
+            dead_stats = stats["dead_code"]
+            removed = removed_size(removed_blocks, removed_statements, all_blocks, code_blocks)
+            # Functions whose every call was inlined are no longer called.
+            graph = {}
+            for unit in units:
+                if unit[0].block_type == "function":
+                    graph[unit[0].block_id] = {inst.block_id for b in unit for inst in compiled[b.block_id][0]
+                        if isinstance(inst, JmpToPlaceholder) and inst.op == "CALL"}
+            reached = reachable_functions(graph, entry_functions(code_blocks))
+            dropped = set()
+            for unit in units:
+                if unit[0].block_type == "function" and unit[0].block_id not in reached:
+                    dead_stats["functions"] = dead_stats.get("functions", 0) + 1
+                    removed += sum(len(compiled[b.block_id][0]) for b in unit)
+                    dropped.update(b.block_id for b in unit)
+            code_blocks = BlockTable(b for b in code_blocks if b.block_id not in dropped)
+            dead_stats["instructions"] = removed
+            dead_stats["bytes"] = removed * WORD_BYTES
+
+    with phase(profiler, "layout"):
+        program_instructions, p_comments = layout_blocks(code_blocks, compiled, stats.setdefault("layout", {}))
 
     # print(instructions_to_string(program_instructions, p_comments))
-    insert_jumps(program_instructions, code_blocks)
+    with phase(profiler, "insert_jumps"):
+        insert_jumps(program_instructions, code_blocks)
+    if "jump_thread" in options["peephole"]:
+        with phase(profiler, "jump_thread"):
+            thread_jumps(program_instructions, peephole_stats)
     # print(instructions_to_string(program_instructions, p_comments))
 
-    # return program_instructions, p_comments
-    return instructions_to_string(program_instructions, p_comments)
+    symbols = symbol_map(code_blocks, counters) if counters else None
+    if symbols:
+        stats["instrument"] = {"entries": len(symbols["entries"]), "base": symbols["base"]}
+    costs = None
+    if options["cost"]:
+        with phase(profiler, "cost"):
+            costs = estimate_costs(program_instructions, code_blocks, trips, options["cycle_table"], options["loop_bound"])
+            annotate_costs(p_comments, costs)
+    main = code_blocks.get(code_blocks[0].functions.resolve("main")) if len(code_blocks) else None
+    entry = main.start_address if main is not None else 0
+    return CompiledProgram(program_instructions, p_comments, symbols, costs, entry)
+
+def format_compile_stats(stats):
+    """Format the optimization counters of a build, one line per optimization."""
+    lines = []
+    if stats.get("registers"):
+        lines.append(f"Registers: {stats['registers']['variables']} variables in {stats['registers']['registers']} registers")
+    if stats.get("folding"):
+        folded = ", ".join(f"{k} {v}" for k, v in stats["folding"].items())
+        lines.append(f"Constant folding: {folded}")
+    if stats.get("unroll"):
+        lines.append(f"Unrolled {stats['unroll'].get('loops', 0)} loops, fully unrolled {stats['unroll'].get('full', 0)}")
+    if stats.get("layout"):
+        lines.append(f"Layout: {stats['layout'].get('ifs', 0)} if bodies and {stats['layout'].get('loops', 0)} loops inline")
+    if stats.get("inline"):
+        lines.append(f"Inlined {stats['inline']['calls']} calls")
+    if stats.get("dead_code", {}).get("instructions"):
+        dead = stats["dead_code"]
+        lines.append(f"Dead code: removed {dead.get('functions', 0)} functions and {dead.get('blocks', 0)} blocks, "
+            f"{dead['instructions']} instructions ({dead['bytes']} bytes)")
+    if stats.get("overlay"):
+        overlay = stats["overlay"]
+        if "skipped" in overlay:
+            lines.append(f"Memory overlay skipped: {overlay['skipped']}")
+        lines.append(f"Data memory: {overlay['before']} rows before overlay, {overlay['after']} after")
+    if stats.get("call_stash"):
+        lines.append(f"Removed {stats['call_stash']['eliminated']} stack operations around calls")
+    if stats.get("cache"):
+        cache_stats = stats["cache"]
+        lines.append(f"Cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['evicted']} evicted")
+    if stats.get("instrument"):
+        instrument = stats["instrument"]
+        lines.append(f"Instrumented {instrument['entries']} functions and loops, counters at {instrument['base']}")
+    if stats.get("peephole"):
+        removed = ", ".join(f"{k} {v}" for k, v in stats["peephole"].items())
+        lines.append(f"Peephole: {removed}")
+    return "\n".join(lines)
 
 if __name__ == "__main__":
     code_blocks = parse_file("test1.alang")
@@ -0,0 +1,43 @@
+import re
+
+# https://regex-vis.com/
+token_rgx = re.compile(
+    r"(?P<newline>\n)"
+    r"|(?P<space>[ \r\t]+)"
+    r"|(?P<comment>//[^\n]*)"
+    r"|(?P<name>\w+)"
+    r"|(?P<op>!=|[(){}\[\];,=+\-*&<>])"
+    r"|(?P<error>.)"
+)
+
+class Token():
+    """A single lexical token with its position in the source text."""
+    __slots__ = ("kind", "text", "pos", "line", "col")
+
+    def __init__(self, kind, text, pos, line, col):
+        self.kind = kind
+        self.text = text
+        self.pos = pos
+        self.line = line
+        self.col = col
+
+    def __repr__(self):
+        return f"{self.kind}:{self.text!r}@{self.line}:{self.col}"
+
+def tokenize(text):
+    """Split the source text into a list of tokens in a single pass.
+    Whitespace and comments are dropped. Characters that can't start a token are kept as error tokens."""
+    tokens = []
+    line = 1
+    line_start = 0
+    for r in token_rgx.finditer(text):
+        kind = r.lastgroup
+        if kind == "newline":
+            line += 1
+            line_start = r.end()
+        elif kind != "space" and kind != "comment":
+            pos = r.start()
+            tokens.append(Token(kind, r.group(), pos, line, pos - line_start + 1))
+    # Sentinel token. Simplifies lookahead at the end of the text.
+    tokens.append(Token("eof", "", len(text), line, len(text) - line_start + 1))
+    return tokens
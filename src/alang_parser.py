@@ -1,183 +1,450 @@
 
-import re
 import json
+from alang_lexer import tokenize
+from profiler import phase
 
 class ParseError(Exception): pass
 class CompilationError(Exception): pass
 
+slot_names = {}
+
+def to_serializable(obj):
+    """Return a json serializable dict of a slotted object. Unset attributes are skipped."""
+    if isinstance(obj, BlockTable):
+        return obj.blocks
+    if isinstance(obj, SymbolTable):
+        return obj.symbols
+    cls = type(obj)
+    if cls not in slot_names:
+        slot_names[cls] = [n for c in reversed(cls.__mro__) for n in getattr(c, "__slots__", ())]
+    return {n: getattr(obj, n) for n in slot_names[cls] if hasattr(obj, n)}
+
+class CodeBlock():
+    """A function, if or while block of code."""
+    __slots__ = (
+        "block_type", "block_id", "name", "parent_block", "parameters", "attributes", "variables", "arrays", "functions", 
+        "code", "code_blocks", "start_address", "end_address")
+
+    def __init__(self, block_type, block_id, parent_block, variables, functions, code, code_blocks):
+        self.block_type = block_type
+        self.block_id = block_id
+        self.name = ""
+        self.parent_block = parent_block
+        self.parameters = []
+        self.attributes = []
+        self.variables = variables
+        # Array variable name -> number of memory rows. Other variables use one row.
+        self.arrays = {}
+        self.functions = functions
+        self.code = code
+        self.code_blocks = code_blocks
+        self.start_address = None
+        self.end_address = None
+
+def copy_block(block, **changes):
+    """Return a copy of a code block sharing its symbol tables and code, with the given attributes replaced."""
+    copy = CodeBlock.__new__(CodeBlock)
+    for name in CodeBlock.__slots__:
+        if hasattr(block, name):
+            setattr(copy, name, getattr(block, name))
+    for name, value in changes.items():
+        setattr(copy, name, value)
+    return copy
+
+def copy_blocks(blocks):
+    """Return a BlockTable of copies of code blocks with their own variable tables and arrays,
+    so variables can be declared and moved without changing the given blocks. Parents must come
+    before their children, as they do in parsed blocks."""
+    tables = {}
+    copies = []
+    for b in blocks:
+        parent = b.variables.parent
+        variables = SymbolTable(dict(b.variables.symbols), tables.get(id(parent), parent))
+        tables[id(b.variables)] = variables
+        copies.append(copy_block(b, variables=variables, arrays=dict(b.arrays)))
+    return BlockTable(copies)
+
+class SymbolTable():
+    """Symbols declared in a block, linked to the table of the enclosing block.
+    Names missing locally are resolved through the parent chain. Resolved names are cached."""
+    __slots__ = ("symbols", "parent", "cache")
+
+    def __init__(self, symbols=None, parent=None):
+        self.symbols = symbols if symbols is not None else {}
+        self.parent = parent
+        self.cache = {}
+
+    def resolve(self, name):
+        """Return the value of name or None if it isn't declared in this or any enclosing block."""
+        if name in self.symbols:
+            return self.symbols[name]
+        if name in self.cache:
+            return self.cache[name]
+        value = self.parent.resolve(name) if self.parent else None
+        if value is not None:
+            self.cache[name] = value
+        return value
+
+    def clear_cache(self):
+        self.cache = {}
+
+    def __contains__(self, name):
+        return self.resolve(name) is not None
+
+    def __getitem__(self, name):
+        value = self.resolve(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        self.symbols[name] = value
+
+    def items(self):
+        return self.symbols.items()
+
+class BlockTable():
+    """Flat list of code blocks in program order with constant time lookup by block id."""
+    __slots__ = ("blocks", "index", "registers", "options", "stats", "inline_bodies", "profile_counters")
+
+    def __init__(self, blocks):
+        self.blocks = list(blocks)
+        self.index = {b.block_id: b for b in self.blocks}
+        # Variable address -> register index of variables kept in registers.
+        self.registers = {}
+        # Compiler options, statistics and function block id -> inlined body. Set by compile_alang.
+        self.options = {}
+        self.stats = {}
+        self.inline_bodies = {}
+        # Block id -> counter index of instrumented functions and loops. See instrument.py.
+        self.profile_counters = {}
+
+    def get(self, block_id):
+        return self.index.get(block_id)
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, idx):
+        return self.blocks[idx]
+
+class Operand():
+    """A single value in a statement. kind is variable, constant, time or call.
+    value holds the variable name, the constant value or the called function name."""
+    __slots__ = ("kind", "value", "adr_op", "params")
+
+    def __init__(self, kind, value=None, adr_op=None, params=None):
+        self.kind = kind
+        self.value = value
+        self.adr_op = adr_op
+        self.params = params
+    def __repr__(self):
+        if self.kind == "call":
+            return f"{self.value}({','.join(map(repr, self.params))})"
+        if self.kind == "time":
+            return "time"
+        return f"{self.adr_op or ''}{self.value}"
+
 class Statement():
-    def __init__(self, text, row):
+    """A statement and its operand/operator IR.
+    kind is expression, return or halt. terms is a list of (operator, Operand) evaluated left to right,
+    the first operator is None. target is the assigned Operand of an expression statement."""
+    __slots__ = ("text", "row", "kind", "target", "terms")
+
+    def __init__(self, text, row, kind="expression", target=None, terms=None):
         self.text = text
         self.row = row
+        self.kind = kind
+        self.target = target
+        self.terms = terms if terms is not None else []
 
 class IfStatement(Statement):
-    def __init__(self, text, row, target_block):
-        super().__init__(text, row)
+    __slots__ = ("target_block", "lhs", "compare", "rhs")
+
+    def __init__(self, text, row, kind, target_block, lhs, compare, rhs):
+        super().__init__(text, row, kind)
         # self.text = text
         self.target_block = target_block
+        self.lhs = lhs
+        self.compare = compare
+        self.rhs = rhs
     def __repr__(self):
         return f"{self.text} => {self.target_block}"
 
 
-# https://regex-vis.com/
-text_start_rgx = r"[^ \n\r\t]"
-line_comment_rgx = r"//[^\n]*"
-fn_def_rgx = r"function (\w+)\(((\w+,)*\w+)?\)[ \n\r]*\{"
-if_def_rgx = r"((if|while) *\(([*&]?\w+)([<>]|!=)([*&]?\w+)\))[ \n\r]*\{"
-variable_declaration_rgx = r"int (\w+)(\[(\w+)\])?;"
-statement_rgx = r"([\w \(\),\+\-\*=&]+);"
+statement_ops = {"(", ")", ",", "+", "-", "*", "=", "&"}
+compare_ops = {"<", ">", "!="}
+expression_ops = {"+", "-", "*"}
+# noinline: never inline calls to the function.
+function_attributes = {"noinline"}
+
+def syntax_error(token):
+    return ParseError(f"Parse failed. Invalid syntax starting at line {token.line}")
 
-def get_row_number(text, index):
-    """Return the row number of the specified text index."""
-    n = 1
-    for character in text[0:index]:
-        if character == "\n": 
-            n += 1
-    return n
+def match_tokens(tokens, i, pattern):
+    """Match a sequence of tokens against a pattern of token texts.
+    None in the pattern matches any name token. Return True on a full match."""
+    for offset, expected in enumerate(pattern):
+        t = tokens[i + offset]
+        if t.kind == "eof":
+            return False
+        if expected is None:
+            if t.kind != "name":
+                return False
+        elif t.text != expected:
+            return False
+    return True
 
-def parse_code_block(text, start_index, block_type, block_count, variable_count, parent_id, parameters = []):
+def parse_operand(tokens, i):
+    """Parse a [*&]?name operand. Return the Operand and the index after it or None if it doesn't match."""
+    adr_op = None
+    if tokens[i].text in ("*", "&"):
+        adr_op = tokens[i].text
+        i += 1
+    t = tokens[i]
+    if t.kind != "name":
+        return None
+    if t.text == "time" and not adr_op:
+        return Operand("time"), i + 1
+    try:
+        return Operand("constant", int(t.text, 0), adr_op), i + 1
+    except ValueError:
+        return Operand("variable", t.text, adr_op), i + 1
+
+def parse_term(tokens, i):
+    """Parse an expression term, either a function call or an operand."""
+    if not match_tokens(tokens, i, [None, "("]):
+        return parse_operand(tokens, i)
+    name = tokens[i].text
+    params = []
+    i += 2
+    if tokens[i].text != ")":
+        while True:
+            r = parse_operand(tokens, i)
+            if r is None:
+                return None
+            param, i = r
+            params.append(param)
+            if tokens[i].text != ",":
+                break
+            i += 1
+    if tokens[i].text != ")":
+        return None
+    return Operand("call", name, params=params), i + 1
+
+def parse_expression(tokens, i, end):
+    """Parse 'x+y-z...' up to the token index end into a list of (operator, Operand) terms."""
+    terms = []
+    op = None
+    while True:
+        r = parse_term(tokens, i)
+        if r is None:
+            raise syntax_error(tokens[i])
+        operand, i = r
+        terms.append((op, operand))
+        if i == end:
+            return terms
+        if tokens[i].text not in expression_ops:
+            raise syntax_error(tokens[i])
+        op = tokens[i].text
+        i += 1
+
+def parse_statement(text, tokens, i, end):
+    """Parse the statement tokens from i up to the ; at index end."""
+    t = tokens[i]
+    s = text[t.pos:tokens[end].pos]
+    if t.text == "halt" and end == i + 1:
+        return Statement(s, t.line, "halt")
+    if t.text == "return":
+        terms = []
+        if end != i + 1:
+            r = parse_operand(tokens, i + 1)
+            if r is None or r[1] != end:
+                raise syntax_error(t)
+            terms.append((None, r[0]))
+        return Statement(s, t.line, "return", terms=terms)
+
+    # Assignment or expression statement.
+    target = None
+    r = parse_operand(tokens, i)
+    if r and tokens[r[1]].text == "=":
+        target, i = r
+        i += 1
+    if i == end:
+        raise syntax_error(t)
+    return Statement(s, t.line, "expression", target, parse_expression(tokens, i, end))
+
+def parse_function_header(tokens, i):
+    """Parse '[attributes] function name(a,b,...) {'. Return name, parameters, attributes and the index of '{'."""
+    attributes = []
+    while tokens[i].text in function_attributes:
+        attributes.append(tokens[i].text)
+        i += 1
+    if not match_tokens(tokens, i, ["function", None, "("]):
+        return None
+    name = tokens[i + 1].text
+    params = []
+    i += 3
+    if tokens[i].kind == "name":
+        params.append(tokens[i].text)
+        i += 1
+        while match_tokens(tokens, i, [",", None]):
+            params.append(tokens[i + 1].text)
+            i += 2
+    if not match_tokens(tokens, i, [")", "{"]):
+        return None
+    return name, params, attributes, i + 1
+
+def parse_if_header(tokens, i):
+    """Parse '(if|while) (x<y) {'. Return the condition and the index of ')' and '{'."""
+    if tokens[i].text not in ("if", "while") or tokens[i + 1].text != "(":
+        return None
+    lhs = parse_operand(tokens, i + 2)
+    if lhs is None or tokens[lhs[1]].text not in compare_ops:
+        return None
+    compare = tokens[lhs[1]].text
+    rhs = parse_operand(tokens, lhs[1] + 1)
+    if rhs is None or not match_tokens(tokens, rhs[1], [")", "{"]):
+        return None
+    return lhs[0], compare, rhs[0], rhs[1], rhs[1] + 1
+
+def parse_code_block(text, tokens, start_index, block_type, block_count, variable_count, parent_id, parameters = []):
     """Parse a function block of code. Exit on }."""
     statements = []
     code_blocks = {}
     functions = {}
     variables = {}
+    arrays = {}
     block_id = block_count
 
     # Add parameters to local variables
     for p in parameters:
         variables[p] = variable_count
         variable_count += 1
-    
+
     i = start_index
-    while i < len(text):
-        # Seek forwards until next word
-        if re.match(text_start_rgx, text[i]):
-            t = text[i:]
-            if r := re.match(line_comment_rgx, t):
-                # Skip past line comments.
-                _, comment_end = r.span()
-                i = i + comment_end
-
-            elif text[i] == "}":
-                # End of code block.
-                break
+    while tokens[i].kind != "eof":
+        t = tokens[i]
+        if t.text == "}":
+            # End of code block.
+            break
+
+        elif t.kind == "error":
+            raise syntax_error(t)
+
+        elif r := parse_function_header(tokens, i):
+            # Parse function definition and content.
+            name, params, attributes, block_start = r
+
+            # Parse the code block containing the function code.
+            fn_block, i, block_count, variable_count = parse_code_block(
+                text,
+                tokens,
+                block_start + 1,
+                "function",
+                block_count+1,
+                variable_count,
+                block_id,
+                params)
 
-            elif r := re.match(fn_def_rgx, t):
-                # Parse function definition and content.
-                name = r.group(1)
-                params = []
-                if (r.group(2)):
-                    params = r.group(2).split(",")
-                
-                # Parse the code block containing the function code.
-                _, block_start = r.span()
-                fn_block, i, block_count, variable_count = parse_code_block(
-                    text, 
-                    i + block_start + 1,
-                    "function",
-                    block_count+1,
-                    variable_count,
-                    block_id,
-                    params)
-
-                fn_block["name"] = name
-                fn_block["parameters"] = params
-                functions[name] = fn_block["block_id"]
-                code_blocks[fn_block["block_id"]] = fn_block
-
-            elif r := re.match(if_def_rgx, t):
-                # Parse the conditional code block
-                row = get_row_number(text, i)
-                _, block_start = r.span()
-                if_block, i, block_count, variable_count = parse_code_block(
-                    text, 
-                    i + block_start + 1,
-                    r.group(2),
-                    block_count+1,
-                    variable_count,
-                    block_id
-                    )
-                code_blocks[if_block["block_id"]] = if_block
-
-                s = r.group(1)
-                statements.append(IfStatement(s, row, if_block["block_id"]))
-                
-            
-            elif r := re.match(variable_declaration_rgx, t):
-                # Parse variable declaration.
-                _, width = r.span()
-                i += width
-                name = r.group(1)
-                arr_size = 1
-                if r.group(2):
-                    try:
-                        arr_size = int(r.group(3), 0)
-                    except:
-                        raise ParseError(f"Parse failed. Invalid syntax starting at line {l}")
-                variables[name] = variable_count
-                variable_count += arr_size
-            
-            elif r := re.match(statement_rgx, t):
-                statements.append(Statement(r.group(1), get_row_number(text, i)))
-                _, width = r.span()
-                i += width
-                
-            else:
-                l = 1
-                for c in text[0:i]:
-                    if c == "\n": l += 1
-                raise ParseError(f"Parse failed. Invalid syntax starting at line {l}")
+            fn_block.name = name
+            fn_block.parameters = params
+            fn_block.attributes = attributes
+            functions[name] = fn_block.block_id
+            code_blocks[fn_block.block_id] = fn_block
+
+        elif r := parse_if_header(tokens, i):
+            # Parse the conditional code block
+            lhs, compare, rhs, header_end, block_start = r
+            if_block, i, block_count, variable_count = parse_code_block(
+                text,
+                tokens,
+                block_start + 1,
+                t.text,
+                block_count+1,
+                variable_count,
+                block_id
+                )
+            code_blocks[if_block.block_id] = if_block
+
+            s = text[t.pos:tokens[header_end].pos + 1]
+            statements.append(IfStatement(s, t.line, t.text, if_block.block_id, lhs, compare, rhs))
+
+        elif match_tokens(tokens, i, ["int", None, ";"]) or match_tokens(tokens, i, ["int", None, "[", None, "]", ";"]):
+            # Parse variable declaration.
+            name = tokens[i + 1].text
+            arr_size = 1
+            if tokens[i + 2].text == "[":
+                try:
+                    arr_size = int(tokens[i + 3].text, 0)
+                except:
+                    raise syntax_error(t)
+                arrays[name] = arr_size
+                i += 3
+            variables[name] = variable_count
+            variable_count += arr_size
+            i += 2
+
+        else:
+            # Parse statement. Consume tokens until ;
+            end = i
+            while tokens[end].kind == "name" or tokens[end].text in statement_ops:
+                end += 1
+            if end == i or tokens[end].text != ";":
+                raise syntax_error(t)
+            statements.append(parse_statement(text, tokens, i, end))
+            i = end
         i += 1
 
-    return (
-        {
-            "block_type": block_type,
-            "block_id": block_id,
-            "name": "",
-            "parent_block": parent_id,
-            "variables": variables,
-            "functions": functions,
-            "code": statements,
-            "code_blocks": code_blocks,
-        }, 
-        i, block_count, variable_count)
-
-def flatten_code_tree(parent_block):
+    if block_type != "global" and tokens[i].kind == "eof":
+        # The block is never closed. Point at its opening brace.
+        raise syntax_error(tokens[start_index - 1])
+
+    block = CodeBlock(block_type, block_id, parent_id, SymbolTable(variables), SymbolTable(functions), statements, code_blocks)
+    block.arrays = arrays
+    return block, i, block_count, variable_count
+
+def flatten_code_tree(parent_block, blocks=None):
     """Flatten the nestled code blocks into a list."""
-    blocks = []
-    for id, child_block in parent_block["code_blocks"].items():
+    if blocks is None:
+        blocks = []
+    blocks.append(parent_block)
+    for id, child_block in parent_block.code_blocks.items():
         # Child blocks should access the variables and functions of the parent block.
-        # Do not overwrite local variables.
-        for v_name, v_id in parent_block["variables"].items():
-            if v_name not in child_block["variables"]:
-                child_block["variables"][v_name] = v_id
-        for f_name, f_id in parent_block["functions"].items():
-            if f_name not in child_block["functions"]:
-                child_block["functions"][f_name] = f_id
+        # Local symbols shadow the parent ones.
+        child_block.variables.parent = parent_block.variables
+        child_block.functions.parent = parent_block.functions
 
         # Recurse through child blocks.
-        blocks += flatten_code_tree(child_block)
-    del parent_block["code_blocks"] # Delete tree structure.
-    return [parent_block] + blocks
+        flatten_code_tree(child_block, blocks)
+    del parent_block.code_blocks # Delete tree structure.
+    return blocks
 
-def parse_file(path):
+def parse_file(path, profiler=None):
     f = open(path, "r")
     lines = f.readlines()
     text = "".join(lines)
     try:
-        code_tree, _, _, _ = parse_code_block(text, 0, "global", -1, 0, None)
+        with phase(profiler, "tokenize"):
+            tokens = tokenize(text)
+        with phase(profiler, "parse"):
+            code_tree, _, _, _ = parse_code_block(text, tokens, 0, "global", -1, 0, None)
         # print(json.dumps(code_tree, indent=2))
 
-        if len(code_tree["code"]) != 0:
+        if len(code_tree.code) != 0:
             raise ParseError("Parse failed. No code apart from variable and function declarations allowed in the global scope. Put it in the a function.")
-        # if "main" not in code_tree["functions"]:
+        # if "main" not in code_tree.functions:
         #     raise ParseError("Parse failed. No main function defined.")
     except ParseError as e:
         print(e)
         exit()
 
-    code_blocks = flatten_code_tree(code_tree)
-    # print(json.dumps(code_blocks, indent=2, default=lambda x: x.__dict__))
+    with phase(profiler, "flatten"):
+        code_blocks = BlockTable(flatten_code_tree(code_tree))
+    # print(json.dumps(code_blocks, indent=2, default=to_serializable))
     return code_blocks
 
 if __name__ == "__main__":
@@ -0,0 +1,36 @@
+import os, json
+from machine_image import pack_image, words_to_text
+
+# Output files of a build. Used by interface.py and the compile server, so both write the same bytes.
+
+def output_files(program, binary=False, asm=True):
+    """Return {file name: bytes} of the output files of a CompiledProgram."""
+    files = {}
+    if asm:
+        files["compiled.asm"] = program.listing().encode()
+    if binary:
+        files["machine_code.bin"] = pack_image(program.words(), program.entry)
+    else:
+        files["machine_code"] = words_to_text(program.words()).encode()
+    if program.symbols:
+        files["symbols.json"] = json.dumps(program.symbols, indent=2).encode()
+    if program.costs:
+        files["costs.json"] = json.dumps(program.costs, indent=2).encode()
+    return files
+
+def write_outputs(files, directory="output"):
+    """Write the files that differ from the ones in directory. Return the names of the written files."""
+    os.makedirs(directory, exist_ok=True)
+    written = []
+    for name, data in files.items():
+        path = os.path.join(directory, name)
+        try:
+            with open(path, "rb") as f:
+                if f.read() == data:
+                    continue
+        except FileNotFoundError:
+            pass
+        with open(path, "wb") as f:
+            f.write(data)
+        written.append(name)
+    return written
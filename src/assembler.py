@@ -42,6 +42,9 @@ ADDRESS_MODES = {
     "REG" : 4
 }
 
+# Opcode field of each instruction, already shifted into place.
+OPCODE_FIELDS = {name: code << 28 for name, code in INSTRUCTION_MAP.items()}
+
 class AssemblerException(Exception): pass
 
 def assemble(text):
@@ -100,4 +103,29 @@ def asm_to_machinecode(line):
         if data > 0xFFFFF:
             raise AssemblerException("Invalid data value.")
     
-    return f"{instr:05b}{gr:05b}{m:03b}{data:020b}"
\ No newline at end of file
+    return f"{instr:05b}{gr:05b}{m:03b}{data:020b}"
+
+def encode_instruction(op, grx=0, m=0, data=0):
+    """Encode instruction fields to a 33 bit machine word."""
+    try:
+        word = OPCODE_FIELDS[op]
+    except KeyError:
+        raise AssemblerException("Invalid instruction used.")
+    if not 0 <= grx <= 0b11111:
+        raise AssemblerException("Invalid register index value.")
+    if not 0 <= m <= 0b100:
+        raise AssemblerException("Invalid address mode value.")
+    if not 0 <= data <= 0xFFFFF:
+        raise AssemblerException("Invalid data value.")
+    return word | grx << 23 | m << 20 | data
+
+def assemble_instructions(instructions):
+    """Encode Instruction objects straight to machine words, without going through assembly text."""
+    words = []
+    for idx, inst in enumerate(instructions):
+        try:
+            words.append(encode_instruction(inst.op, inst.grx, inst.m, inst.data))
+        except AssemblerException as e:
+            print(f"Assembler failed. {e} On row {idx}, \"{inst}\"")
+            exit()
+    return words
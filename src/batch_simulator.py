@@ -0,0 +1,289 @@
+import sys
+from simulator import (load_program, instruction_cycles, SimulatorError, CYCLE_TABLE, OPERAND_OPS,
+    WORD_MASK, TIME_REGISTER, INDEX_REGISTER)
+from machine_image import load_machine_code
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Usage:
+# python3 batch_simulator.py [machine_code_file] [memories.npy] [output.npz] [max_steps]
+#
+# memories.npy holds one memory image per lane, an array of shape (lanes, memory_size) where
+# memory_size is a power of two. Each row takes 4 bytes, so images covering the whole 20 bit
+# address space like simulator.py take 4 MiB per lane: 4 GiB for 1000 lanes. Programs that
+# only use low addresses can be run on narrower images. Addresses above them wrap around.
+#
+# Runs one program over many initial memory images. Each lane is a full machine state
+# (registers, flags, stack, memory and cycle counter) stored as a row of NumPy arrays.
+# All running lanes step together. Lanes at the same program counter execute the
+# instruction as one vector operation, the others are masked out until their own
+# instruction comes up in the same step. Same machine model as simulator.py.
+
+class BatchSimulator():
+    """Executes a program on many machine states at once."""
+
+    def __init__(self, program, memory, memory_size=1 << 20, cycle_table=None, stack_size=1024, entry=0):
+        """memory is an array of shape (lanes, memory_size), a list of {address: value} dicts
+        or the number of lanes to start with zeroed memory. Like simulator.py, memory covers the
+        whole 20 bit address space by default. That is 4 MiB per lane, so large batches need a
+        smaller power of two memory_size or narrower arrays. Addresses above it wrap around."""
+        if np is None:
+            raise SimulatorError("Batch execution requires NumPy.")
+        self.program = load_program(program)
+        self.cycle_table = cycle_table or CYCLE_TABLE
+        if isinstance(memory, int):
+            self.mem = np.zeros((memory, memory_size), dtype=np.uint32)
+        elif isinstance(memory, np.ndarray):
+            if memory.ndim != 2:
+                raise SimulatorError("Memory images must be an array of shape (lanes, memory_size).")
+            # Converting to 32 bits keeps the low word of every value, no 64 bit copy is needed.
+            self.mem = memory.astype(np.uint32)
+        else:
+            self.mem = np.zeros((len(memory), memory_size), dtype=np.uint32)
+            for lane, image in enumerate(memory):
+                for adr, value in image.items():
+                    if not 0 <= adr < memory_size:
+                        raise SimulatorError(f"Address {adr} of lane {lane} outside of memory of size {memory_size}.")
+                    self.mem[lane, adr] = value & WORD_MASK
+        lanes, self.memory_size = self.mem.shape
+        if self.memory_size & (self.memory_size - 1):
+            raise SimulatorError("Memory size must be a power of two.")
+        self.lanes = lanes
+        # Registers are kept in 64 bits so results can be masked after each operation.
+        self.regs = np.zeros((lanes, 32), dtype=np.uint64)
+        self.zero = np.zeros(lanes, dtype=bool)
+        self.negative = np.zeros(lanes, dtype=bool)
+        self.stack = np.zeros((lanes, stack_size), dtype=np.uint64)
+        self.sp = np.zeros(lanes, dtype=np.int64)
+        self.max_stack_depth = np.zeros(lanes, dtype=np.int64)
+        self.clock = np.zeros(lanes, dtype=np.int64)
+        self.pc = np.full(lanes, entry, dtype=np.int64)
+        self.running = np.ones(lanes, dtype=bool)
+        self.halted = np.zeros(lanes, dtype=bool)
+        self.steps = np.zeros(lanes, dtype=np.int64)
+        self.jumps_taken = np.zeros(lanes, dtype=np.int64)
+        self.costs = np.array([instruction_cycles(op, m, self.cycle_table) for op, grx, m, data in self.program],
+            dtype=np.int64)
+        self.code = [self.decode(idx, *inst) for idx, inst in enumerate(self.program)]
+
+    def reader(self, m, d):
+        """Return a function reading the operand of an address mode for the given lanes."""
+        mem, regs, mask = self.mem, self.regs, self.memory_size - 1
+        if m == 0:
+            return lambda lanes: mem[lanes, d & mask].astype(np.uint64)
+        if m == 1:
+            return lambda lanes: np.full(len(lanes), d, dtype=np.uint64)
+        if m == 2:
+            return lambda lanes: mem[lanes, mem[lanes, d & mask] & mask].astype(np.uint64)
+        if m == 3:
+            return lambda lanes: mem[lanes, (regs[lanes, INDEX_REGISTER] + d) & mask].astype(np.uint64)
+        if m == 4:
+            if d == TIME_REGISTER:
+                return lambda lanes: (self.clock[lanes] & WORD_MASK).astype(np.uint64)
+            r = d & 0b11111
+            return lambda lanes: regs[lanes, r]
+        raise SimulatorError(f"Invalid address mode {m}.")
+
+    def writer(self, m, d):
+        """Return a function writing values to the destination of an address mode for the given lanes."""
+        mem, regs, mask = self.mem, self.regs, self.memory_size - 1
+        if m == 0:
+            def write(lanes, v): mem[lanes, d & mask] = v
+        elif m == 2:
+            def write(lanes, v): mem[lanes, mem[lanes, d & mask] & mask] = v
+        elif m == 3:
+            def write(lanes, v): mem[lanes, (regs[lanes, INDEX_REGISTER] + d) & mask] = v
+        elif m == 4:
+            r = d & 0b11111
+            def write(lanes, v): regs[lanes, r] = v
+        else:
+            raise SimulatorError(f"Invalid address mode {m} for STORE.")
+        return write
+
+    def decode(self, idx, op, g, m, d):
+        """Predecode an instruction to a function that executes it on an array of lanes
+        and sets their next program counter."""
+        if op not in DISPATCH:
+            raise SimulatorError(f"Invalid instruction {op} at {idx}.")
+        read = self.reader(m, d) if op in OPERAND_OPS and op != "STORE" else None
+        return DISPATCH[op](self, idx, g, m, d, read)
+
+    def run(self, max_steps=None):
+        """Step all lanes until every lane has stopped or max_steps. Return the statistics,
+        including the final memory and register arrays."""
+        code, costs, size = self.code, self.costs, len(self.code)
+        step = 0
+        while step != max_steps:
+            lanes = np.flatnonzero(self.running)
+            if not len(lanes):
+                break
+            pcs = self.pc[lanes]
+            outside = (pcs < 0) | (pcs >= size)
+            if outside.any():
+                lane = lanes[outside][0]
+                raise SimulatorError(f"Program counter outside of program in lane {lane}: {self.pc[lane]}")
+            self.clock[lanes] += costs[pcs]
+            self.steps[lanes] += 1
+            first = pcs[0]
+            if (pcs == first).all():
+                code[first](lanes)
+            else:
+                for pc in np.unique(pcs):
+                    code[pc](lanes[pcs == pc])
+            step += 1
+        return self.stats()
+
+    def stop(self, lanes):
+        self.running[lanes] = False
+        self.halted[lanes] = True
+
+    def stats(self):
+        """Return the final memory and registers and per lane instruction counts, cycles and stack depth."""
+        registers = (self.regs & WORD_MASK).astype(np.uint32)
+        return {
+            "memory": self.mem,
+            "registers": registers,
+            "instructions": self.steps,
+            "cycles": self.clock,
+            "halted": self.halted,
+            "max_stack_depth": self.max_stack_depth,
+            "jumps_taken": self.jumps_taken,
+        }
+
+def signed(values):
+    """Interpret 32 bit values as signed."""
+    values = values.astype(np.int64) & WORD_MASK
+    return values - ((values & 0x80000000) << 1)
+
+# Handler factories. Each returns a function executing one decoded instruction on an array of lanes.
+
+def op_nop(sim, idx, g, m, d, read):
+    def nop(lanes):
+        sim.pc[lanes] = idx + 1
+    return nop
+
+def op_halt(sim, idx, g, m, d, read):
+    return sim.stop
+
+def op_load(sim, idx, g, m, d, read):
+    regs, pc = sim.regs, sim.pc
+    def load(lanes):
+        regs[lanes, g] = read(lanes)
+        pc[lanes] = idx + 1
+    return load
+
+def op_store(sim, idx, g, m, d, read):
+    regs, pc, write = sim.regs, sim.pc, sim.writer(m, d)
+    def store(lanes):
+        write(lanes, regs[lanes, g] & WORD_MASK)
+        pc[lanes] = idx + 1
+    return store
+
+def alu(fn):
+    def factory(sim, idx, g, m, d, read):
+        regs, pc = sim.regs, sim.pc
+        def execute(lanes):
+            regs[lanes, g] = fn(regs[lanes, g], read(lanes)) & WORD_MASK
+            pc[lanes] = idx + 1
+        return execute
+    return factory
+
+def op_cmp(sim, idx, g, m, d, read):
+    regs, pc = sim.regs, sim.pc
+    def cmp(lanes):
+        a, b = regs[lanes, g], read(lanes)
+        sim.zero[lanes] = a == b
+        sim.negative[lanes] = signed(a) < signed(b)
+        pc[lanes] = idx + 1
+    return cmp
+
+def jump(condition):
+    def factory(sim, idx, g, m, d, read):
+        pc, extra = sim.pc, sim.cycle_table["jump_taken"]
+        def execute(lanes):
+            taken = condition(sim, lanes)
+            pc[lanes] = np.where(taken, read(lanes).astype(np.int64), idx + 1)
+            sim.clock[lanes] += taken * extra
+            sim.jumps_taken[lanes] += taken
+        return execute
+    return factory
+
+def push_values(sim, lanes, values):
+    sp = sim.sp[lanes]
+    if (sp >= sim.stack.shape[1]).any():
+        raise SimulatorError(f"Stack overflow in lane {lanes[sp >= sim.stack.shape[1]][0]}.")
+    sim.stack[lanes, sp] = values
+    sim.sp[lanes] = sp + 1
+    sim.max_stack_depth[lanes] = np.maximum(sim.max_stack_depth[lanes], sp + 1)
+
+def op_call(sim, idx, g, m, d, read):
+    pc, extra = sim.pc, sim.cycle_table["jump_taken"]
+    def call(lanes):
+        push_values(sim, lanes, idx + 1)
+        pc[lanes] = read(lanes).astype(np.int64)
+        sim.clock[lanes] += extra
+        sim.jumps_taken[lanes] += 1
+    return call
+
+def op_ret(sim, idx, g, m, d, read):
+    def ret(lanes):
+        # Returning from the entry function ends the program.
+        empty = sim.sp[lanes] == 0
+        sim.stop(lanes[empty])
+        lanes = lanes[~empty]
+        sim.sp[lanes] -= 1
+        sim.pc[lanes] = sim.stack[lanes, sim.sp[lanes]].astype(np.int64)
+    return ret
+
+def op_push(sim, idx, g, m, d, read):
+    def push(lanes):
+        push_values(sim, lanes, sim.regs[lanes, g])
+        sim.pc[lanes] = idx + 1
+    return push
+
+def op_pop(sim, idx, g, m, d, read):
+    def pop(lanes):
+        if (sim.sp[lanes] == 0).any():
+            raise SimulatorError(f"POP from empty stack at {idx}.")
+        sim.sp[lanes] -= 1
+        sim.regs[lanes, g] = sim.stack[lanes, sim.sp[lanes]]
+        sim.pc[lanes] = idx + 1
+    return pop
+
+DISPATCH = {
+    "NOP": op_nop,
+    "LOAD": op_load,
+    "STORE": op_store,
+    "JMP": jump(lambda sim, lanes: np.ones(len(lanes), dtype=bool)),
+    "ADD": alu(lambda a, b: a + b),
+    "SUB": alu(lambda a, b: a - b),
+    "MUL": alu(lambda a, b: a * b),
+    "JNE": jump(lambda sim, lanes: ~sim.zero[lanes]),
+    "CMP": op_cmp,
+    "AND": alu(lambda a, b: a & b),
+    "OR": alu(lambda a, b: a | b),
+    "HALT": op_halt,
+    "CALL": op_call,
+    "RET": op_ret,
+    "PUSH": op_push,
+    "POP": op_pop,
+    "LSR": alu(lambda a, b: a >> (b & np.uint64(31))),
+    "LSL": alu(lambda a, b: a << (b & np.uint64(31))),
+    "JGR": jump(lambda sim, lanes: sim.negative[lanes]),
+}
+
+def run_batch(program, memory, max_steps=None, **kwargs):
+    """Run a program over many initial memory images. Return the final memory and register arrays."""
+    result = BatchSimulator(program, memory, **kwargs).run(max_steps)
+    return result["memory"], result["registers"]
+
+if __name__ == "__main__":
+    program = load_machine_code(sys.argv[1])
+    sim = BatchSimulator(program, np.load(sys.argv[2]), entry=getattr(program, "entry", 0))
+    max_steps = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    result = sim.run(max_steps)
+    np.savez(sys.argv[3], **result)
+    print(f"Lanes: {sim.lanes}, halted: {int(result['halted'].sum())}, max instructions: {int(result['instructions'].max())}")
@@ -0,0 +1,164 @@
+import os, time, json, pickle, hashlib, collections
+from compiler_utils import Instruction, JmpToPlaceholder, JmpBackPlaceholder, JmpRelPlaceholder, JmpOverPlaceholder
+
+# Persistent cache of compiled functions.
+#
+# A function and the if/while blocks inside it are cached together as a relocatable object.
+# The object holds the peephole optimized instructions and comments of each block.
+# Jumps to blocks of the same function are stored relative to the function and calls
+# by the name of the called function, so cached code can be placed anywhere.
+#
+# The key is a hash of everything the compiled code depends on. See unit_fingerprint in
+# alang_compiler.py: the statements, the addresses and registers of the variables they use,
+# the parameters and inlined bodies of the functions they call and the compiler options.
+
+CACHE_VERSION = 3
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60 # Seconds
+OBJECT_SUFFIX = ".obj"
+
+def fingerprint_key(fingerprint):
+    text = json.dumps([CACHE_VERSION, fingerprint], separators=(",", ":"))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+class BuildCache():
+    """Directory of cached objects, evicted by total size and age."""
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, fingerprint):
+        return fingerprint_key(fingerprint)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + OBJECT_SUFFIX)
+
+    def load(self, key):
+        """Return the cached object or None. Loading an object marks it as recently used."""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                obj = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, ValueError, AttributeError):
+            # Damaged entry. Recompile and overwrite it.
+            return None
+        os.utime(path)
+        return obj
+
+    def store(self, key, obj):
+        # Write to a temporary file first so readers never see a partial object.
+        path = self.path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def evict(self):
+        """Remove objects older than max_age, then the least recently used ones until the
+        cache fits in max_bytes. Return the number of removed objects."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(OBJECT_SUFFIX):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+class MemoryCache():
+    """Cache of objects in memory with the interface of BuildCache. Used by the compile server.
+    Keeps the max_entries most recently used objects."""
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.objects = collections.OrderedDict()
+
+    def key(self, fingerprint):
+        return fingerprint_key(fingerprint)
+
+    def load(self, key):
+        obj = self.objects.get(key)
+        if obj is not None:
+            self.objects.move_to_end(key)
+        return obj
+
+    def store(self, key, obj):
+        self.objects[key] = obj
+        self.objects.move_to_end(key)
+
+    def evict(self):
+        removed = 0
+        while len(self.objects) > self.max_entries:
+            self.objects.popitem(last=False)
+            removed += 1
+        return removed
+
+def make_object(unit, compiled, stats, blocks):
+    """Return a relocatable object of the compiled blocks of a function.
+    compiled maps block id to (instructions, comments)."""
+    local = {b.block_id: idx for idx, b in enumerate(unit)}
+    object_blocks = []
+    for b in unit:
+        instructions, comments = compiled[b.block_id]
+        code = []
+        for inst in instructions:
+            if isinstance(inst, JmpToPlaceholder):
+                if inst.block_id in local:
+                    code.append(("block", inst.op, local[inst.block_id], inst.offset))
+                else:
+                    code.append(("call", inst.op, blocks.get(inst.block_id).name, inst.offset))
+            elif isinstance(inst, JmpBackPlaceholder):
+                code.append(("back",))
+            elif isinstance(inst, JmpRelPlaceholder):
+                code.append(("rel", inst.op, inst.offset))
+            elif isinstance(inst, JmpOverPlaceholder):
+                code.append(("over", inst.op, local[inst.block_id]))
+            else:
+                code.append((inst.op, inst.grx, inst.m, inst.data))
+        object_blocks.append((code, comments))
+    return {"blocks": object_blocks, "stats": stats}
+
+def relocate(obj, unit):
+    """Return {block id: (instructions, comments)} for the blocks of a function from a cached object."""
+    compiled = {}
+    for b, (code, comments) in zip(unit, obj["blocks"]):
+        instructions = []
+        for inst in code:
+            if inst[0] == "block":
+                instructions.append(JmpToPlaceholder(inst[1], unit[inst[2]].block_id, inst[3]))
+            elif inst[0] == "call":
+                instructions.append(JmpToPlaceholder(inst[1], b.functions[inst[2]], inst[3]))
+            elif inst[0] == "back":
+                instructions.append(JmpBackPlaceholder())
+            elif inst[0] == "rel":
+                instructions.append(JmpRelPlaceholder(inst[1], inst[2]))
+            elif inst[0] == "over":
+                instructions.append(JmpOverPlaceholder(inst[1], unit[inst[2]].block_id))
+            else:
+                instructions.append(Instruction(*inst))
+        compiled[b.block_id] = (instructions, dict(comments))
+    return compiled
+
+def merge_stats(total, delta):
+    """Add nested counters of delta to total."""
+    for k, v in delta.items():
+        if isinstance(v, dict):
+            merge_stats(total.setdefault(k, {}), v)
+        else:
+            total[k] = total.get(k, 0) + v
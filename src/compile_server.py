@@ -0,0 +1,198 @@
+import os, sys, io, json, time, socket, hashlib, contextlib
+from alang_parser import parse_file
+from alang_compiler import compile_program, format_compile_stats
+from artifacts import output_files, write_outputs
+from build_cache import MemoryCache
+
+# Usage:
+# python3 compile_server.py build [alang_file] [address]
+# python3 compile_server.py status [address]
+# python3 compile_server.py stop [address]
+#
+# Long running compile server. Start it with python3 interface.py --serve [address] and the usual
+# compiler flags. It keeps the compiled functions of every program it has built in memory, so a
+# rebuild only compiles the functions whose code or dependencies changed. Requests for unchanged
+# files are answered from memory without touching the output files. With --watch the server also
+# polls the files it has built and rebuilds them when they are saved.
+#
+# The output files are produced by the same code as one-shot builds and are byte-identical to them.
+# Output files with unchanged content are not rewritten.
+#
+# The address is the path of a Unix socket, or a port number to listen on 127.0.0.1.
+# Requests and responses are single lines of JSON:
+#   {"command": "build", "file": path}  ->  {"ok": true, "changed": bool, "written": [files], "output": text, ...}
+#   {"command": "status"}               ->  {"ok": true, "files": [paths], "builds": n}
+#   {"command": "stop"}                 ->  {"ok": true}
+# Failed builds answer {"ok": false, "output": compiler messages}. If the compiler crashed the
+# response also has "error", the exception. The server keeps running either way.
+
+DEFAULT_ADDRESS = ".alang_server.sock"
+POLL_INTERVAL = 0.25 # Seconds between checks of watched files.
+
+def server_socket(address):
+    """Return a listening socket for an address."""
+    if address.isdigit():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("127.0.0.1", int(address)))
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+    sock.listen()
+    return sock
+
+def client_socket(address):
+    if address.isdigit():
+        return socket.create_connection(("127.0.0.1", int(address)))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+def read_line(conn):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def request(command, address=DEFAULT_ADDRESS, **fields):
+    """Send a request to a running server and return its response."""
+    with client_socket(address) as conn:
+        conn.sendall(json.dumps({"command": command, **fields}).encode() + b"\n")
+        return json.loads(read_line(conn))
+
+class CompileServer():
+    """Builds programs on request and keeps their state between builds."""
+
+    def __init__(self, options, binary=False, asm=True, output_dir="output", watch=False):
+        self.options = dict(options)
+        if self.options.get("cache") is None:
+            self.options["cache"] = MemoryCache()
+        self.binary = binary
+        self.asm = asm
+        self.output_dir = output_dir
+        self.watch = watch
+        # Path -> {"mtime", "hash", "files", "response"} of the last build of each file.
+        self.files = {}
+        self.builds = 0
+        self.running = False
+
+    def build(self, path):
+        """Build a file unless its content is unchanged since the last build. Return the response."""
+        path = os.path.abspath(path)
+        start = time.perf_counter()
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            with open(path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+        except OSError as e:
+            return {"ok": False, "file": path, "output": str(e)}
+        state = self.files.get(path)
+        if state is not None and state["hash"] == digest:
+            state["mtime"] = mtime
+            # Another file may have been built into the output directory since.
+            written = write_outputs(state["files"], self.output_dir)
+            return {**state["response"], "changed": False, "written": written,
+                "seconds": time.perf_counter() - start}
+
+        # The compiler reports errors by printing them and exiting.
+        output = io.StringIO()
+        stats = {}
+        try:
+            with contextlib.redirect_stdout(output):
+                program = compile_program(parse_file(path), self.options, stats)
+                files = output_files(program, self.binary, self.asm)
+        except SystemExit:
+            return self.failed(path, mtime, {"ok": False, "file": path, "output": output.getvalue()})
+        except Exception as e:
+            # A compiler crash on a half written file mustn't stop the server.
+            return self.failed(path, mtime, {"ok": False, "file": path, "output": output.getvalue(),
+                "error": f"{type(e).__name__}: {e}"})
+        written = write_outputs(files, self.output_dir)
+        self.builds += 1
+        response = {"ok": True, "file": path, "changed": True, "written": written,
+            "instructions": len(program.instructions), "output": format_compile_stats(stats),
+            "seconds": time.perf_counter() - start}
+        self.files[path] = {"mtime": mtime, "hash": digest, "files": files, "response": response}
+        return response
+
+    def failed(self, path, mtime, response):
+        """Keep watching a file that failed to build, so it's rebuilt when it's saved again."""
+        self.files[path] = {"mtime": mtime, "hash": None, "files": None, "response": response}
+        return response
+
+    def poll(self):
+        """Rebuild watched files whose modification time changed."""
+        for path, state in list(self.files.items()):
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            if mtime != state["mtime"]:
+                response = self.build(path)
+                if response["ok"]:
+                    print(f"Rebuilt {path}: ok in {response['seconds'] * 1000:.1f} ms")
+                else:
+                    # Failed builds have no timing.
+                    print(f"Rebuilt {path}: failed")
+                    print(response.get("error") or response["output"].strip())
+
+    def handle(self, message):
+        command = message.get("command")
+        if command == "build":
+            return self.build(message["file"])
+        if command == "status":
+            return {"ok": True, "files": list(self.files), "builds": self.builds}
+        if command == "stop":
+            self.running = False
+            return {"ok": True}
+        return {"ok": False, "output": f"Unknown command {command}."}
+
+    def serve(self, address=DEFAULT_ADDRESS):
+        """Answer requests until a stop request."""
+        sock = server_socket(address)
+        sock.settimeout(POLL_INTERVAL if self.watch else None)
+        self.running = True
+        print(f"Compile server listening on {address}")
+        try:
+            while self.running:
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    self.poll()
+                    continue
+                with conn:
+                    conn.settimeout(None)
+                    try:
+                        response = self.handle(json.loads(read_line(conn)))
+                    except (ValueError, KeyError) as e:
+                        response = {"ok": False, "output": f"Invalid request: {e}"}
+                    except Exception as e:
+                        response = {"ok": False, "output": "", "error": f"{type(e).__name__}: {e}"}
+                    conn.sendall(json.dumps(response).encode() + b"\n")
+        finally:
+            sock.close()
+            if not address.isdigit() and os.path.exists(address):
+                os.remove(address)
+
+if __name__ == "__main__":
+    command = sys.argv[1]
+    if command == "build":
+        response = request("build", *sys.argv[3:4], file=os.path.abspath(sys.argv[2]))
+    else:
+        response = request(command, *sys.argv[2:3])
+    if response.get("output"):
+        print(response["output"])
+    if response.get("error"):
+        print(f"Compiler error: {response['error']}")
+    if command == "build" and response["ok"]:
+        state = "rebuilt" if response["changed"] else "unchanged"
+        print(f"{state}, wrote {', '.join(response['written']) or 'nothing'} in {response['seconds'] * 1000:.1f} ms")
+    elif command == "status":
+        print(f"{response['builds']} builds: {', '.join(response['files'])}")
+    if not response["ok"]:
+        sys.exit(1)
@@ -1,73 +1,56 @@
-import re
-
 class CompilationError(Exception): pass
 
-# https://regex-vis.com/
-variable_rgx = r"([*&])?(\w+)(?=[+\-*;]|$)"
-func_call_rgx = r"(\w+)\((([*&]?\w+,)*[*&]?\w+)?\)$"
+# GR31 is the index register of the IDX address mode.
+INDEX_REGISTER = 31
 
-def deref_variable(adr_op, var_name, var_map):
-    """Dereference a variable. Return the address and mode of the given variable."""
-    try:
-        # The value is a constant
-        val = int(var_name, 0)
+def deref_variable(adr_op, var_name, var_map, registers=None):
+    """Dereference a variable. Return the address and mode of the given variable.
+    Variables allocated to a register are accessed with the REG address mode."""
+    m = 0
+    if adr_op == "&":
         m = 1
-        if adr_op == "*":
-            m = 0
-        elif adr_op == "&":
+    elif adr_op == "*":
+        m = 2
+    if var_name not in var_map:
+        raise CompilationError(f"Undeclared variable used: {var_name}")
+    adr = var_map[var_name]
+    if m == 0 and registers and adr in registers:
+        return 4, registers[adr]
+    return m, adr
+
+def deref_operand(operand, var_map, registers=None):
+    """Dereference a constant, variable or time operand. Return the address mode and data of the operand."""
+    if operand.kind == "constant":
+        if operand.adr_op == "&":
             raise CompilationError(f"Invalid address mode for constant.")
-    except:
-        # The value is a variable
-        m = 0
-        if adr_op == "&":
-            m = 1
-        elif adr_op == "*":
-            m = 2
-        if var_name not in var_map:
-            raise CompilationError(f"Undeclared variable used: {var_name}")
-        val = var_map[var_name]
-    return m, val
+        if operand.adr_op == "*":
+            return 0, operand.value
+        return 1, operand.value
+    elif operand.kind == "time":
+        # Time is read from register 30.
+        return 4, 30
+    elif operand.kind == "variable":
+        return deref_variable(operand.adr_op, operand.value, var_map, registers)
+    raise CompilationError(f"Invalid operand: {operand}")
 
 def get_block(block_id, blocks):
-    for b in blocks:
-        if b["block_id"] == block_id:
-            return b
+    if b := blocks.get(block_id):
+        return b
     raise CompilationError("Trying to access non existant code block.")
 
-def parse_function(expression):
-    """Parse a function call statement and return relevant info."""
-    if r := re.match(func_call_rgx, expression):
-        fn_name = r.group(1)
-        fn_params = []
-        if r.group(2):
-            fn_params = r.group(2).split(",")
-        _, width = r.span()
-        return fn_name, fn_params, width
-    else:
-        return False
-    
-def parse_variable(expression, require_valid=False):
-    """Parse a variable token and return relevant info."""
-    if r := re.match(variable_rgx, expression):
-        adr_op = r.group(1)
-        var_name = r.group(2)
-        _, width = r.span()
-        return adr_op, var_name, width
-    if require_valid:
-        raise CompilationError("Invalid variable syntax.")
-    return False
-
 def instructions_to_string(instructions, comments={}):
-    out = ""
+    out = []
     for idx, inst in enumerate(instructions):
-        # out += f"{idx:02} "
-        out += inst.__repr__()
+        # out.append(f"{idx:02} ")
+        out.append(inst.__repr__())
         if idx in comments:
-            out += "\t# " + comments[idx]
-        out += "\n"
-    return out
+            out.append("\t# " + comments[idx])
+        out.append("\n")
+    return "".join(out)
 
 class Instruction():
+    __slots__ = ("op", "grx", "m", "data")
+
     def __init__(self, op, grx=0, m=0, data=0):
         self.op = op
         self.grx = grx
@@ -79,6 +62,8 @@ class Instruction():
     
 class JmpToPlaceholder():
     """Placeholder for jmp instruction before functions have been placed in memory. Used by if and while."""
+    __slots__ = ("op", "block_id", "offset")
+
     def __init__(self, op, block_id, offset):
         self.op = op
         self.block_id = block_id
@@ -88,5 +73,29 @@ class JmpToPlaceholder():
     
 class JmpBackPlaceholder():
     """Placeholder for jmp instruction before functions have been placed in memory. Used by if and while."""
+    __slots__ = ()
+
+    def __repr__(self):
+        return f"JMP_BACK_PLACEHOLDER"
+
+class JmpRelPlaceholder():
+    """Placeholder for a jump to another instruction of the same block, offset instructions away.
+    Used by loops inside a single statement."""
+    __slots__ = ("op", "offset")
+
+    def __init__(self, op, offset):
+        self.op = op
+        self.offset = offset
+    def __repr__(self):
+        return f"{self.op}_PLACEHOLDER rel:{self.offset}"
+
+class JmpOverPlaceholder():
+    """Placeholder for a jump past an if/while block that is laid out right after this instruction.
+    Used by if blocks with an inverted condition and by loops with the test at the bottom."""
+    __slots__ = ("op", "block_id")
+
+    def __init__(self, op, block_id):
+        self.op = op
+        self.block_id = block_id
     def __repr__(self):
-        return f"JMP_BACK_PLACEHOLDER"
\ No newline at end of file
+        return f"{self.op}_PLACEHOLDER over:{self.block_id}"
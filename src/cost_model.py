@@ -0,0 +1,363 @@
+import sys, json
+from alang_parser import IfStatement
+from regalloc import function_map
+from ir_optimizer import is_inline_candidate, entry_functions
+from simulator import CYCLE_TABLE, instruction_cycles
+
+# Usage:
+# python3 cost_model.py [costs_file]
+#
+# Static cycle estimates of a compiled program, from the final instructions and a cycle table.
+#
+# The instructions of each function form a flow graph. Loops are found from its back edges and
+# estimated from the innermost out: the cycles of one iteration are the longest path from the loop
+# head back to it, the cycles of the loop are trips * iteration plus the longest path out of it.
+# Conditional jumps are assumed taken when that costs more, calls add the estimate of the called
+# function. Estimates are worst cases for one call of a function or one run of a loop.
+#
+# Trip counts are known for loops counting a local variable between constants, see unroll_loops.
+# Other loops are assumed to run loop_bound times and their estimates are marked as assumed, as
+# are functions calling themselves, whose recursive calls are counted once.
+#
+# The report ranks functions and loops by cycles and hints which are worth inlining or unrolling.
+# Builds given the hints of a previous report (interface.py --cost-hints) use a larger inline
+# threshold and unroll factor for them.
+
+COSTS_VERSION = 1
+DEFAULT_LOOP_BOUND = 10
+# Share of the cycles of a call or loop iteration spent on calling or looping for a hint.
+HINT_SHARE = 0.25
+# Hinted functions and loops are inlined and unrolled up to this many times the usual limit.
+HINT_FACTOR = 2
+
+CONDITIONAL_JUMPS = {"JNE", "JGR"}
+
+def successors(inst, adr, cycle_table):
+    """Return [(address, extra cycles)] of the instructions that may run after an instruction."""
+    taken = cycle_table["jump_taken"]
+    if inst.op in ("RET", "HALT"):
+        return []
+    if inst.op == "JMP":
+        # Jumps through memory or registers are not followed.
+        return [(inst.data, taken)] if inst.m == 1 else []
+    if inst.op in CONDITIONAL_JUMPS and inst.m == 1:
+        return [(adr + 1, 0), (inst.data, taken)]
+    return [(adr + 1, 0)]
+
+def loop_name(fn, statement):
+    """Name of a while loop, as in symbol maps: function:line."""
+    return f"{fn.name if fn else 'global'}:{statement.row}"
+
+class CostModel():
+    """Estimates the cycles of the functions and loops of a linked program."""
+
+    def __init__(self, instructions, blocks, trips=None, cycle_table=CYCLE_TABLE, loop_bound=DEFAULT_LOOP_BOUND):
+        self.instructions = instructions
+        self.blocks = blocks
+        self.trips = trips or {}
+        self.cycle_table = cycle_table
+        self.loop_bound = loop_bound
+        self.functions = function_map(blocks)
+        # Function or global block -> blocks laid out with it.
+        self.regions = {}
+        for b in blocks:
+            region = self.functions[b.block_id] or blocks[0]
+            self.regions.setdefault(region.block_id, []).append(b)
+        self.starts = {b.start_address: b for b in blocks if b.block_type == "function"}
+        # Function block id -> (cycles, assumed) once estimated, None while being estimated.
+        self.estimates = {}
+        self.loops = []
+
+    def call_target(self, inst):
+        if inst.op == "CALL" and inst.m == 1:
+            return self.starts.get(inst.data)
+        return None
+
+    def callee_cycles(self, fn):
+        """Return (cycles, assumed) of a call to a function. Calls back into a function that is being
+        estimated are recursive and count nothing more."""
+        if fn.block_id not in self.estimates:
+            self.estimate(fn)
+        if self.estimates[fn.block_id] is None:
+            return 0, True
+        return self.estimates[fn.block_id]
+
+    def estimate(self, region):
+        """Estimate a function or the global code. Callees are estimated first, on an explicit
+        stack so long call chains don't hit the recursion limit."""
+        stack = [region]
+        while stack:
+            fn = stack[-1]
+            self.estimates[fn.block_id] = None
+            pending = next((c for c in self.callees(fn) if c.block_id not in self.estimates), None)
+            if pending is not None:
+                stack.append(pending)
+                continue
+            self.estimates[fn.block_id] = self.analyze(fn)
+            stack.pop()
+
+    def addresses(self, region):
+        """Addresses of the instructions of a function or the global code."""
+        adrs = set()
+        for b in self.regions[region.block_id]:
+            adrs.update(range(b.start_address, b.end_address + 1))
+        return adrs
+
+    def callees(self, region):
+        found = []
+        nodes = self.addresses(region)
+        for adr in nodes:
+            inst = self.instructions[adr]
+            target = self.call_target(inst)
+            if target is not None:
+                found.append(target)
+            for t, _ in successors(inst, adr, self.cycle_table):
+                # Code falling through into the next function, like the global code into main.
+                if t not in nodes and t in self.starts:
+                    found.append(self.starts[t])
+        return found
+
+    def analyze(self, region):
+        """Return (cycles, assumed) of one run of a function or the global code and record its loops."""
+        nodes = self.addresses(region)
+        if region.start_address not in nodes:
+            return 0, False
+        table = self.cycle_table
+        cost = {}
+        edges = {}
+        exits = {}
+        assumed = False
+        for adr in nodes:
+            inst = self.instructions[adr]
+            cost[adr] = instruction_cycles(inst.op, inst.m, table)
+            target = self.call_target(inst)
+            if target is not None:
+                cycles, callee_assumed = self.callee_cycles(target)
+                cost[adr] += table["jump_taken"] + cycles
+                assumed |= callee_assumed
+            edges[adr] = []
+            exits[adr] = []
+            for t, extra in successors(inst, adr, table):
+                if t in nodes:
+                    edges[adr].append((t, extra))
+                elif t in self.starts:
+                    cycles, callee_assumed = self.callee_cycles(self.starts[t])
+                    exits[adr].append(extra + cycles)
+                    assumed |= callee_assumed
+                else:
+                    exits[adr].append(extra)
+
+        # Back edges of a depth first search from the entry close the loops.
+        entry = region.start_address
+        reached = {entry}
+        on_stack = {entry}
+        back_edges = {}
+        work = [(entry, iter(edges[entry]))]
+        while work:
+            adr, it = work[-1]
+            for t, _ in it:
+                if t in on_stack:
+                    back_edges.setdefault(t, []).append(adr)
+                elif t not in reached:
+                    reached.add(t)
+                    on_stack.add(t)
+                    work.append((t, iter(edges[t])))
+                    break
+            else:
+                on_stack.discard(adr)
+                work.pop()
+
+        predecessors = {}
+        for adr in reached:
+            for t, _ in edges[adr]:
+                predecessors.setdefault(t, []).append(adr)
+        loops = []
+        for head, sources in back_edges.items():
+            body = {head}
+            work = [s for s in sources if s != head]
+            body.update(work)
+            while work:
+                for p in predecessors.get(work.pop(), ()):
+                    if p not in body:
+                        body.add(p)
+                        work.append(p)
+            loops.append((head, body))
+        loops.sort(key=lambda loop: len(loop[1]))
+
+        # The while blocks of the region, to name loops and find their trip counts.
+        statements = {}
+        for b in self.regions[region.block_id]:
+            for statement in b.code:
+                if isinstance(statement, IfStatement):
+                    statements[statement.target_block] = statement
+        whiles = [b for b in self.regions[region.block_id]
+            if b.block_type == "while" and b.start_address <= b.end_address]
+
+        # The loop of a while block is the innermost loop around its body.
+        loop_blocks = {}
+        for w in whiles:
+            head = next((head for head, body in loops if w.start_address in body and w.end_address in body), None)
+            loop_blocks.setdefault(head, w)
+
+        # Loops are replaced by their head, carrying the cycles of the whole loop, from the innermost out.
+        rep = {}
+        summary = {}
+        fn = region if region.block_type == "function" else None
+        for head, body in loops:
+            iteration, exit_cycles = self.longest_path(head, body, cost, edges, exits, rep, summary)
+            block = loop_blocks.get(head)
+            known = block is not None and block.block_id in self.trips
+            trips = self.trips[block.block_id] if known else self.loop_bound
+            assumed |= not known
+            total = trips * iteration + exit_cycles
+            loop = {"kind": "loop", "function": fn.name if fn else "global", "address": head,
+                "trips": trips, "trips_known": known, "iteration_cycles": iteration, "cycles": total}
+            if block is not None and block.block_id in statements:
+                statement = statements[block.block_id]
+                loop.update(name=loop_name(fn, statement), line=statement.row, text=statement.text)
+                loop["hint"] = self.unroll_hint(block, cost, iteration, trips, known)
+            else:
+                loop.update(name=f"{loop['function']}@{head}", hint=None)
+            self.loops.append(loop)
+            # Exits of the loop lead to the code after it, without counting the loop again.
+            outside = [(t, 0) for adr in body for t, _ in edges[adr] if t not in body]
+            summary[head] = (total, outside)
+            for adr in body:
+                rep[adr] = head
+        _, cycles = self.longest_path(entry, reached, cost, edges, exits, rep, summary)
+        return cycles, assumed
+
+    def longest_path(self, head, nodes, cost, edges, exits, rep, summary):
+        """Return (iteration, exit) cycles of the longest paths from head back to it and out of nodes,
+        with inner loops replaced by their head."""
+
+        def node_cost(r):
+            return summary[r][0] if r in summary else cost[r]
+
+        def out(r):
+            """Edges (target or None for exits, extra cycles) of a node or inner loop."""
+            if r in summary:
+                targets = summary[r][1]
+                result = []
+            else:
+                targets = edges[r]
+                result = [(None, extra) for extra in exits[r]]
+                if not edges[r] and not exits[r]:
+                    result.append((None, 0))
+            for t, extra in targets:
+                result.append((rep.get(t, t) if t in nodes else None, extra))
+            return result
+
+        # Reverse postorder of the nodes reachable from head, edges back to head left out.
+        order = []
+        seen = {head}
+        work = [(head, iter(out(head)))]
+        while work:
+            r, it = work[-1]
+            for t, _ in it:
+                if t is not None and t != head and t not in seen:
+                    seen.add(t)
+                    work.append((t, iter(out(t))))
+                    break
+            else:
+                order.append(r)
+                work.pop()
+        order.reverse()
+
+        dist = {head: 0}
+        iteration = exit_cycles = 0
+        for r in order:
+            end = dist[r] + node_cost(r)
+            for t, extra in out(r):
+                if t is None:
+                    exit_cycles = max(exit_cycles, end + extra)
+                elif t == head:
+                    iteration = max(iteration, end + extra)
+                elif dist.get(t, -1) < end + extra:
+                    dist[t] = end + extra
+        return iteration, exit_cycles
+
+    def unroll_hint(self, block, cost, iteration, trips, known):
+        """Hint straight loops with a known trip count that spend much of each iteration on looping."""
+        if not known or trips < 2 or iteration == 0:
+            return None
+        work = 0
+        for adr in range(block.start_address, block.end_address + 1):
+            inst = self.instructions[adr]
+            if inst.op in CONDITIONAL_JUMPS:
+                return None
+            if inst.op != "JMP":
+                work += cost[adr]
+        return "unroll" if (iteration - work) >= HINT_SHARE * iteration else None
+
+    def inline_hint(self, fn, cycles, entries):
+        """Hint straight leaf functions whose calls cost a large share of their cycles."""
+        if fn.block_id in entries or not is_inline_candidate(fn):
+            return None
+        table = self.cycle_table
+        call = instruction_cycles("CALL", 1, table) + table["jump_taken"]
+        overhead = call + instruction_cycles("RET", 0, table)
+        return "inline" if overhead >= HINT_SHARE * (call + cycles) else None
+
+    def report(self):
+        """Estimate every function. Return the cost report."""
+        entries = entry_functions(self.blocks)
+        functions = []
+        regions = [b for b in self.blocks if b.block_type in ("function", "global")]
+        for region in regions:
+            if region.block_id not in self.estimates:
+                self.estimate(region)
+        for region in regions:
+            if region.block_type == "global" and region.start_address > region.end_address:
+                continue
+            cycles, assumed = self.estimates[region.block_id]
+            name = region.name if region.block_type == "function" else "global"
+            functions.append({"name": name, "kind": region.block_type, "address": region.start_address,
+                "instructions": len(self.addresses(region)), "cycles": cycles, "assumed": assumed,
+                "hint": self.inline_hint(region, cycles, entries) if region.block_type == "function" else None})
+        return {"version": COSTS_VERSION, "loop_bound": self.loop_bound, "functions": functions, "loops": self.loops}
+
+def estimate_costs(instructions, blocks, trips=None, cycle_table=CYCLE_TABLE, loop_bound=DEFAULT_LOOP_BOUND):
+    """Return the cost report of linked instructions. blocks must have their addresses set by the layout.
+    trips maps while block ids to their known trip count."""
+    return CostModel(instructions, blocks, trips, cycle_table, loop_bound).report()
+
+def annotate_costs(comments, report):
+    """Add the estimates to the listing comments at the start of each function and loop."""
+    for entry in report["functions"] + report["loops"]:
+        if entry["kind"] == "loop":
+            trips = f"{entry['trips']}{'' if entry['trips_known'] else '?'}"
+            text = f"loop {entry['name']} ~{entry['iteration_cycles']} cycles x {trips}"
+        else:
+            text = f"~{entry['cycles']}{'?' if entry['assumed'] else ''} cycles"
+        adr = entry["address"]
+        comments[adr] = f"{comments[adr]} | {text}" if adr in comments else text
+
+def cost_hints(report):
+    """Return the functions and loops a report hints to inline or unroll."""
+    return {
+        "inline": [e["name"] for e in report["functions"] if e["hint"] == "inline"],
+        "unroll": [e["name"] for e in report["loops"] if e["hint"] == "unroll"],
+    }
+
+def format_costs(report):
+    """Format a cost report as a table, most cycles first. Assumed trip counts are marked with ?."""
+    rows = [(e["cycles"], e) for e in report["functions"] + report["loops"]]
+    rows.sort(key=lambda row: -row[0])
+    lines = [f"{'Name':24} {'kind':8} {'cycles':>10} {'per iter':>9} {'trips':>6} hint"]
+    for cycles, e in rows:
+        if e["kind"] == "loop":
+            mark = "" if e["trips_known"] else "?"
+            per_iteration, trips = str(e["iteration_cycles"]), f"{e['trips']}{mark}"
+        else:
+            mark = "?" if e["assumed"] else ""
+            per_iteration, trips = "", ""
+        lines.append(f"{e['name']:24} {e['kind']:8} {str(cycles) + mark:>10} {per_iteration:>9} {trips:>6} "
+            f"{e['hint'] or '':6}".rstrip())
+    if any(e["assumed"] for e in report["functions"]):
+        lines.append(f"? assumes {report['loop_bound']} iterations of loops without a known trip count")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    with open(sys.argv[1], "r") as f:
+        print(format_costs(json.load(f)))
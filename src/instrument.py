@@ -0,0 +1,158 @@
+import sys, json
+from alang_parser import IfStatement
+from regalloc import function_map
+from compiler_utils import Instruction, INDEX_REGISTER
+
+# Usage:
+# python3 instrument.py [symbol_map] [memory_dump]
+# python3 instrument.py [symbol_map] --simulate [machine_code_file] [max_steps]
+#
+# On-target profiling of functions and loops.
+#
+# Instrumented functions and loops count how often they are entered and add up the cycles they run,
+# read from the time register GR30. The counters are a hidden global array of two rows per function
+# or loop: entry count and cycles. Entering pushes the current time on the stack. Leaving pops it
+# and adds the elapsed cycles, both at the end of a loop and at every RET or HALT inside it.
+# Times are inclusive: a function's cycles include the functions it calls, recursive calls are
+# counted again at each level. Counters wrap at 32 bits.
+#
+# The compiler writes a symbol map with the address of each counter pair. The memory dump given
+# to this tool holds the counter region read from the target, one word per line, starting at the
+# base address of the map.
+
+PROFILE_COUNTERS = "profile.counters"
+SYMBOL_MAP_VERSION = 1
+
+def instrumented_blocks(blocks, selection):
+    """Return the functions and while blocks to instrument, in program order.
+    selection is "all" or a list of function names. Loops are instrumented with their function."""
+    functions = function_map(blocks)
+    selected = []
+    for b in blocks:
+        fn = b if b.block_type == "function" else functions[b.block_id]
+        if b.block_type not in ("function", "while") or fn is None:
+            continue
+        if selection == "all" or fn.name in selection:
+            selected.append(b)
+    return selected
+
+def declare_profile_counters(blocks, selection):
+    """Declare the counter array in the global block. Return {block id: counter index}."""
+    selected = instrumented_blocks(blocks, selection)
+    if not selected:
+        return {}
+    next_address = 0
+    for b in blocks:
+        for name, adr in b.variables.items():
+            next_address = max(next_address, adr + b.arrays.get(name, 1))
+    root = blocks[0]
+    root.variables[PROFILE_COUNTERS] = next_address
+    root.arrays[PROFILE_COUNTERS] = 2 * len(selected)
+    return {b.block_id: idx for idx, b in enumerate(selected)}
+
+def counter_address(block, counters):
+    """Address of the entry count of an instrumented block. The cycles follow it."""
+    return block.variables.resolve(PROFILE_COUNTERS) + 2 * counters[block.block_id]
+
+def profile_entry(adr):
+    """Count an entry and push the time. Uses GR0, which holds no value between statements."""
+    return [
+        Instruction("LOAD", 0, 0, adr),
+        Instruction("ADD", 0, 1, 1),
+        Instruction("STORE", 0, 0, adr),
+        Instruction("LOAD", 0, 4, 30),
+        Instruction("PUSH", 0),
+    ]
+
+def profile_exit(adr):
+    """Pop the entry time and add the elapsed cycles. GR1 is kept for return values."""
+    return [
+        Instruction("POP", INDEX_REGISTER),
+        Instruction("LOAD", 0, 4, 30),
+        Instruction("SUB", 0, 4, INDEX_REGISTER),
+        Instruction("ADD", 0, 0, adr + 1),
+        Instruction("STORE", 0, 0, adr + 1),
+    ]
+
+def active_blocks(block, blocks, counters):
+    """Return the instrumented loops around a block and its function, innermost first.
+    These are running when the block returns or halts."""
+    active = []
+    while block is not None:
+        if block.block_id in counters:
+            active.append(block)
+        if block.block_type == "function":
+            break
+        block = blocks.get(block.parent_block)
+    return active
+
+def symbol_map(blocks, counters):
+    """Return the symbol map of the counters and the code addresses of the instrumented blocks.
+    Blocks that are no longer in the program are left out."""
+    loops = {}
+    for b in blocks:
+        for statement in b.code:
+            if isinstance(statement, IfStatement) and statement.target_block in counters:
+                loops[statement.target_block] = statement
+    functions = function_map(blocks)
+    base = None
+    entries = []
+    for b in blocks:
+        if b.block_id not in counters:
+            continue
+        adr = counter_address(b, counters)
+        base = b.variables.resolve(PROFILE_COUNTERS)
+        if b.block_type == "function":
+            entry = {"name": b.name, "kind": "function", "function": b.name}
+        else:
+            statement = loops[b.block_id]
+            fn = functions[b.block_id].name
+            entry = {"name": f"{fn}:{statement.row}", "kind": "loop", "function": fn,
+                "line": statement.row, "text": statement.text}
+        entry.update(address=b.start_address, count=adr, cycles=adr + 1)
+        entries.append(entry)
+    if base is None:
+        return None
+    rows = 2 * len(counters)
+    return {"version": SYMBOL_MAP_VERSION, "base": base, "rows": rows, "entries": entries}
+
+def decode_profile(symbols, memory, offset=0):
+    """Return the entries of a symbol map with their counts and cycles read from memory,
+    most cycles first. memory[adr - offset] holds the word at address adr."""
+    report = []
+    for entry in symbols["entries"]:
+        count = memory[entry["count"] - offset]
+        cycles = memory[entry["cycles"] - offset]
+        report.append({**entry, "calls": count, "total_cycles": cycles,
+            "cycles_per_call": cycles / count if count else 0})
+    report.sort(key=lambda e: -e["total_cycles"])
+    return report
+
+def format_hotspots(report):
+    """Format a decoded profile as a table."""
+    total = max((e["total_cycles"] for e in report), default=0)
+    lines = [f"{'Name':24} {'kind':8} {'calls':>8} {'cycles':>10} {'per call':>10} {'share':>6}"]
+    for e in report:
+        share = 100 * e["total_cycles"] / total if total else 0
+        lines.append(f"{e['name']:24} {e['kind']:8} {e['calls']:8} {e['total_cycles']:10} "
+            f"{e['cycles_per_call']:10.1f} {share:5.1f}%")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    with open(sys.argv[1], "r") as f:
+        symbols = json.load(f)
+    if sys.argv[2] == "--simulate":
+        from simulator import Simulator
+        from machine_image import load_machine_code
+        program = load_machine_code(sys.argv[3])
+        sim = Simulator(program, entry=getattr(program, "entry", 0))
+        sim.run(int(sys.argv[4]) if len(sys.argv) > 4 else None)
+        memory, offset = sim.mem, 0
+    else:
+        with open(sys.argv[2], "r") as f:
+            memory = [int(line, 0) for line in f.read().split()]
+        offset = symbols["base"]
+        if len(memory) < symbols["rows"]:
+            print(f"Memory dump too short. The counters take {symbols['rows']} rows.")
+            exit()
+    print(format_hotspots(decode_profile(symbols, memory, offset)))
@@ -0,0 +1,403 @@
+from alang_parser import Operand, Statement, IfStatement, BlockTable, copy_block
+from regalloc import function_map, call_graph, recursive_functions, all_operands, resolve
+
+# Optimization passes working on the statement IR before it's compiled.
+
+# Largest value that fits the data field of an instruction.
+MAX_CONSTANT = 0xFFFFF
+# Most statements a loop body may grow to when it's unrolled.
+UNROLL_MAX_STATEMENTS = 64
+
+# Builtin functions compiled inline. Name -> number of parameters.
+INTRINSICS = {"memcpy": 3}
+# Hidden variable holding the destination pointer of memcpy calls that copy through pointer variables.
+# Names with a dot can't clash with declared variables.
+MEMCPY_POINTER = "memcpy.dst"
+
+def is_constant(operand):
+    return operand.kind == "constant" and operand.adr_op is None
+
+def constant(value):
+    return Operand("constant", value)
+
+def power_of_two(value):
+    """Return k if value is 2^k with k > 0, otherwise None."""
+    if value > 1 and value & (value - 1) == 0:
+        return value.bit_length() - 1
+    return None
+
+def apply_op(op, a, b):
+    if op == "+":
+        return a + b
+    if op == "-":
+        return a - b
+    if op == "*":
+        return a * b
+
+def fold_step(terms, stats):
+    """Apply the first matching folding rule. Return the new terms or None if nothing matched."""
+    # Constant prefix. Expressions are evaluated left to right so only the start can be computed.
+    if len(terms) >= 2 and is_constant(terms[0][1]) and is_constant(terms[1][1]) and terms[1][0] in ("+", "-", "*"):
+        value = apply_op(terms[1][0], terms[0][1].value, terms[1][1].value)
+        if 0 <= value <= MAX_CONSTANT:
+            stats["folded"] = stats.get("folded", 0) + 1
+            return [(None, constant(value))] + terms[2:]
+
+    # 0 + x and 1 * x are x.
+    if len(terms) >= 2 and is_constant(terms[0][1]):
+        first, (op, operand) = terms[0][1].value, terms[1]
+        if (first == 0 and op == "+") or (first == 1 and op == "*"):
+            stats["identities"] = stats.get("identities", 0) + 1
+            return [(None, operand)] + terms[2:]
+
+    for i in range(1, len(terms)):
+        op, operand = terms[i]
+        if not is_constant(operand):
+            continue
+        value = operand.value
+
+        # x + 0, x - 0 and x * 1 are x.
+        if (op in ("+", "-") and value == 0) or (op == "*" and value == 1):
+            stats["identities"] = stats.get("identities", 0) + 1
+            return terms[:i] + terms[i + 1:]
+
+        # x * 0 is 0 unless the value before it comes from a function call.
+        if op == "*" and value == 0 and all(o.kind != "call" for _, o in terms[:i]):
+            stats["folded"] = stats.get("folded", 0) + i
+            return [(None, constant(0))] + terms[i + 1:]
+
+        # Merge consecutive constants. (x + a) - b is x + (a - b) and (x * a) * b is x * (a * b).
+        prev_op, prev = terms[i - 1]
+        if i >= 2 and is_constant(prev):
+            merged = None
+            if op in ("+", "-") and prev_op in ("+", "-"):
+                net = (prev.value if prev_op == "+" else -prev.value) + (value if op == "+" else -value)
+                merged = ("+", net) if net >= 0 else ("-", -net)
+            elif op == "*" and prev_op == "*":
+                merged = ("*", prev.value * value)
+            if merged and merged[1] <= MAX_CONSTANT:
+                stats["folded"] = stats.get("folded", 0) + 1
+                return terms[:i - 1] + [(merged[0], constant(merged[1]))] + terms[i + 1:]
+
+    # x * 2^k and 2^k * x are x << k. Done last so constant multiplications are merged first.
+    if len(terms) >= 2 and is_constant(terms[0][1]) and terms[1][0] == "*" and power_of_two(terms[0][1].value) is not None:
+        stats["shifts"] = stats.get("shifts", 0) + 1
+        return [(None, terms[1][1]), ("<<", constant(power_of_two(terms[0][1].value)))] + terms[2:]
+    for i in range(1, len(terms)):
+        op, operand = terms[i]
+        if op == "*" and is_constant(operand) and power_of_two(operand.value) is not None:
+            stats["shifts"] = stats.get("shifts", 0) + 1
+            return terms[:i] + [("<<", constant(power_of_two(operand.value)))] + terms[i + 1:]
+    return None
+
+def fold_terms(terms, stats=None):
+    """Fold constants and reduce multiplications by powers of two to shifts in an expression."""
+    if stats is None:
+        stats = {}
+    while (folded := fold_step(terms, stats)) is not None:
+        terms = folded
+    return terms
+
+def fold_constants(blocks, stats=None):
+    """Run constant folding on every expression statement. Return a new BlockTable with copies
+    of the changed statements and their blocks, the given blocks aren't changed."""
+    folded_blocks = []
+    for block in blocks:
+        code = []
+        for statement in block.code:
+            if statement.kind == "expression" and (terms := fold_terms(statement.terms, stats)) is not statement.terms:
+                statement = copy_statement(statement)
+                statement.terms = terms
+            code.append(statement)
+        changed = any(s is not t for s, t in zip(code, block.code))
+        folded_blocks.append(copy_block(block, code=code) if changed else block)
+    return BlockTable(folded_blocks)
+
+def is_inline_candidate(block):
+    """True if a function is a leaf with straight line code that may be inlined at its call sites."""
+    if block.block_type != "function" or "noinline" in block.attributes:
+        return False
+    for idx, statement in enumerate(block.code):
+        if isinstance(statement, IfStatement):
+            return False
+        if statement.kind == "return" and idx != len(block.code) - 1:
+            return False
+        if any(operand.kind == "call" for _, operand in statement.terms):
+            return False
+    return True
+
+def constant_condition(statement):
+    """Return the value of an if/while condition comparing two constants, or None."""
+    if not (is_constant(statement.lhs) and is_constant(statement.rhs)):
+        return None
+    lhs, rhs = statement.lhs.value, statement.rhs.value
+    if statement.compare == "<":
+        return lhs < rhs
+    if statement.compare == ">":
+        return lhs > rhs
+    if statement.compare == "!=":
+        return lhs != rhs
+    if statement.compare == "==":
+        return lhs == rhs
+    return None
+
+def entry_functions(blocks):
+    """Return the ids of the functions the program starts in: the first function and main."""
+    entries = set()
+    for b in blocks:
+        if b.block_type == "function":
+            entries.add(b.block_id)
+            break
+    if len(blocks) and (main := blocks[0].functions.resolve("main")) is not None:
+        entries.add(main)
+    return entries
+
+def reachable_functions(graph, entries):
+    """Return the ids of the functions reachable from the entry functions in a call graph."""
+    reached = set(entries)
+    work = list(entries)
+    while work:
+        for callee in graph.get(work.pop(), ()):
+            if callee not in reached:
+                reached.add(callee)
+                work.append(callee)
+    return reached
+
+def eliminate_dead_code(blocks, stats=None):
+    """Drop if/while blocks whose condition compares two constants and is never true, and functions
+    that can't be called from the entry functions.
+    Return the live blocks, the removed blocks and the removed (block, if/while statement) pairs.
+    Blocks losing statements are copied, the given blocks aren't changed."""
+    if stats is None:
+        stats = {}
+    dead = set()
+    removed_statements = []
+    live_blocks = []
+    for b in blocks:
+        live_code = []
+        for statement in b.code:
+            if isinstance(statement, IfStatement) and constant_condition(statement) is False:
+                dead.add(statement.target_block)
+                removed_statements.append((b, statement))
+                stats["blocks"] = stats.get("blocks", 0) + 1
+            else:
+                live_code.append(statement)
+        live_blocks.append(b if len(live_code) == len(b.code) else copy_block(b, code=live_code))
+    blocks = live_blocks
+
+    # Blocks inside removed blocks are removed too. Parents come before their children.
+    for b in blocks:
+        if b.parent_block in dead:
+            dead.add(b.block_id)
+    live = [b for b in blocks if b.block_id not in dead]
+
+    functions = function_map(live)
+    reached = reachable_functions(call_graph(live, functions), entry_functions(blocks))
+    for b in live:
+        fn = functions[b.block_id]
+        if fn is not None and fn.block_id not in reached:
+            dead.add(b.block_id)
+            if b is fn:
+                stats["functions"] = stats.get("functions", 0) + 1
+    live = BlockTable(b for b in blocks if b.block_id not in dead)
+    return live, [b for b in blocks if b.block_id in dead], removed_statements
+
+def intrinsic_call(statement, block):
+    """Return the name of the intrinsic a statement consists of, or None.
+    Declared functions with the same name take precedence."""
+    if isinstance(statement, IfStatement) or statement.kind != "expression" or len(statement.terms) != 1:
+        return None
+    operand = statement.terms[0][1]
+    if operand.kind == "call" and operand.value in INTRINSICS and operand.value not in block.functions:
+        return operand.value
+    return None
+
+def is_address_constant(operand):
+    """True if the value of an operand is an address known at compile time: a constant or &variable."""
+    return (operand.kind == "constant" and operand.adr_op is None) or \
+        (operand.kind == "variable" and operand.adr_op == "&")
+
+def declare_intrinsic_variables(blocks):
+    """Declare the hidden variables used by intrinsics in the functions calling them."""
+    functions = function_map(blocks)
+    next_address = 0
+    for b in blocks:
+        for name, adr in b.variables.items():
+            next_address = max(next_address, adr + b.arrays.get(name, 1))
+    for b in blocks:
+        for statement in b.code:
+            if intrinsic_call(statement, b) != "memcpy":
+                continue
+            params = statement.terms[0][1].params
+            if len(params) == 3 and is_address_constant(params[0]) and is_address_constant(params[1]):
+                continue
+            fn = functions[b.block_id] or b
+            if MEMCPY_POINTER not in fn.variables.symbols:
+                fn.variables[MEMCPY_POINTER] = next_address
+                next_address += 1
+
+def copy_statement(statement):
+    return Statement(statement.text, statement.row, statement.kind, statement.target, list(statement.terms))
+
+def trip_count(start, compare, end, step):
+    """Number of iterations of a loop counting from start by step while the condition holds, or None."""
+    if compare == "<":
+        return 0 if start >= end else (end - start + step - 1) // step
+    if compare == "!=" and end >= start and (end - start) % step == 0:
+        return (end - start) // step
+    return None
+
+def loop_trip_count(loop, block, idx, blocks, pinned):
+    """Return the trip count of a while loop, or None. The loop must count a local variable from
+    a constant set right before it to a constant, by a step at the end of its body."""
+    condition = block.code[idx]
+    lhs, compare, rhs = condition.lhs, condition.compare, condition.rhs
+    if compare == ">":
+        lhs, compare, rhs = rhs, "<", lhs
+    elif compare == "!=" and is_constant(lhs):
+        lhs, rhs = rhs, lhs
+    if lhs.kind != "variable" or lhs.adr_op is not None or not is_constant(rhs):
+        return None
+    counter = resolve(lhs, block)
+    if counter is None or counter in pinned:
+        return None
+
+    # The counter is set to a constant right before the loop.
+    if idx == 0:
+        return None
+    init = block.code[idx - 1]
+    if isinstance(init, IfStatement) or init.kind != "expression" or init.target is None \
+            or init.target.adr_op is not None or resolve(init.target, block) != counter \
+            or len(init.terms) != 1 or not is_constant(init.terms[0][1]):
+        return None
+
+    # The body ends with counter = counter + step and doesn't set the counter elsewhere, nor do the blocks in it.
+    body = loop.code
+    if not body or isinstance(body[-1], IfStatement):
+        return None
+    step = body[-1]
+    if step.kind != "expression" or step.target is None or step.target.adr_op is not None \
+            or resolve(step.target, loop) != counter or len(step.terms) != 2:
+        return None
+    (_, first), (op, amount) = step.terms
+    if first.kind != "variable" or first.adr_op is not None or resolve(first, loop) != counter \
+            or op != "+" or not is_constant(amount) or amount.value < 1:
+        return None
+    work = [(statement, loop) for statement in body[:-1]]
+    while work:
+        statement, b = work.pop()
+        if isinstance(statement, IfStatement):
+            nested = blocks.get(statement.target_block)
+            work += [(s, nested) for s in nested.code]
+            continue
+        target = statement.target
+        if target is not None and target.kind == "variable" and target.adr_op is None \
+                and resolve(target, b) == counter:
+            return None
+
+    return trip_count(init.terms[0][1].value, compare, rhs.value, amount.value)
+
+def unroll_loop(loop, block, idx, blocks, pinned):
+    """Return (trip count, body) of a while loop that can be unrolled, or None.
+    The body must be straight line code and the trip count known, see loop_trip_count."""
+    if not loop.code or any(isinstance(s, IfStatement) for s in loop.code):
+        return None
+    count = loop_trip_count(loop, block, idx, blocks, pinned)
+    if count is None:
+        return None
+    return count, loop.code
+
+def calls_back(loop, fn, blocks, graph):
+    """True if a loop body or the blocks in it call a function that can call fn."""
+    callees = set()
+    work = [loop]
+    while work:
+        b = work.pop()
+        for statement in b.code:
+            if isinstance(statement, IfStatement):
+                work.append(blocks.get(statement.target_block))
+            for name in all_operands(statement)[1]:
+                if name in b.functions:
+                    callees.add(b.functions[name])
+    return fn.block_id in reachable_functions(graph, callees)
+
+def unroll_loops(blocks, factor, stats=None, trips=None, hot=None):
+    """Unroll while loops with a constant trip count. The body is repeated by the largest
+    divisor of the trip count up to factor. Loops running at most factor times are replaced
+    by copies of their body. Return a new BlockTable with copies of the changed blocks, without
+    the removed loop blocks. The given blocks aren't changed.
+    hot maps loop names "function:line" to a factor used instead of factor for them.
+    The iterations of the loops that are kept are added to trips by loop block id, if given."""
+    if stats is None:
+        stats = {}
+    if hot is None:
+        hot = {}
+    if factor < 2 and trips is None:
+        return blocks
+
+    # Counters must only be changed by the loop itself: no globals, variables used by
+    # other functions, variables whose address is taken or locals of recursive functions,
+    # which are static and overwritten by the nested calls.
+    functions = function_map(blocks)
+    graph = call_graph(blocks, functions)
+    recursive = recursive_functions(graph)
+    owner = {}
+    for b in blocks:
+        for _, adr in b.variables.items():
+            owner[adr] = functions[b.block_id]
+    pinned = {adr for adr, fn in owner.items() if fn is None or fn.block_id in recursive}
+    for b in blocks:
+        for statement in b.code:
+            for operand, _ in all_operands(statement)[0]:
+                if operand.kind != "variable":
+                    continue
+                adr = resolve(operand, b)
+                if operand.adr_op == "&" or owner.get(adr) is not functions[b.block_id]:
+                    pinned.add(adr)
+
+    removed = set()
+    # Block id -> new code of the changed blocks.
+    new_code = {}
+    for b in blocks:
+        if b.block_id in removed:
+            continue
+        code = []
+        for idx, statement in enumerate(b.code):
+            if not isinstance(statement, IfStatement) or statement.kind != "while":
+                code.append(statement)
+                continue
+            loop = blocks.get(statement.target_block)
+            fn = functions[b.block_id]
+            if fn is not None and calls_back(loop, fn, blocks, graph):
+                code.append(statement)
+                continue
+            r = unroll_loop(loop, b, idx, blocks, pinned)
+            if r is None:
+                code.append(statement)
+                if trips is not None and (count := loop_trip_count(loop, b, idx, blocks, pinned)) is not None:
+                    trips[loop.block_id] = count
+                continue
+            count, body = r
+            loop_factor = hot.get(f"{fn.name}:{statement.row}", factor) if fn else factor
+            if factor > 1 and 0 < count <= loop_factor and count * len(body) <= UNROLL_MAX_STATEMENTS \
+                    and not loop.variables.symbols and not loop.functions.symbols:
+                # Replace the loop with copies of the body.
+                code += [copy_statement(s) for _ in range(count) for s in body]
+                removed.add(loop.block_id)
+                stats["full"] = stats.get("full", 0) + 1
+                continue
+            code.append(statement)
+            times = next((k for k in range(loop_factor, 1, -1) if count % k == 0), 1) if factor > 1 else 1
+            if times > 1 and times * len(body) <= UNROLL_MAX_STATEMENTS:
+                new_code[loop.block_id] = [copy_statement(s) for _ in range(times) for s in body]
+                stats["loops"] = stats.get("loops", 0) + 1
+            else:
+                times = 1
+            if trips is not None:
+                trips[loop.block_id] = count // times
+        if code != b.code:
+            new_code[b.block_id] = code
+    if not removed and not new_code:
+        return blocks
+    return BlockTable(copy_block(b, code=new_code[b.block_id]) if b.block_id in new_code else b
+        for b in blocks if b.block_id not in removed)
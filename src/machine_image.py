@@ -0,0 +1,119 @@
+import sys, mmap, struct
+
+# Packed binary machine code.
+#
+# Header, 16 bytes, big endian:
+#   magic "AMC\0", format version, word width in bits, bytes per word, padding,
+#   instruction count (32 bit), entry address (32 bit).
+# The instructions follow as big endian words of WORD_BYTES bytes each.
+
+MAGIC = b"AMC\0"
+VERSION = 1
+WORD_BITS = 33
+WORD_BYTES = (WORD_BITS + 7) // 8
+HEADER = struct.Struct(">4sBBBxII")
+
+class MachineImageError(Exception): pass
+
+def text_to_words(text):
+    """Convert machine code text, one binary instruction per line, to a list of words."""
+    return [int(line, 2) for line in text.split()]
+
+def words_to_text(words):
+    return "\n".join(f"{word:0{WORD_BITS}b}" for word in words)
+
+def pack_image(words, entry=0):
+    """Return the packed binary image of a list of machine words."""
+    body = bytearray(len(words) * WORD_BYTES)
+    for idx, word in enumerate(words):
+        if word >> WORD_BITS:
+            raise MachineImageError(f"Instruction {idx} doesn't fit in {WORD_BITS} bits.")
+        body[idx * WORD_BYTES:(idx + 1) * WORD_BYTES] = word.to_bytes(WORD_BYTES, "big")
+    return HEADER.pack(MAGIC, VERSION, WORD_BITS, WORD_BYTES, len(words), entry) + bytes(body)
+
+def write_image(path, words, entry=0):
+    with open(path, "wb") as f:
+        f.write(pack_image(words, entry))
+
+def parse_header(data):
+    """Return (instruction count, entry address) from the start of an image."""
+    if len(data) < HEADER.size:
+        raise MachineImageError("File too short for a machine code header.")
+    magic, version, word_bits, word_bytes, count, entry = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise MachineImageError("Not a packed machine code file.")
+    if version != VERSION or word_bits != WORD_BITS or word_bytes != WORD_BYTES:
+        raise MachineImageError(f"Unsupported format: version {version}, {word_bits} bit words in {word_bytes} bytes.")
+    if len(data) < HEADER.size + count * WORD_BYTES:
+        raise MachineImageError(f"File truncated. Header says {count} instructions.")
+    return count, entry
+
+class MachineImage():
+    """Read only view of a packed machine code file. The file is memory mapped and
+    instructions are decoded on access, so nothing is copied up front."""
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped.
+            self.file.close()
+            raise MachineImageError("File too short for a machine code header.")
+        self.count, self.entry = parse_header(self.map)
+        self.view = memoryview(self.map)[HEADER.size:HEADER.size + self.count * WORD_BYTES]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError("Instruction index out of range.")
+        return int.from_bytes(self.view[idx * WORD_BYTES:(idx + 1) * WORD_BYTES], "big")
+
+    def __iter__(self):
+        view = self.view
+        for offset in range(0, len(view), WORD_BYTES):
+            yield int.from_bytes(view[offset:offset + WORD_BYTES], "big")
+
+    def raw(self):
+        """The packed instruction bytes, without the header."""
+        return self.view
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def is_image(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def load_machine_code(path):
+    """Return a MachineImage for packed files and the text for text machine code."""
+    if is_image(path):
+        return MachineImage(path)
+    with open(path, "r") as f:
+        return f.read()
+
+if __name__ == "__main__":
+    # Usage:
+    # python3 machine_image.py pack [machine_code_file] [output_file]
+    # python3 machine_image.py unpack [image_file] [output_file]
+    command, input_file, output_file = sys.argv[1:4]
+    if command == "pack":
+        with open(input_file, "r") as f:
+            write_image(output_file, text_to_words(f.read()))
+    elif command == "unpack":
+        with MachineImage(input_file) as image, open(output_file, "w") as f:
+            f.write(words_to_text(image))
+    else:
+        print(f"Unknown command {command}.")
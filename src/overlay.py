@@ -0,0 +1,184 @@
+from alang_parser import IfStatement
+from regalloc import FunctionFlow, all_operands, resolve, function_map, call_graph, recursive_functions
+
+# Static stack overlay of local variables.
+#
+# Each function gets a frame holding the variables declared in it and its if/while blocks.
+# A frame is placed above the frames of every function that calls it, so functions that
+# can be active at the same time never share memory. Functions that are never active at
+# the same time, like two functions called one after the other, reuse the same rows.
+#
+# Locals are assumed to only hold values during a call. Variables that keep their value
+# between calls stay in their own rows: globals, variables read before they are written
+# in their function, variables used by other functions, locals of recursive functions and
+# locals whose address is returned or stored outside the function. Pointers to locals
+# passed to a called function must not be kept after that call returns.
+# Variables kept in registers need no memory and get negative addresses.
+
+def variable_rows(blocks):
+    """Return (address, rows, block, name) of every variable, in address order."""
+    variables = []
+    for b in blocks:
+        for name, adr in b.variables.items():
+            variables.append((adr, b.arrays.get(name, 1), b, name))
+    variables.sort(key=lambda v: v[0])
+    return variables
+
+def escaping_locals(fn, fn_blocks, owner):
+    """Return the addresses of locals of a function whose address is returned or stored outside the function."""
+    def is_local(operand, b):
+        adr = resolve(operand, b)
+        return adr is not None and owner.get(adr) is fn
+
+    # Local variables holding addresses of locals, directly or through other such variables.
+    pointers = set()
+    taken = {}
+    changed = True
+    while changed:
+        changed = False
+        for b in fn_blocks:
+            for statement in b.code:
+                if isinstance(statement, IfStatement):
+                    continue
+                sources = set()
+                for _, operand in statement.terms:
+                    if operand.kind != "variable" or not is_local(operand, b):
+                        continue
+                    adr = resolve(operand, b)
+                    if operand.adr_op == "&":
+                        sources.add(adr)
+                    elif operand.adr_op is None and adr in pointers:
+                        sources |= taken[adr]
+                if not sources:
+                    continue
+                target = statement.target
+                if statement.kind == "expression" and target is not None and target.kind == "variable" \
+                        and target.adr_op is None and is_local(target, b):
+                    adr = resolve(target, b)
+                    if adr not in pointers or not sources <= taken[adr]:
+                        pointers.add(adr)
+                        taken[adr] = taken.get(adr, set()) | sources
+                        changed = True
+
+    escaping = set()
+    for b in fn_blocks:
+        for statement in b.code:
+            if isinstance(statement, IfStatement):
+                continue
+            sources = set()
+            for _, operand in statement.terms:
+                if operand.kind == "variable" and is_local(operand, b):
+                    adr = resolve(operand, b)
+                    if operand.adr_op == "&":
+                        sources.add(adr)
+                    elif operand.adr_op is None and adr in pointers:
+                        sources |= taken[adr]
+            if not sources:
+                continue
+            target = statement.target
+            kept_local = target is not None and target.kind == "variable" and target.adr_op is None \
+                and is_local(target, b)
+            if statement.kind == "return" or (target is not None and not kept_local):
+                escaping |= sources
+    return escaping
+
+def overlay_variables(blocks, registers=None, stats=None):
+    """Give the variables of functions that are never active at the same time the same memory rows.
+    Variable addresses in the symbol tables are rewritten, compile_program passes copies of
+    the parsed blocks. Return the new registers dict
+    (address -> register) for the moved variables."""
+    if registers is None:
+        registers = {}
+    if stats is None:
+        stats = {}
+    variables = variable_rows(blocks)
+    before = max((adr + rows for adr, rows, _, _ in variables), default=0)
+    stats["before"] = before
+    stats["after"] = before
+
+    functions = function_map(blocks)
+    owner = {adr: functions[b.block_id] for adr, _, b, _ in variables}
+
+    # Private variables keep a row of their own.
+    private = {adr for adr, fn in owner.items() if fn is None}
+    graph = call_graph(blocks, functions)
+    recursive = recursive_functions(graph)
+    function_blocks = {}
+    for b in blocks:
+        fn = functions[b.block_id]
+        if fn is not None:
+            function_blocks.setdefault(fn.block_id, []).append(b)
+        for statement in b.code:
+            operands, _ = all_operands(statement)
+            for operand, _ in operands:
+                if operand.kind == "constant" and operand.adr_op == "*" and operand.value < before:
+                    # The program reads or writes variable memory by address.
+                    stats["skipped"] = f"constant address {operand.value} in variable memory"
+                    return registers
+                if operand.kind == "variable":
+                    adr = resolve(operand, b)
+                    if adr is not None and owner.get(adr) is not fn:
+                        private.add(adr)
+    for fn in blocks:
+        if fn.block_type != "function":
+            continue
+        fn_blocks = function_blocks[fn.block_id]
+        if fn.block_id in recursive:
+            private |= {adr for b in fn_blocks for _, adr in b.variables.items()}
+            continue
+        flow = FunctionFlow(fn, fn_blocks, blocks, address_uses=False)
+        private |= flow.live_out()[flow.entry] - flow.defs[flow.entry]
+        private |= escaping_locals(fn, fn_blocks, owner)
+
+    # Lay out the private variables first, in their original order, then the frames.
+    mapping = {}
+    register_keys = 0
+    next_row = 0
+    frames = {} # Function block id -> [(address, position in frame)]
+    frame_size = {}
+    for adr, rows, b, name in variables:
+        if adr in registers:
+            register_keys += 1
+            mapping[adr] = -register_keys
+        elif adr in private:
+            mapping[adr] = next_row
+            next_row += rows
+        else:
+            fn_id = owner[adr].block_id
+            frames.setdefault(fn_id, []).append((adr, frame_size.get(fn_id, 0)))
+            frame_size[fn_id] = frame_size.get(fn_id, 0) + rows
+    base = next_row
+
+    # Frames start above the frames of all their callers. Callers come first in topological order.
+    callers = {}
+    for caller, callees in graph.items():
+        if caller in recursive:
+            continue
+        for callee in callees:
+            callers.setdefault(callee, set()).add(caller)
+    offset = {}
+    pending = {fn_id: len(callers.get(fn_id, ())) for fn_id in graph if fn_id not in recursive}
+    ready = [fn_id for fn_id, n in pending.items() if n == 0]
+    while ready:
+        fn_id = ready.pop()
+        offset[fn_id] = max((offset[c] + frame_size.get(c, 0) for c in callers.get(fn_id, ())), default=0)
+        for callee in graph[fn_id]:
+            if callee in pending:
+                pending[callee] -= 1
+                if pending[callee] == 0:
+                    ready.append(callee)
+
+    after = base
+    for fn_id, frame in frames.items():
+        for adr, position in frame:
+            mapping[adr] = base + offset[fn_id] + position
+        after = max(after, base + offset[fn_id] + frame_size[fn_id])
+
+    for b in blocks:
+        for name, adr in b.variables.items():
+            b.variables[name] = mapping[adr]
+    for b in blocks:
+        b.variables.clear_cache()
+    stats["after"] = after
+    stats["shared"] = sum(len(frame) for frame in frames.values())
+    return {mapping[adr]: reg for adr, reg in registers.items()}
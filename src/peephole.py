@@ -0,0 +1,132 @@
+from compiler_utils import JmpToPlaceholder, JmpBackPlaceholder, JmpRelPlaceholder, JmpOverPlaceholder, get_block
+
+# Peephole patterns run on the instructions of a single block before the blocks are placed in memory.
+# Each pattern returns the indices of the instructions it wants to remove.
+# Jump targets (labels) and placeholders are never removed.
+
+def is_placeholder(inst):
+    return isinstance(inst, (JmpToPlaceholder, JmpBackPlaceholder, JmpRelPlaceholder, JmpOverPlaceholder))
+
+def same_location(a, b):
+    """True if two instructions reference the same memory row or register directly."""
+    return a.m == b.m and a.data == b.data and a.m in (0, 4)
+
+def store_load(instructions, i):
+    """STORE x followed by LOAD x. The register already holds the value."""
+    a, b = instructions[i], instructions[i + 1]
+    if a.op == "STORE" and b.op == "LOAD" and a.grx == b.grx and same_location(a, b):
+        return [i + 1]
+
+def load_store(instructions, i):
+    """LOAD x followed by STORE x. The stored value is already in memory."""
+    a, b = instructions[i], instructions[i + 1]
+    if a.op == "LOAD" and b.op == "STORE" and a.grx == b.grx and same_location(a, b):
+        return [i + 1]
+
+def dead_load(instructions, i):
+    """LOAD r followed by another LOAD r that doesn't read r. The first value is never used."""
+    a, b = instructions[i], instructions[i + 1]
+    if a.op == "LOAD" and b.op == "LOAD" and a.grx == b.grx and not (b.m == 4 and b.data == b.grx):
+        return [i]
+
+def unreachable(instructions, i):
+    """Instructions after RET or HALT can only run if they are jumped to."""
+    if instructions[i].op in ("RET", "HALT"):
+        return [i + 1]
+
+PEEPHOLE_PATTERNS = {
+    "store_load": store_load,
+    "load_store": load_store,
+    "dead_load": dead_load,
+    "unreachable": unreachable,
+}
+
+# Passes run on all instructions of a block before the patterns. See value_numbering.py.
+BLOCK_PATTERNS = ["value_numbering"]
+
+# Patterns run on the linked program after insert_jumps.
+LINKED_PATTERNS = ["jump_thread"]
+
+def find_labels(instructions, blocks):
+    """Return the indices in a block that can be jumped to."""
+    labels = {0}
+    for idx, inst in enumerate(instructions):
+        if isinstance(inst, JmpToPlaceholder):
+            # Calls and if blocks return to the next instruction.
+            labels.add(idx + 1)
+            # While blocks jump back to the start of the condition.
+            target = get_block(inst.block_id, blocks)
+            if target.block_type == "while":
+                labels.add(idx - 2)
+        elif isinstance(inst, JmpOverPlaceholder):
+            # The block laid out after the jump continues at the next instruction.
+            labels.add(idx + 1)
+        elif isinstance(inst, JmpRelPlaceholder):
+            # Nothing between a relative jump and its target may be removed.
+            target = idx + inst.offset
+            labels.update(range(min(idx, target), max(idx, target) + 1))
+    return labels
+
+def remove_instructions(instructions, comments, removed):
+    """Remove the given indices. Comments of removed instructions move to the next kept instruction."""
+    kept = []
+    new_comments = {}
+    pending = []
+    for idx, inst in enumerate(instructions):
+        if idx in comments:
+            pending.append(comments[idx])
+        if idx in removed:
+            continue
+        if pending:
+            new_comments[len(kept)] = "; ".join(pending)
+            pending = []
+        kept.append(inst)
+    return kept, new_comments
+
+def peephole(instructions, comments, blocks, patterns=None, stats=None):
+    """Run peephole patterns on the instructions of a block until nothing changes.
+    Return the new instructions and comments. Removed instruction counts are added to stats per pattern."""
+    if patterns is None:
+        patterns = PEEPHOLE_PATTERNS.keys()
+    patterns = [p for p in patterns if p in PEEPHOLE_PATTERNS]
+    changed = True
+    while changed:
+        changed = False
+        labels = find_labels(instructions, blocks)
+        for name in patterns:
+            pattern = PEEPHOLE_PATTERNS[name]
+            removed = set()
+            for i in range(len(instructions) - 1):
+                if i in removed or is_placeholder(instructions[i]) or is_placeholder(instructions[i + 1]):
+                    continue
+                for r in pattern(instructions, i) or []:
+                    if r not in labels:
+                        removed.add(r)
+            if removed:
+                instructions, comments = remove_instructions(instructions, comments, removed)
+                if stats is not None:
+                    stats[name] = stats.get(name, 0) + len(removed)
+                changed = True
+                break
+    return instructions, comments
+
+def thread_jumps(instructions, stats=None):
+    """Retarget jumps that land on an unconditional JMP to the final destination.
+    Run after insert_jumps. The number of retargeted jumps is added to stats."""
+    count = 0
+    for inst in instructions:
+        if inst.op not in ("JMP", "JNE", "JGR") or inst.m != 1:
+            continue
+        target = inst.data
+        seen = set()
+        while target < len(instructions) and target not in seen:
+            t = instructions[target]
+            if t.op != "JMP" or t.m != 1:
+                break
+            seen.add(target)
+            target = t.data
+        if target != inst.data:
+            inst.data = target
+            count += 1
+    if stats is not None and count:
+        stats["jump_thread"] = stats.get("jump_thread", 0) + count
@@ -0,0 +1,106 @@
+import time, json, tracemalloc, contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Wall time and peak memory of the compiler phases, for --profile.
+#
+# Phases nest. A phase named "regalloc" started inside "compile" is reported as "compile/regalloc".
+# Memory is traced with tracemalloc. The peak of a phase is the highest memory in use while it ran,
+# minus the memory in use when it started, so it includes its nested phases.
+# Tracing makes Python slower. Compare the times with each other, not with builds without --profile.
+
+class Profiler():
+    """Records phases and compiled functions."""
+
+    def __init__(self):
+        self.phases = []
+        self.functions = []
+        # [path, start memory, highest peak seen] of the running phases.
+        self.running = []
+        self.highest = 0
+        self.start = time.perf_counter()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def peak(self):
+        """Return the peak since the last call and restart peak tracking from the current memory."""
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        self.highest = max(self.highest, peak)
+        return peak
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.running:
+            # The peak so far belongs to the enclosing phase.
+            parent = self.running[-1]
+            parent[2] = max(parent[2], self.peak())
+            path = f"{parent[0]}/{name}"
+        else:
+            path = name
+        current = tracemalloc.get_traced_memory()[0]
+        self.peak()
+        entry = [path, current, current]
+        self.running.append(entry)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.running.pop()
+            peak = max(entry[2], self.peak())
+            if self.running:
+                self.running[-1][2] = max(self.running[-1][2], peak)
+            self.phases.append({"name": path, "start": start - self.start, "seconds": seconds,
+                "peak_bytes": peak - entry[1]})
+
+    @contextlib.contextmanager
+    def function(self, unit):
+        """Record compiling a function and its if/while blocks.
+        Yields the record, the caller adds the number of instructions."""
+        name = unit[0].name or unit[0].block_type
+        record = {"name": name, "blocks": len(unit), "instructions": 0}
+        with self.phase(name):
+            yield record
+        timing = self.phases.pop()
+        record["seconds"] = timing["seconds"]
+        record["peak_bytes"] = timing["peak_bytes"]
+        self.functions.append(record)
+
+    def report(self):
+        """Return the profile as a dict that can be written as JSON."""
+        report = {
+            "seconds": time.perf_counter() - self.start,
+            "peak_bytes": max(self.highest, tracemalloc.get_traced_memory()[1]),
+            "phases": sorted(self.phases, key=lambda p: p["start"]),
+            "functions": sorted(self.functions, key=lambda f: -f["seconds"]),
+        }
+        if resource is not None:
+            # Kilobytes on Linux, bytes on macOS.
+            report["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return report
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+def phase(profiler, name):
+    """Return a context recording a phase, or one doing nothing if profiler is None."""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.phase(name)
+
+def format_profile(report, limit=10):
+    """Format the top level phases and the slowest functions as a table."""
+    lines = [f"{'Phase':24} {'seconds':>8} {'peak KiB':>10}"]
+    for p in report["phases"]:
+        if p["name"].count("/") <= 1:
+            lines.append(f"{p['name']:24} {p['seconds']:8.3f} {p['peak_bytes'] / 1024:10.1f}")
+    if report["functions"]:
+        lines.append(f"{'Function':24} {'seconds':>8} {'peak KiB':>10} {'instructions':>13}")
+        for f in report["functions"][:limit]:
+            lines.append(f"{f['name']:24} {f['seconds']:8.3f} {f['peak_bytes'] / 1024:10.1f} {f['instructions']:13}")
+    return "\n".join(lines)
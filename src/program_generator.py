@@ -0,0 +1,99 @@
+import sys, random
+
+# Usage:
+# python3 program_generator.py [output_file] [functions] [depth] [expression] [array] [fanout] [statements] [seed]
+#
+# Synthetic alang programs for benchmarks. Every size parameter can be scaled on its own:
+#   functions   number of functions besides main
+#   depth       nesting depth of if/while blocks in each function
+#   expression  number of terms in each expression
+#   array       rows of the arrays copied with memcpy
+#   fanout      number of functions called by each function
+#   statements  assignments in each block
+# Functions only call functions with a higher number, so programs don't recurse and all loops
+# have a constant trip count. The same parameters and seed give the same program.
+
+DEFAULT_SIZES = {"functions": 25, "depth": 2, "expression": 4, "array": 8, "fanout": 2, "statements": 3}
+
+OPS = ["+", "-", "*"]
+
+class ProgramGenerator():
+    """Builds the source of a synthetic program."""
+
+    def __init__(self, sizes=None, seed=0):
+        self.sizes = {**DEFAULT_SIZES, **(sizes or {})}
+        self.random = random.Random(seed)
+        self.lines = []
+
+    def emit(self, level, text):
+        self.lines.append("    " * level + text)
+
+    def expression(self, names):
+        terms = [self.random.choice(names + [str(self.random.randint(1, 99))])
+            for _ in range(self.sizes["expression"])]
+        text = terms[0]
+        for term in terms[1:]:
+            text += f" {self.random.choice(OPS)} {term}"
+        return text
+
+    def block(self, level, depth, names, callees):
+        """Emit the statements of a block and its nested block."""
+        for _ in range(self.sizes["statements"]):
+            self.emit(level, f"{self.random.choice(names[:3])} = {self.expression(names)};")
+        # Calls are spread over the nesting levels.
+        while callees and (depth == self.sizes["depth"] or self.random.random() < 0.5):
+            self.emit(level, f"{self.random.choice(names[:3])} = {callees.pop()}({self.random.choice(names)});")
+        if depth == self.sizes["depth"]:
+            return
+        if depth % 2:
+            self.emit(level, f"if ({names[0]} < {self.random.randint(1, 99)}) {{")
+            self.block(level + 1, depth + 1, names, callees)
+        else:
+            counter = f"i{depth}"
+            self.emit(level, f"int {counter};")
+            self.emit(level, f"{counter} = 0;")
+            self.emit(level, f"while ({counter} < {self.random.randint(2, 5)}) {{")
+            self.block(level + 1, depth + 1, [*names, counter], callees)
+            self.emit(level + 1, f"{counter} = {counter} + 1;")
+        self.emit(level, "}")
+
+    def function(self, idx):
+        n = self.sizes["functions"]
+        later = list(range(idx + 1, n))
+        callees = [f"f{k}" for k in self.random.sample(later, min(self.sizes["fanout"], len(later)))]
+        self.emit(0, f"function f{idx}(x) {{")
+        self.emit(1, "int a;")
+        self.emit(1, "int b;")
+        self.emit(1, f"int t[{self.sizes['array']}];")
+        self.emit(1, "a = x;")
+        self.emit(1, "b = x + 1;")
+        self.emit(1, f"memcpy(&t, &data, {self.sizes['array']});")
+        self.block(1, 0, ["a", "b", "x"], callees)
+        self.emit(1, "return a;")
+        self.emit(0, "}")
+
+    def generate(self):
+        """Return the program source."""
+        self.lines = []
+        self.emit(0, f"int data[{self.sizes['array']}];")
+        self.emit(0, "function main() {")
+        self.emit(1, "int r;")
+        for k in range(min(self.sizes["fanout"], self.sizes["functions"])):
+            self.emit(1, f"r = f{k}({k});")
+        self.emit(1, "*1000 = r;")
+        self.emit(1, "halt;")
+        self.emit(0, "}")
+        for idx in range(self.sizes["functions"]):
+            self.function(idx)
+        return "\n".join(self.lines) + "\n"
+
+def generate_program(sizes=None, seed=0):
+    """Return the source of a synthetic program. sizes overrides DEFAULT_SIZES."""
+    return ProgramGenerator(sizes, seed).generate()
+
+if __name__ == "__main__":
+    names = ["functions", "depth", "expression", "array", "fanout", "statements"]
+    sizes = {name: int(value) for name, value in zip(names, sys.argv[2:8])}
+    seed = int(sys.argv[8]) if len(sys.argv) > 8 else 0
+    with open(sys.argv[1], "w") as f:
+        f.write(generate_program(sizes, seed))
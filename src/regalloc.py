@@ -0,0 +1,276 @@
+from alang_parser import IfStatement
+from compiler_utils import deref_variable, CompilationError
+
+# GR0 is the accumulator, GR1 holds return values, GR30 reads the time and GR31 is the index register.
+ALLOCATABLE_REGISTERS = list(range(2, 30))
+
+def loop_depth(block, blocks):
+    """Return the number of while loops surrounding a block within its function."""
+    depth = 0
+    while block.block_type not in ("function", "global"):
+        if block.block_type == "while":
+            depth += 1
+        block = blocks.get(block.parent_block)
+    return depth
+
+def all_operands(statement):
+    """Return every non call operand of a statement as (operand, is_def) and the called function names."""
+    refs = []
+    calls = []
+    if isinstance(statement, IfStatement):
+        refs += [(statement.lhs, False), (statement.rhs, False)]
+    else:
+        for _, operand in statement.terms:
+            if operand.kind == "call":
+                calls.append(operand.value)
+                refs += [(p, False) for p in operand.params]
+            else:
+                refs.append((operand, False))
+        if statement.target:
+            refs.append((statement.target, statement.target.adr_op is None))
+    return refs, calls
+
+def statement_operands(statement):
+    """Return the variable operands of a statement as (operand, is_def) and the called function names."""
+    refs, calls = all_operands(statement)
+    return [(o, d) for o, d in refs if o.kind == "variable"], calls
+
+def resolve(operand, block):
+    try:
+        return deref_variable(None, operand.value, block.variables)[1]
+    except CompilationError:
+        # Reported when the block is compiled.
+        return None
+
+class FunctionFlow():
+    """Statement level control flow graph of a function and its if/while blocks."""
+    __slots__ = ("function", "blocks", "nodes", "entry", "exit", "succ", "uses", "defs", "parents")
+
+    def __init__(self, function, function_blocks, blocks, address_uses=True):
+        """address_uses: count taking the address of a variable (&x) as a use of it."""
+        self.function = function
+        self.blocks = function_blocks
+        self.nodes = {} # (block_id, statement index) -> node
+        self.parents = {} # block_id of if/while block -> (parent block, statement index)
+        for b in self.blocks:
+            for idx, statement in enumerate(b.code):
+                self.nodes[(b.block_id, idx)] = len(self.nodes)
+                if isinstance(statement, IfStatement):
+                    self.parents[statement.target_block] = (b, idx)
+        # Node 0..n-1 are statements, n is the function entry and n+1 the exit.
+        self.entry = len(self.nodes)
+        self.exit = len(self.nodes) + 1
+        size = len(self.nodes) + 2
+        self.succ = [set() for _ in range(size)]
+        self.uses = [set() for _ in range(size)]
+        self.defs = [set() for _ in range(size)]
+
+        self.defs[self.entry] = {deref_variable(None, p, function.variables)[1] for p in function.parameters}
+        self.succ[self.entry].add(self.follow(function, 0))
+        # Local variables keep their value until the next call.
+        self.succ[self.exit].add(self.entry)
+
+        for b in self.blocks:
+            for idx, statement in enumerate(b.code):
+                n = self.nodes[(b.block_id, idx)]
+                for operand, is_def in statement_operands(statement)[0]:
+                    if not address_uses and operand.adr_op == "&":
+                        continue
+                    adr = resolve(operand, b)
+                    if adr is not None:
+                        (self.defs if is_def else self.uses)[n].add(adr)
+                if statement.kind in ("return", "halt"):
+                    self.succ[n].add(self.exit)
+                    continue
+                if isinstance(statement, IfStatement):
+                    self.succ[n].add(self.follow(blocks.get(statement.target_block), 0))
+                self.succ[n].add(self.follow(b, idx + 1))
+
+    def follow(self, block, idx):
+        """Return the node that runs at statement idx of block, or when leaving the block."""
+        if idx < len(block.code):
+            return self.nodes[(block.block_id, idx)]
+        if block is self.function:
+            return self.exit
+        parent, parent_idx = self.parents[block.block_id]
+        if block.block_type == "while":
+            return self.nodes[(parent.block_id, parent_idx)]
+        return self.follow(parent, parent_idx + 1)
+
+    def live_out(self):
+        """Backwards liveness analysis. Return the set of live variables after each node."""
+        size = len(self.succ)
+        live_in = [set() for _ in range(size)]
+        live_out = [set() for _ in range(size)]
+        changed = True
+        while changed:
+            changed = False
+            for n in reversed(range(size)):
+                out = set()
+                for s in self.succ[n]:
+                    out |= live_in[s]
+                new_in = self.uses[n] | (out - self.defs[n])
+                if new_in != live_in[n] or out != live_out[n]:
+                    live_in[n] = new_in
+                    live_out[n] = out
+                    changed = True
+        return live_out
+
+def function_map(blocks):
+    """Return a dict mapping every block id to the function block it belongs to."""
+    functions = {}
+    for b in blocks:
+        # Parents come before their children in the block list.
+        if b.block_type in ("function", "global"):
+            functions[b.block_id] = b if b.block_type == "function" else None
+        else:
+            functions[b.block_id] = functions[b.parent_block]
+    return functions
+
+def call_graph(blocks, functions=None):
+    """Return the set of functions directly called by each function block id."""
+    if functions is None:
+        functions = function_map(blocks)
+    graph = {}
+    for b in blocks:
+        fn = functions[b.block_id]
+        if fn is None:
+            continue
+        callees = graph.setdefault(fn.block_id, set())
+        for statement in b.code:
+            for name in statement_operands(statement)[1]:
+                if name in b.functions:
+                    callees.add(b.functions[name])
+    return graph
+
+def recursive_functions(graph):
+    """Return the ids of functions that can call themselves, directly or through other functions.
+    Uses Tarjan's strongly connected components algorithm."""
+    index = {}
+    low = {}
+    on_stack = set()
+    stack = []
+    recursive = set()
+    counter = 0
+    for root in graph:
+        if root in index:
+            continue
+        work = [(root, iter(graph.get(root, ())))]
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, callees = work[-1]
+            for callee in callees:
+                if callee not in index:
+                    index[callee] = low[callee] = counter
+                    counter += 1
+                    stack.append(callee)
+                    on_stack.add(callee)
+                    work.append((callee, iter(graph.get(callee, ()))))
+                    break
+                if callee in on_stack:
+                    low[node] = min(low[node], index[callee])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        f = stack.pop()
+                        on_stack.discard(f)
+                        component.append(f)
+                        if f == node:
+                            break
+                    if len(component) > 1 or node in graph.get(node, ()):
+                        recursive.update(component)
+    return recursive
+
+def allocate_registers(blocks, registers=None, stats=None):
+    """Assign the hottest local variables to general registers.
+    Return a dict mapping variable address to register index."""
+    if registers is None:
+        registers = ALLOCATABLE_REGISTERS
+    functions = function_map(blocks)
+    owner = {}
+    function_blocks = {}
+    for b in blocks:
+        fn = functions[b.block_id]
+        for _, adr in b.variables.items():
+            owner[adr] = fn
+        if fn is not None:
+            function_blocks.setdefault(fn.block_id, []).append(b)
+
+    # Variables that can't live in a register: address taken, dereferenced,
+    # accessed from another function or aliased by a constant address.
+    excluded = set()
+    weight = {}
+    for b in blocks:
+        fn = functions[b.block_id]
+        depth = loop_depth(b, blocks)
+        for statement in b.code:
+            operands, _ = all_operands(statement)
+            for operand, _ in operands:
+                if operand.kind == "constant" and operand.adr_op == "*":
+                    excluded.add(operand.value)
+                if operand.kind != "variable":
+                    continue
+                adr = resolve(operand, b)
+                if adr is None:
+                    continue
+                if operand.adr_op or owner.get(adr) is not fn:
+                    excluded.add(adr)
+                weight[adr] = weight.get(adr, 0) + 10 ** min(depth, 6)
+
+    # Interference between variables of the same function.
+    recursive = recursive_functions(call_graph(blocks, functions))
+    interference = {}
+    for fn in blocks:
+        if fn.block_type != "function":
+            continue
+        flow = FunctionFlow(fn, function_blocks[fn.block_id], blocks)
+        local = {adr for b in flow.blocks for _, adr in b.variables.items()}
+        if fn.block_id in recursive:
+            # Recursive calls overwrite locals through the callee. Don't share registers.
+            for adr in local:
+                interference[adr] = local - {adr}
+            continue
+        for adr in local:
+            interference[adr] = set()
+        live_out = flow.live_out()
+        for n in range(len(live_out)):
+            defs = flow.defs[n]
+            if n == flow.entry:
+                live = live_out[n] | defs
+            else:
+                live = live_out[n]
+            for d in defs:
+                for l in live:
+                    if l != d and d in interference and l in interference:
+                        interference[d].add(l)
+                        interference[l].add(d)
+
+    # Greedy allocation, hottest variables first. Each function gets its own registers
+    # since callers keep their registers live during calls.
+    allocation = {}
+    function_registers = {}
+    free = list(registers)
+    candidates = [adr for adr in weight if adr not in excluded and adr in interference]
+    candidates.sort(key=lambda adr: (-weight[adr], adr))
+    for adr in candidates:
+        fn = owner[adr]
+        own = function_registers.setdefault(fn.block_id, [])
+        taken = {allocation[a] for a in interference[adr] if a in allocation}
+        reg = next((r for r in own if r not in taken), None)
+        if reg is None and free:
+            reg = free.pop(0)
+            own.append(reg)
+        if reg is not None:
+            allocation[adr] = reg
+    if stats is not None:
+        stats["variables"] = len(allocation)
+        stats["registers"] = len(registers) - len(free)
+    return allocation
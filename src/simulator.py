@@ -0,0 +1,323 @@
+import sys
+from assembler import INSTRUCTION_MAP, ADDRESS_MODES
+from machine_image import load_machine_code
+
+# Usage:
+# python3 simulator.py [machine_code_file] [max_steps]
+#
+# Machine model:
+# 32 general registers of 32 bits. GR30 reads the cycle counter (time).
+# IDX addresses memory at data + GR31.
+# CMP sets the flags from GRx - operand. JNE jumps if they differ, JGR jumps if the operand is greater (signed).
+# The stack is separate from data memory. RET with an empty stack ends the program like HALT.
+
+OP_NAMES = {v: k for k, v in INSTRUCTION_MAP.items()}
+MODE_NAMES = {v: k for k, v in ADDRESS_MODES.items()}
+
+WORD_MASK = 0xFFFFFFFF
+TIME_REGISTER = 30
+INDEX_REGISTER = 31
+
+# Cycles per instruction. Operand access and taken jumps add to the base cost.
+CYCLE_TABLE = {
+    "ops": {
+        "NOP": 1, "LOAD": 2, "STORE": 2, "JMP": 2, "ADD": 2, "SUB": 2, "MUL": 4, "JNE": 2, "CMP": 2,
+        "AND": 2, "OR": 2, "HALT": 1, "CALL": 3, "RET": 3, "PUSH": 3, "POP": 3, "LSR": 2, "LSL": 2, "JGR": 2,
+    },
+    "modes": {"DIR": 1, "IM": 0, "IND": 2, "IDX": 1, "REG": 0},
+    "jump_taken": 1,
+}
+
+# Instructions that use the address mode and data field.
+OPERAND_OPS = {"LOAD", "STORE", "JMP", "ADD", "SUB", "MUL", "JNE", "CMP", "AND", "OR", "CALL", "LSR", "LSL", "JGR"}
+JUMP_OPS = {"JMP", "JNE", "JGR", "CALL"}
+# Memory rows read to get the operand of each address mode.
+MODE_READS = {"DIR": 1, "IM": 0, "IND": 2, "IDX": 1, "REG": 0}
+STACK_OPS = {"PUSH", "POP", "CALL", "RET"}
+
+class SimulatorError(Exception): pass
+
+def instruction_cycles(op, m, cycle_table=CYCLE_TABLE):
+    """Cycles of an instruction, not counting taken jumps."""
+    cycles = cycle_table["ops"].get(op, 1)
+    if op in OPERAND_OPS:
+        cycles += cycle_table["modes"].get(MODE_NAMES.get(m), 0)
+    return cycles
+
+def decode_word(word):
+    """Split a 33 bit machine word into (op, grx, m, data)."""
+    return word >> 28, (word >> 23) & 0b11111, (word >> 20) & 0b111, word & 0xFFFFF
+
+def load_program(program):
+    """Return a list of (op name, grx, m, data) from machine code text, machine words, a MachineImage
+    or Instruction objects."""
+    if isinstance(program, str):
+        program = [int(line, 2) for line in program.split()]
+    decoded = []
+    for inst in program:
+        if isinstance(inst, int):
+            op, grx, m, data = decode_word(inst)
+            if op not in OP_NAMES:
+                raise SimulatorError(f"Invalid instruction {op}.")
+            decoded.append((OP_NAMES[op], grx, m, data))
+        else:
+            decoded.append((inst.op, inst.grx, inst.m, inst.data))
+    return decoded
+
+def signed(value):
+    return value - (1 << 32) if value & 0x80000000 else value
+
+class Simulator():
+    """Executes a program instruction by instruction and counts cycles, memory accesses and stack use."""
+
+    def __init__(self, program, memory=None, memory_size=1 << 20, cycle_table=None, entry=0):
+        self.program = load_program(program)
+        self.cycle_table = cycle_table or CYCLE_TABLE
+        if memory_size & (memory_size - 1):
+            raise SimulatorError("Memory size must be a power of two.")
+        self.memory_size = memory_size
+        self.mem = [0] * memory_size
+        if memory:
+            for adr, value in memory.items():
+                self.mem[adr] = value & WORD_MASK
+        self.regs = [0] * 32
+        self.flags = [False, False] # Zero, negative
+        self.stack = []
+        self.clock = [0]
+        self.pc = entry
+        self.halted = False
+        self.steps = 0
+        self.max_stack_depth = 0
+        self.counts = [0] * len(self.program)
+        self.taken = [0] * len(self.program)
+        self.code = [self.decode(idx, *inst) for idx, inst in enumerate(self.program)]
+        self.costs = [instruction_cycles(op, m, self.cycle_table) for op, grx, m, data in self.program]
+
+    def reader(self, m, d):
+        """Return a function reading the operand of an address mode."""
+        mem, regs, clock, mask = self.mem, self.regs, self.clock, self.memory_size - 1
+        if m == 0:
+            return lambda: mem[d & mask]
+        if m == 1:
+            return lambda: d
+        if m == 2:
+            return lambda: mem[mem[d & mask] & mask]
+        if m == 3:
+            return lambda: mem[(d + regs[INDEX_REGISTER]) & mask]
+        if m == 4:
+            if d == TIME_REGISTER:
+                return lambda: clock[0] & WORD_MASK
+            r = d & 0b11111
+            return lambda: regs[r]
+        raise SimulatorError(f"Invalid address mode {m}.")
+
+    def writer(self, m, d):
+        """Return a function writing a value to the destination of an address mode."""
+        mem, regs, mask = self.mem, self.regs, self.memory_size - 1
+        if m == 0:
+            def write(v): mem[d & mask] = v
+        elif m == 2:
+            def write(v): mem[mem[d & mask] & mask] = v
+        elif m == 3:
+            def write(v): mem[(d + regs[INDEX_REGISTER]) & mask] = v
+        elif m == 4:
+            r = d & 0b11111
+            def write(v): regs[r] = v
+        else:
+            raise SimulatorError(f"Invalid address mode {m} for STORE.")
+        return write
+
+    def decode(self, idx, op, g, m, d):
+        """Predecode an instruction to a function that executes it and returns the next pc, or -1 to stop."""
+        if op not in DISPATCH:
+            raise SimulatorError(f"Invalid instruction {op} at {idx}.")
+        read = self.reader(m, d) if op in OPERAND_OPS and op != "STORE" else None
+        return DISPATCH[op](self, idx, g, m, d, read)
+
+    def run(self, max_steps=None):
+        """Run until HALT, a return from the entry function or max_steps. Return the statistics."""
+        code, costs, counts, clock = self.code, self.costs, self.counts, self.clock
+        pc = self.pc
+        steps = 0
+        limit = max_steps if max_steps is not None else -1
+        size = len(code)
+        while steps != limit:
+            if not 0 <= pc < size:
+                raise SimulatorError(f"Program counter outside of program: {pc}")
+            counts[pc] += 1
+            clock[0] += costs[pc]
+            pc = code[pc](pc)
+            steps += 1
+            if pc < 0:
+                self.halted = True
+                break
+        self.pc = pc
+        self.steps += steps
+        return self.stats()
+
+    def stats(self):
+        """Return instruction counts, cycles per opcode, memory accesses and stack depth."""
+        per_op = {}
+        reads = writes = stack = 0
+        jump_taken = self.cycle_table["jump_taken"]
+        for idx, (op, grx, m, data) in enumerate(self.program):
+            n = self.counts[idx]
+            if not n:
+                continue
+            entry = per_op.setdefault(op, {"count": 0, "cycles": 0})
+            entry["count"] += n
+            entry["cycles"] += n * self.costs[idx] + self.taken[idx] * jump_taken
+            mode = MODE_NAMES.get(m)
+            if op == "STORE":
+                if mode != "REG":
+                    writes += n
+                # Indirect stores read the pointer.
+                if mode == "IND":
+                    reads += n
+            elif op in OPERAND_OPS and op not in JUMP_OPS:
+                reads += n * MODE_READS.get(mode, 0)
+            if op in STACK_OPS:
+                stack += n
+        return {
+            "instructions": self.steps,
+            "cycles": self.clock[0],
+            "halted": self.halted,
+            "per_opcode": per_op,
+            "memory_reads": reads,
+            "memory_writes": writes,
+            "stack_accesses": stack,
+            "max_stack_depth": self.max_stack_depth,
+            "jumps_taken": sum(self.taken),
+        }
+
+# Handler factories. Each returns a function executing one decoded instruction.
+
+def op_nop(sim, idx, g, m, d, read):
+    return lambda pc: pc + 1
+
+def op_halt(sim, idx, g, m, d, read):
+    return lambda pc: -1
+
+def op_load(sim, idx, g, m, d, read):
+    regs = sim.regs
+    def load(pc):
+        regs[g] = read()
+        return pc + 1
+    return load
+
+def op_store(sim, idx, g, m, d, read):
+    regs, write = sim.regs, sim.writer(m, d)
+    def store(pc):
+        write(regs[g])
+        return pc + 1
+    return store
+
+def alu(fn):
+    def factory(sim, idx, g, m, d, read):
+        regs = sim.regs
+        def execute(pc):
+            regs[g] = fn(regs[g], read()) & WORD_MASK
+            return pc + 1
+        return execute
+    return factory
+
+def op_cmp(sim, idx, g, m, d, read):
+    regs, flags = sim.regs, sim.flags
+    def cmp(pc):
+        a, b = regs[g], read()
+        flags[0] = a == b
+        flags[1] = signed(a) < signed(b)
+        return pc + 1
+    return cmp
+
+def jump(condition):
+    def factory(sim, idx, g, m, d, read):
+        flags, taken, clock, extra = sim.flags, sim.taken, sim.clock, sim.cycle_table["jump_taken"]
+        def execute(pc):
+            if condition(flags):
+                taken[pc] += 1
+                clock[0] += extra
+                return read()
+            return pc + 1
+        return execute
+    return factory
+
+def op_call(sim, idx, g, m, d, read):
+    stack, taken, clock, extra = sim.stack, sim.taken, sim.clock, sim.cycle_table["jump_taken"]
+    def call(pc):
+        stack.append(pc + 1)
+        if len(stack) > sim.max_stack_depth:
+            sim.max_stack_depth = len(stack)
+        taken[pc] += 1
+        clock[0] += extra
+        return read()
+    return call
+
+def op_ret(sim, idx, g, m, d, read):
+    stack = sim.stack
+    def ret(pc):
+        if not stack:
+            # Returning from the entry function ends the program.
+            return -1
+        return stack.pop()
+    return ret
+
+def op_push(sim, idx, g, m, d, read):
+    stack, regs = sim.stack, sim.regs
+    def push(pc):
+        stack.append(regs[g])
+        if len(stack) > sim.max_stack_depth:
+            sim.max_stack_depth = len(stack)
+        return pc + 1
+    return push
+
+def op_pop(sim, idx, g, m, d, read):
+    stack, regs = sim.stack, sim.regs
+    def pop(pc):
+        if not stack:
+            raise SimulatorError(f"POP from empty stack at {pc}.")
+        regs[g] = stack.pop()
+        return pc + 1
+    return pop
+
+DISPATCH = {
+    "NOP": op_nop,
+    "LOAD": op_load,
+    "STORE": op_store,
+    "JMP": jump(lambda flags: True),
+    "ADD": alu(lambda a, b: a + b),
+    "SUB": alu(lambda a, b: a - b),
+    "MUL": alu(lambda a, b: a * b),
+    "JNE": jump(lambda flags: not flags[0]),
+    "CMP": op_cmp,
+    "AND": alu(lambda a, b: a & b),
+    "OR": alu(lambda a, b: a | b),
+    "HALT": op_halt,
+    "CALL": op_call,
+    "RET": op_ret,
+    "PUSH": op_push,
+    "POP": op_pop,
+    "LSR": alu(lambda a, b: a >> (b & 31)),
+    "LSL": alu(lambda a, b: a << (b & 31)),
+    "JGR": jump(lambda flags: flags[1]),
+}
+
+def format_stats(stats):
+    """Format simulator statistics as a table."""
+    lines = [
+        f"Instructions: {stats['instructions']}",
+        f"Cycles: {stats['cycles']}",
+        f"Memory reads: {stats['memory_reads']}, writes: {stats['memory_writes']}, stack: {stats['stack_accesses']}",
+        f"Max stack depth: {stats['max_stack_depth']}",
+        f"Jumps taken: {stats['jumps_taken']}",
+        "Opcode  count  cycles",
+    ]
+    for op, entry in sorted(stats["per_opcode"].items(), key=lambda x: -x[1]["cycles"]):
+        lines.append(f"{op:6} {entry['count']:6} {entry['cycles']:7}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    program = load_machine_code(sys.argv[1])
+    sim = Simulator(program, entry=getattr(program, "entry", 0))
+    max_steps = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    print(format_stats(sim.run(max_steps)))
@@ -0,0 +1,186 @@
+from compiler_utils import Instruction, INDEX_REGISTER
+from peephole import is_placeholder, find_labels, remove_instructions
+
+# Local value numbering of the instructions of a block, across the statements of each basic block.
+#
+# Every value read or computed in a basic block gets a number. Equal numbers are equal values:
+# the same constant, a row or register that hasn't been written since, or the same operation on
+# the same values. With the numbers of what each register and memory row holds:
+#   - a LOAD of a value the register already holds is dropped,
+#   - a STORE of a value the location already holds is dropped,
+#   - memory operands whose value is held in a register are read from the register instead,
+#   - a LOAD followed by operations on the same register computing a value that is already held
+#     elsewhere is replaced by a LOAD of it, or dropped if the register held it before.
+#
+# Basic blocks end at labels, jumps, calls and placeholders, where nothing is known.
+# Stores through pointers or the index register may write any row. They forget every memory row,
+# direct stores forget every row read through a pointer. GR30 reads the time and never holds a value.
+
+TIME_REGISTER = 30
+
+DIR, IM, IND, IDX, REG = 0, 1, 2, 3, 4
+
+ALU_OPS = {"ADD", "SUB", "MUL", "AND", "OR", "LSL", "LSR"}
+COMMUTATIVE_OPS = {"ADD", "MUL", "AND", "OR"}
+# Instructions reading the value of their operand.
+READ_OPS = ALU_OPS | {"LOAD", "CMP"}
+CONTROL_OPS = {"JMP", "JNE", "JGR", "CALL", "RET", "HALT"}
+
+class ValueTable():
+    """Value numbers of the registers and memory rows in a basic block."""
+    __slots__ = ("registers", "memory", "indirect", "expressions", "count")
+
+    def __init__(self):
+        # Register index -> value number.
+        self.registers = {}
+        # Address -> value number of rows accessed directly.
+        self.memory = {}
+        # ("ptr", pointer value) or ("idx", data, index value) -> value number of rows accessed indirectly.
+        self.indirect = {}
+        # Constants and operations on value numbers -> value number.
+        self.expressions = {}
+        self.count = 0
+
+    def new(self):
+        self.count += 1
+        return self.count
+
+    def lookup(self, table, key):
+        if key not in table:
+            table[key] = self.new()
+        return table[key]
+
+    def register(self, r):
+        if r == TIME_REGISTER:
+            return self.new()
+        return self.lookup(self.registers, r)
+
+    def expression(self, op, a, b):
+        if op in COMMUTATIVE_OPS and b < a:
+            a, b = b, a
+        return self.lookup(self.expressions, (op, a, b))
+
+    def location(self, m, data):
+        """Return (table, key) of the location an operand reads or a STORE writes."""
+        if m == DIR:
+            return self.memory, data
+        if m == REG:
+            return self.registers, data
+        if m == IND:
+            return self.indirect, ("ptr", self.lookup(self.memory, data))
+        if m == IDX:
+            return self.indirect, ("idx", data, self.register(INDEX_REGISTER))
+        return None, None
+
+    def operand(self, m, data):
+        """Value number of an operand."""
+        if m == IM:
+            return self.lookup(self.expressions, ("const", data))
+        if m == REG and data == TIME_REGISTER:
+            return self.new()
+        table, key = self.location(m, data)
+        if table is None:
+            return self.new()
+        return self.lookup(table, key)
+
+    def write(self, m, data, value):
+        """Record a STORE of a value to an operand location and forget the rows it may overwrite."""
+        table, key = self.location(m, data)
+        if table is self.memory:
+            self.indirect.clear()
+        elif table is self.indirect:
+            self.memory.clear()
+            self.indirect.clear()
+        elif table is None or key == TIME_REGISTER:
+            return
+        table[key] = value
+
+    def holder(self, value, exclude=None):
+        """Return the lowest register holding a value, or None."""
+        found = [r for r, v in self.registers.items() if v == value and r != exclude and r != TIME_REGISTER]
+        return min(found) if found else None
+
+    def row(self, value):
+        """Return the lowest directly accessed row holding a value, or None."""
+        found = [adr for adr, v in self.memory.items() if v == value]
+        return min(found) if found else None
+
+def number_values(instructions, comments, blocks, stats=None):
+    """Remove redundant loads, stores and recomputations in the basic blocks of a block's instructions.
+    Return the new instructions and comments. The removed instructions and the memory operands read
+    from registers instead are added to stats as value_numbering and value_reuse."""
+    labels = find_labels(instructions, blocks)
+    result = list(instructions)
+    removed = set()
+    reused = 0
+    table = ValueTable()
+    # (register, index of the LOAD starting it, value the register held before) of the instructions
+    # computing the value of the last loaded register, or None.
+    chain = None
+    for idx, inst in enumerate(instructions):
+        if idx in labels:
+            table = ValueTable()
+            chain = None
+        if is_placeholder(inst) or inst.op in CONTROL_OPS:
+            table = ValueTable()
+            chain = None
+            continue
+        op, r = inst.op, inst.grx
+
+        value = None
+        if op in READ_OPS:
+            value = table.operand(inst.m, inst.data)
+            if inst.m in (DIR, IND, IDX) and (holder := table.holder(value)) is not None:
+                inst = result[idx] = Instruction(op, r, REG, holder)
+                reused += 1
+
+        if op == "LOAD":
+            before = table.register(r)
+            if before == value:
+                removed.add(idx)
+                chain = None
+                continue
+            table.registers[r] = value
+            chain = (r, idx, before)
+        elif op in ALU_OPS:
+            value = table.expression(op, table.register(r), value)
+            table.registers[r] = value
+            if chain is None or chain[0] != r:
+                chain = None
+                continue
+            start, before = chain[1], chain[2]
+            if value == before:
+                # The register held the value before it was loaded.
+                removed.update(range(start, idx + 1))
+                chain = None
+            elif (holder := table.holder(value, exclude=r)) is not None:
+                result[start] = Instruction("LOAD", r, REG, holder)
+                removed.update(range(start + 1, idx + 1))
+            elif (adr := table.row(value)) is not None:
+                result[start] = Instruction("LOAD", r, DIR, adr)
+                removed.update(range(start + 1, idx + 1))
+        elif op == "STORE":
+            chain = None
+            value = table.register(r)
+            target, key = table.location(inst.m, inst.data)
+            if target is not None and target.get(key) == value:
+                removed.add(idx)
+                continue
+            table.write(inst.m, inst.data, value)
+        elif op == "POP":
+            chain = None
+            table.registers[r] = table.new()
+        elif op in ("CMP", "PUSH", "NOP"):
+            chain = None
+        else:
+            table = ValueTable()
+            chain = None
+
+    if stats is not None:
+        if removed:
+            stats["value_numbering"] = stats.get("value_numbering", 0) + len(removed)
+        if reused:
+            stats["value_reuse"] = stats.get("value_reuse", 0) + reused
+    if not removed:
+        return result, comments
+    return remove_instructions(result, comments, removed)
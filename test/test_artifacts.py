@@ -0,0 +1,32 @@
+import os, sys
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), "..", "src"))
+from alang_parser import parse_file
+from alang_compiler import compile_program
+from artifacts import output_files
+from machine_image import parse_header
+from simulator import Simulator
+
+SOURCE = """function two() {
+    return 2;
+}
+
+function main() {
+    int x;
+    x = two();
+    *1000 = x + 1;
+    halt;
+}
+"""
+
+def test_image_entry_is_main(tmp_path):
+    """A function declared before main mustn't be where the program starts."""
+    path = tmp_path / "entry.alang"
+    path.write_text(SOURCE)
+    program = compile_program(parse_file(str(path)))
+    data = output_files(program, binary=True)["machine_code.bin"]
+    count, entry = parse_header(data)
+    assert count == len(program.words())
+    assert entry == program.entry != 0
+    sim = Simulator(program.words(), entry=entry)
+    sim.run()
+    assert sim.mem[1000] == 3
@@ -0,0 +1,76 @@
+import os, sys, threading
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), "..", "src"))
+import compile_server
+from alang_parser import parse_file
+from alang_compiler import compile_program
+from artifacts import output_files
+from compile_server import CompileServer, request
+from machine_image import MachineImage
+from program_generator import generate_program
+
+SOURCE = """function main() {
+    *1000 = 1;
+    halt;
+}
+"""
+
+def crashing_parse(parse_file):
+    """Return a parse_file failing with an exception the compiler doesn't handle for files named bad."""
+    def parse(path, profiler=None):
+        if os.path.basename(path).startswith("bad"):
+            raise IndexError("list index out of range")
+        return parse_file(path, profiler)
+    return parse
+
+def test_compiler_crash_does_not_stop_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(compile_server, "parse_file", crashing_parse(compile_server.parse_file))
+    good, bad = tmp_path / "good.alang", tmp_path / "bad.alang"
+    good.write_text(SOURCE)
+    bad.write_text(SOURCE)
+    address = str(tmp_path / "server.sock")
+    server = CompileServer({}, output_dir=str(tmp_path / "output"))
+    thread = threading.Thread(target=server.serve, args=(address,))
+    thread.start()
+    try:
+        while not os.path.exists(address):
+            pass
+        response = request("build", address, file=str(bad))
+        assert not response["ok"]
+        assert response["error"] == "IndexError: list index out of range"
+        assert request("build", address, file=str(good))["ok"]
+        assert request("status", address)["builds"] == 1
+    finally:
+        request("stop", address)
+        thread.join()
+
+def test_watch_survives_truncated_save(tmp_path, capsys):
+    path = tmp_path / "program.alang"
+    path.write_text(SOURCE)
+    server = CompileServer({}, output_dir=str(tmp_path / "output"), watch=True)
+    assert server.build(str(path))["ok"]
+    path.write_text("function main() {")
+    os.utime(path, ns=(1, 1))
+    server.poll()
+    assert capsys.readouterr().out.startswith(f"Rebuilt {path}: failed\n")
+    path.write_text(SOURCE)
+    os.utime(path, ns=(2, 2))
+    server.poll()
+    assert capsys.readouterr().out.startswith(f"Rebuilt {path}: ok")
+
+def test_server_build_matches_serial(tmp_path):
+    """Server builds, also after an edit rebuilds one function from memory, write what a one-shot build writes."""
+    source = generate_program({"functions": 6, "depth": 2}, 5)
+    end = source.rindex("return a;")
+    edited = source[:end] + "return b;" + source[end + len("return a;"):]
+    path = tmp_path / "program.alang"
+    output = tmp_path / "output"
+    server = CompileServer({}, binary=True, output_dir=str(output))
+    for text in (source, edited):
+        path.write_text(text)
+        assert server.build(str(path))["ok"]
+        program = compile_program(parse_file(str(path)))
+        files = output_files(program, binary=True)
+        assert {name: (output / name).read_bytes() for name in files} == files
+        with MachineImage(str(output / "machine_code.bin")) as image:
+            assert list(image) == program.words()
+            assert image.entry == program.entry
@@ -0,0 +1,114 @@
+import os, sys, json, glob
+import pytest
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), "..", "src"))
+from alang_parser import parse_file, to_serializable
+from alang_compiler import compile_program
+from build_cache import BuildCache
+from program_generator import generate_program
+
+TEST_DIR = os.path.dirname(__file__)
+
+# Programs whose loops are unrolled, blocks removed as dead code and constants folded.
+SOURCES = {
+    "loops": """function main() {
+    int i;
+    int j;
+    int s;
+    s = 0;
+    i = 0;
+    while (i < 8) {
+        s = s + i;
+        i = i + 1;
+    }
+    j = 0;
+    while (j < 3) {
+        s = s + j;
+        j = j + 1;
+    }
+    *1000 = s;
+    halt;
+}
+""",
+    "dead_code": """function main() {
+    int a;
+    a = 1;
+    if (1 > 2) {
+        a = 2;
+    }
+    while (5 < 2) {
+        a = a + 1;
+    }
+    *1000 = a;
+    halt;
+}
+""",
+    "folding": """function main() {
+    int a;
+    a = 2 * 3 + 4;
+    a = a * 8;
+    *1000 = a;
+    halt;
+}
+""",
+}
+
+# Options of the builds compiling the same parse.
+BUILDS = {
+    "default": {},
+    "memory": {"overlay": False, "registers": []},
+    "instrument": {"instrument": "all"},
+}
+
+def sources():
+    params = []
+    for path in sorted(glob.glob(os.path.join(TEST_DIR, "*.alang"))):
+        with open(path) as f:
+            params.append(pytest.param(f.read(), id=os.path.basename(path)))
+    params += [pytest.param(source, id=name) for name, source in SOURCES.items()]
+    return params
+
+def snapshot(blocks):
+    return json.dumps(blocks, default=to_serializable, sort_keys=True)
+
+@pytest.mark.parametrize("build", BUILDS)
+@pytest.mark.parametrize("source", sources())
+def test_compile_keeps_parsed_blocks(tmp_path, source, build):
+    """Compiling leaves the parse unchanged, so compiling it again gives what compiling a fresh parse gives."""
+    path = tmp_path / "program.alang"
+    path.write_text(source)
+    blocks = parse_file(str(path))
+    before = snapshot(blocks)
+    first = compile_program(blocks, BUILDS[build]).words()
+    assert snapshot(blocks) == before
+    assert compile_program(blocks, BUILDS[build]).words() == first == compile_program(parse_file(str(path)), BUILDS[build]).words()
+
+def generated_program(tmp_path, source):
+    path = tmp_path / "generated.alang"
+    path.write_text(source)
+    return str(path)
+
+def test_cache_build_matches_serial(tmp_path):
+    """Builds from a cache, before and after one function is edited, are identical to uncached builds."""
+    source = generate_program({"functions": 6, "depth": 2}, 3)
+    path = generated_program(tmp_path, source)
+    serial = compile_program(parse_file(path)).words()
+    cache = BuildCache(str(tmp_path / "cache"))
+    for _ in range(2):
+        assert compile_program(parse_file(path), {"cache": cache}).words() == serial
+
+    # The last function returns b instead of a. Only it is compiled again.
+    end = source.rindex("return a;")
+    path = generated_program(tmp_path, source[:end] + "return b;" + source[end + len("return a;"):])
+    stats = {}
+    assert compile_program(parse_file(path), {"cache": cache}, stats).words() == compile_program(parse_file(path)).words()
+    assert stats["cache"]["misses"] == 1
+    assert stats["cache"]["hits"] > 0
+
+def test_parallel_build_matches_serial(tmp_path):
+    path = generated_program(tmp_path, generate_program({"functions": 8, "depth": 2}, 4))
+    serial_stats, parallel_stats = {}, {}
+    serial = compile_program(parse_file(path), {"jobs": 1}, serial_stats)
+    parallel = compile_program(parse_file(path), {"jobs": 3}, parallel_stats)
+    assert parallel.words() == serial.words()
+    assert parallel.listing() == serial.listing()
+    assert parallel_stats == serial_stats
@@ -0,0 +1,188 @@
+import os, sys, glob
+import pytest
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), "..", "src"))
+from alang_parser import parse_file
+from alang_compiler import compile_program, ALLOCATABLE_REGISTERS
+from program_generator import generate_program
+from simulator import Simulator
+
+# Differential tests: each build must leave the same results as a build with every optimization off.
+# Programs read input from INPUT_BASE up and keep their results from OUTPUT_BASE up, above the
+# variables. The rows below INPUT_BASE hold variables, which the optimizations are free to move
+# or keep in registers.
+
+TEST_DIR = os.path.dirname(__file__)
+INPUT_BASE = 100
+OUTPUT_BASE = 1000
+INPUT = {adr: adr * 7 + 3 for adr in range(INPUT_BASE, OUTPUT_BASE)}
+# loop_test never halts. Programs are compared after this many instructions.
+MAX_STEPS = 200000
+
+UNOPTIMIZED = {
+    "peephole": [], "registers": [], "fold": False, "inline_threshold": 0, "call_liveness": False,
+    "dead_code": False, "overlay": False, "unroll": 1, "layout": False}
+
+# Build name -> options on top of UNOPTIMIZED, None for the default options.
+BUILDS = {
+    "default": None,
+    "registers": {"registers": ALLOCATABLE_REGISTERS},
+    "fold": {"fold": True},
+    "unroll": {"unroll": 4},
+    "layout": {"layout": True},
+    "value_numbering": {"peephole": ["value_numbering"], "registers": ALLOCATABLE_REGISTERS},
+}
+
+# Name -> source of programs exercising single optimizations.
+SOURCES = {
+    "folding": """function main() {
+    int x;
+    x = *100;
+    *1000 = 2 * 3 + x * 8 - 0;
+    *1001 = x * 1 * 4 + 5 - 2;
+    *1002 = 0 + x * 0 + 16 * x;
+    halt;
+}
+""",
+    "loops": """function main() {
+    int i;
+    int j;
+    int s;
+    s = *100;
+    i = 0;
+    while (i < 8) {
+        s = s * 3 + i;
+        i = i + 1;
+    }
+    *1000 = s;
+    j = 0;
+    while (j != 3) {
+        s = s - j;
+        j = j + 1;
+    }
+    *1001 = s;
+    halt;
+}
+""",
+    "branches": """function main() {
+    int a;
+    int n;
+    a = *100;
+    n = 0;
+    while (a > 5) {
+        if (a < 400) {
+            a = a - 7;
+        }
+        if (a > 399) {
+            a = a - 100;
+            n = n + 1;
+        }
+        if (a != 50) {
+            n = n + 2;
+        }
+    }
+    *1000 = a;
+    *1001 = n;
+    halt;
+}
+""",
+    # Stores through p overwrite a and b, which must be read again.
+    "aliasing": """function main() {
+    int a;
+    int b;
+    int p;
+    a = *100;
+    b = a + 1;
+    *1000 = a + b;
+    p = &a;
+    *p = b * 2;
+    *1001 = a + b;
+    p = &b;
+    *p = a;
+    *1002 = a + b;
+    *1003 = *100 + *100;
+    halt;
+}
+""",
+    # unused is removed as dead code, but its size is still counted with its hidden memcpy variable.
+    "memcpy": """int ga[4];
+function main() {
+    int la[4];
+    int p;
+    ga = *100;
+    p = &la;
+    memcpy(p, &ga, 2);
+    p = 1000;
+    memcpy(p, &la, 2);
+    halt;
+}
+
+function unused() {
+    int p;
+    int la[4];
+    p = &la;
+    memcpy(p, &ga, 2);
+}
+""",
+    # The nested call of f through g resets the counter i, which locals share between calls.
+    "recursion": """function main() {
+    int r;
+    r = f(0);
+    *1000 = r;
+    halt;
+}
+
+function f(d) {
+    int c;
+    int i;
+    int s;
+    c = 0;
+    i = 0;
+    while (i < 2) {
+        s = g(d);
+        c = c + 1;
+        i = i + 1;
+    }
+    return c;
+}
+
+function g(e) {
+    if (e < 1) {
+        e = e + 1;
+        e = f(e);
+    }
+    return 0;
+}
+""",
+}
+
+GENERATED = [{"functions": 4, "depth": 2, "array": 4, "seed": 1}, {"functions": 6, "depth": 3, "fanout": 3, "seed": 2}]
+
+def programs():
+    sources = []
+    for path in sorted(glob.glob(os.path.join(TEST_DIR, "*.alang"))):
+        with open(path) as f:
+            sources.append(pytest.param(f.read(), id=os.path.basename(path)))
+    for name, source in SOURCES.items():
+        sources.append(pytest.param(source, id=name))
+    for sizes in GENERATED:
+        sizes = dict(sizes)
+        seed = sizes.pop("seed")
+        sources.append(pytest.param(generate_program(sizes, seed), id=f"generated-{seed}"))
+    return sources
+
+def run(path, options):
+    """Compile and simulate a program. Return whether it halted and its output rows."""
+    blocks = parse_file(str(path))
+    assert max((adr + b.arrays.get(name, 1) for b in blocks for name, adr in b.variables.items()), default=0) <= INPUT_BASE
+    program = compile_program(blocks, options)
+    sim = Simulator(program.words(), memory=INPUT, entry=program.entry)
+    sim.run(MAX_STEPS)
+    return sim.halted, sim.mem[OUTPUT_BASE:]
+
+@pytest.mark.parametrize("build", BUILDS)
+@pytest.mark.parametrize("source", programs())
+def test_build_matches_unoptimized(tmp_path, source, build):
+    path = tmp_path / "program.alang"
+    path.write_text(source)
+    options = {} if BUILDS[build] is None else {**UNOPTIMIZED, **BUILDS[build]}
+    assert run(path, options) == run(path, UNOPTIMIZED)
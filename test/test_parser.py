@@ -0,0 +1,23 @@
+import os, sys
+import pytest
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), "..", "src"))
+from alang_lexer import tokenize
+from alang_parser import parse_code_block, parse_file, ParseError
+
+TRUNCATED = [
+    "function main() {",
+    "function main() {\n    int a;\n    while (a < 2) {",
+    "function main() {\n    if (1 < 2) {\n        halt;\n    }\n",
+]
+
+@pytest.mark.parametrize("source", TRUNCATED)
+def test_unterminated_block_is_a_syntax_error(source):
+    with pytest.raises(ParseError):
+        parse_code_block(source, tokenize(source), 0, "global", -1, 0, None)
+
+def test_parse_file_reports_unterminated_block(tmp_path, capsys):
+    path = tmp_path / "truncated.alang"
+    path.write_text(TRUNCATED[1])
+    with pytest.raises(SystemExit):
+        parse_file(str(path))
+    assert capsys.readouterr().out == "Parse failed. Invalid syntax starting at line 3\n"
@@ -0,0 +1,38 @@
+import os, sys
+import pytest
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), "..", "src"))
+from alang_parser import parse_file
+from alang_compiler import compile_program
+from simulator import Simulator
+
+TEST_DIR = os.path.dirname(__file__)
+
+def test_batch_simulator_matches_simulator():
+    """gpu_test writes sprite memory at 0x60000, above any smaller default memory."""
+    np = pytest.importorskip("numpy")
+    from batch_simulator import BatchSimulator
+    words = compile_program(parse_file(os.path.join(TEST_DIR, "gpu_test.alang"))).words()
+    scalar = Simulator(words)
+    stats = scalar.run()
+    batch = BatchSimulator(words, 2)
+    result = batch.run()
+    for lane in range(2):
+        assert (result["memory"][lane] == np.array(scalar.mem, dtype=np.uint32)).all()
+        assert result["cycles"][lane] == stats["cycles"]
+        assert result["instructions"][lane] == stats["instructions"]
+
+def test_batch_simulator_narrow_memory():
+    """Programs using low addresses only run the same on memories much smaller than the default."""
+    np = pytest.importorskip("numpy")
+    from batch_simulator import BatchSimulator
+    from simulator import SimulatorError
+    words = compile_program(parse_file(os.path.join(TEST_DIR, "func_test.alang"))).words()
+    scalar = Simulator(words)
+    scalar.run()
+    result = BatchSimulator(words, 3, memory_size=1 << 10).run()
+    assert result["memory"].shape == (3, 1 << 10)
+    assert (result["memory"] == np.array(scalar.mem[:1 << 10], dtype=np.uint32)).all()
+    images = np.full((2, 1 << 10), -1, dtype=np.int64)
+    assert (BatchSimulator(words, images).mem == 0xFFFFFFFF).all()
+    with pytest.raises(SimulatorError):
+        BatchSimulator(words, [{1 << 10: 1}], memory_size=1 << 10)